@@ -0,0 +1,89 @@
+import os,sys
+import time
+import random
+import argparse
+import tempfile
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tag_system import TagSystem, filter_parallel_min
+
+'''
+标签筛选的benchmark
+随机生成一个标签库（不访问图片文件，目录记录由ListCatalog提供），分别用1到N个进程走GUI使用的流式筛选（iterFilterImage），统计耗时和加速比
+进程池的创建（包括传入tag_dict快照）不计入耗时，每个进程数先预热一次；每次计时前清空筛选结果缓存
+另外统计修改一个图片的标签后的第一次筛选（进程池不重建，修改随任务发给进程）
+
+用法：
+    python benchmark/bench_filter.py [--num 图片数] [--tags 标签数] [--workers 最多进程数] [--exp 标签筛选串]
+'''
+
+class ListCatalog(object):
+    '''
+    用路径列表代替目录记录（接口同CatalogSystem里筛选用到的部分）
+    '''
+    def __init__(self, paths):
+        self.paths = paths
+        self.path_set = set(paths)
+
+    def iterImages(self, rootpath, prune=None):
+        return iter(self.paths)
+
+    def hasFile(self, path):
+        return path in self.path_set
+
+def run_filter(tag_system, root, exp):
+    '''
+    清空结果缓存后走一次流式筛选
+    '''
+    tag_system.result_cache.clear()
+    tag_system.result_cache_size = 0
+    return list(itertools.chain.from_iterable(tag_system.iterFilterImage(root, exp)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num', type=int, default=1000000)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--exp', default='{2021}!(t0&t1)|`t2&!t3')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    tag_filedir = tempfile.mkdtemp()
+    root = os.path.join(tag_filedir, 'imgs')
+    base = TagSystem(tag_filedir, ['.jpg'])
+    tags = [base.addMetaTag(f't{i}', 0) for i in range(args.tags)]
+    for i in range(args.tags): #每个标签下挂一个子标签，让`运算符有子树可查
+        base.addMetaTag(f't{i}_sub', tags[i])
+    paths = [os.path.join(root, str(2015+i%10), f'{i}.jpg') for i in range(args.num)]
+    for path in paths:
+        base.tag_dict[path] = {tag:None for tag in random.sample(tags, 3)}
+    print(f'{args.num} images, {args.tags} tags, exp={args.exp}')
+
+    result = None
+    t1 = None
+    for workers in range(1, args.workers+1):
+        tag_system = TagSystem(tag_filedir, ['.jpg'], catalog=ListCatalog(paths), filter_workers=workers)
+        tag_system.meta_tag_tree,tag_system.meta_tag2name,tag_system.tag_dict = base.meta_tag_tree,base.meta_tag2name,dict(base.tag_dict)
+        tag_system._build_tree_index()
+        assert len(paths) >= filter_parallel_min, f'--num should be at least {filter_parallel_min} to use the process pool'
+        run_filter(tag_system, root, args.exp) #预热（创建进程池）
+        best = float('inf')
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            ret = run_filter(tag_system, root, args.exp)
+            best = min(best, time.perf_counter() - t)
+        tag_system.updateTag(paths[0], {tags[0]:None}) #修改后的第一次筛选
+        t = time.perf_counter()
+        run_filter(tag_system, root, args.exp)
+        t_edit = time.perf_counter() - t
+        tag_system.close()
+        if result is None:
+            result,t1 = ret,best
+        assert ret == result, 'results differ between worker counts'
+        print(f'workers={workers:>2}: {best:.3f}s, speedup {t1/best:.2f}x, {len(ret)} matched, after edit {t_edit:.3f}s')
+
+if __name__ == '__main__':
+    main()
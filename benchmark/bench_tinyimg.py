@@ -0,0 +1,54 @@
+import os,sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import yaml
+
+from img_system import tinyimg_tiers, make_tinyimg
+
+'''
+缩略图生成的benchmark
+对目录里的每张图片，分别强制使用每一级生成方式（exif/draft/full），统计每张图片的平均耗时
+最后再统计make_tinyimg（自动选择）的耗时和各级的命中次数
+
+用法：
+    python benchmark/bench_tinyimg.py 图片目录 [--size 缩略图大小] [--num 最多测试的图片数]
+'''
+
+def main():
+    global_args = yaml.load(open(os.path.join(os.path.dirname(__file__), '..', 'global.yml'), encoding='utf-8'), yaml.FullLoader)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dirpath')
+    parser.add_argument('--size', type=int, default=global_args['tinyimg_size'])
+    parser.add_argument('--num', type=int, default=100)
+    args = parser.parse_args()
+
+    names = sorted(os.listdir(args.dirpath))
+    paths = [os.path.join(args.dirpath,name) for name in names if os.path.splitext(name)[1] in global_args['img_extnames']]
+    paths = paths[:args.num]
+    print(f'{len(paths)} images, tinyimg_size={args.size}')
+
+    # 每一级单独计时（该级不可用的图片不计入）
+    for tier,func in tinyimg_tiers:
+        cnt = 0
+        t = time.perf_counter()
+        for path in paths:
+            if func(path, args.size) is not None:
+                cnt += 1
+        t = time.perf_counter() - t
+        per_img = f'{t/cnt*1000:.2f}ms/img' if cnt > 0 else '-'
+        print(f'{tier:>6}: {cnt}/{len(paths)} usable, {per_img}')
+
+    # 自动选择
+    hits = {tier:0 for tier,_ in tinyimg_tiers}
+    t = time.perf_counter()
+    for path in paths:
+        _,tier = make_tinyimg(path, args.size)
+        hits[tier] += 1
+    t = time.perf_counter() - t
+    if len(paths) > 0:
+        print(f'  auto: {t/len(paths)*1000:.2f}ms/img, {hits}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import os
+import time
+import pickle
+import threading
+
+'''
+CatalogSystem模块可独立于Qt/GUI使用
+
+该模块负责维护图片目录树的目录（catalog），用来代替每次都遍历文件系统：
+    1. 为每个目录记录修改时间，以及它的子目录和文件名字
+    2. 读取目录时先对比目录的修改时间，没变化的目录直接使用记录，变化了才用os.scandir重新扫描
+       （目录里增删、重命名文件或子目录都会改变目录的修改时间，但修改文件内容不会）
+    3. 筛选时遍历目录（iterImages/hasFile），刚检查过的目录在catalog_ttl秒内不再检查修改时间，连续筛选时连stat都省掉
+       listDir（显示目录）每次都检查修改时间，刚增删的文件马上能看到
+    符号链接的目录不进入（避免链接成环时无限递归）
+    4. 目录记录保存在文件里，下次启动时继续使用
+    5. 筛选线程和GUI线程会同时使用目录记录，读写记录都要持有lock
+
+目录记录的结构：
+    dirs: 目录key->[修改时间(ns), [子目录名字], [文件名字]]
+    目录key是os.path.normcase过的绝对路径，返回给调用者的路径保留原来的大小写
+'''
+
+class CatalogSystem(object):
+    def __init__(self, catalog_filepath, img_extnames, ttl):
+        self.catalog_filepath = catalog_filepath #保存目录记录的文件路径
+        self.img_extnames = img_extnames #图片文件名后缀
+        self.ttl = ttl #检查过的目录在多少秒内不再检查修改时间
+
+        self.dirs = {} #目录key->[mtime_ns,[子目录名字],[文件名字]]
+        self.checked = {} #目录key->上次检查修改时间的时间（不保存到文件）
+        self.is_dirty = False #判断是否修改（即是否未保存）
+        self.lock = threading.RLock() #互斥锁，保证线程安全
+
+        self.reset() #从文件载入目录记录
+
+    def listDir(self, dirpath):
+        '''
+        列出目录的子目录和文件（目录没变化时不访问文件系统）
+        args
+            dirpath:str 目录路径
+        ret
+            ([str],[str]) 子目录名字列表，文件名字列表；目录不存在时都为空
+        '''
+        ret = self._scan(os.path.abspath(dirpath), use_ttl=False)
+        if ret is None:
+            return [],[]
+        return list(ret[0]),list(ret[1])
+
+    def walkImages(self, rootpath, prune=None):
+        '''
+        查找目录里的所有子孙图片文件（包括子孙目录），顺序与os.walk相同
+        只重新扫描修改时间变化了的目录
+        args
+            rootpath:str 目录路径
+            prune:func(str)->bool 判断是否跳过某个目录的整棵子树（None表示不跳过），被跳过的目录不会被访问
+        ret
+            [str] 图片路径列表
+        '''
+        return list(self.iterImages(rootpath, prune))
+
+    def iterImages(self, rootpath, prune=None):
+        '''
+        walkImages的生成器版本，每扫描一个目录就产出该目录的图片
+        args
+            rootpath:str 目录路径
+            prune:func(str)->bool 判断是否跳过某个目录的整棵子树（None表示不跳过）
+        ret
+            generator(str) 图片路径
+        '''
+        stack = [os.path.abspath(rootpath)]
+        while len(stack) > 0:
+            cur_dir = stack.pop()
+            if prune is not None and prune(cur_dir):
+                continue
+            ret = self._scan(cur_dir)
+            if ret is None: #目录已被删除
+                continue
+            sub_dirs,files = ret
+            for file in files:
+                if os.path.splitext(file)[1] in self.img_extnames:
+                    yield os.path.join(cur_dir, file)
+            for sub_dir in reversed(sub_dirs): #倒序入栈，出栈时按原顺序
+                stack.append(os.path.join(cur_dir, sub_dir))
+
+    def hasFile(self, path):
+        '''
+        判断文件是否存在（根据所在目录的记录判断）
+        args
+            path:str 文件路径
+        ret
+            bool 是否存在
+        '''
+        dirpath,name = os.path.split(os.path.abspath(path))
+        ret = self._scan(dirpath)
+        return ret is not None and name in ret[1]
+
+    def _scan(self, dirpath, use_ttl=True):
+        '''
+        获取一个目录的记录，目录修改时间变化了则重新扫描
+        args
+            dirpath:str 目录的绝对路径
+            use_ttl:bool 刚检查过的目录是否跳过修改时间的检查
+        ret
+            ([str],[str]) 子目录名字列表，文件名字列表（不要修改，重新扫描时会换成新的列表）；目录不存在时返回None
+        '''
+        with self.lock:
+            return self._scan2(dirpath, use_ttl)
+
+    def _scan2(self, dirpath, use_ttl):
+        '''
+        _scan的实现（调用者需持有lock）
+        '''
+        key = os.path.normcase(dirpath)
+        rec = self.dirs.get(key)
+        now = time.time()
+        if use_ttl and rec is not None and now - self.checked.get(key, 0) < self.ttl:
+            return rec[1],rec[2]
+
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            if rec is not None:
+                self._drop(key)
+            return None
+
+        if rec is None or rec[0] != mtime:
+            sub_dirs,files = [],[]
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                sub_dirs.append(entry.name)
+                            elif entry.is_file():
+                                files.append(entry.name)
+                        except OSError: #扫描期间被删除等情况
+                            continue
+            except OSError: #不是目录或没有权限
+                if rec is not None:
+                    self._drop(key)
+                return None
+            if rec is not None: #删掉已不存在的子目录的记录
+                for sub_dir in set(rec[1]) - set(sub_dirs):
+                    self._drop(os.path.normcase(os.path.join(dirpath, sub_dir)))
+            rec = [mtime, sub_dirs, files]
+            self.dirs[key] = rec
+            self.is_dirty = True
+
+        self.checked[key] = now
+        return rec[1],rec[2]
+
+    def _drop(self, key):
+        '''
+        删除一个目录及其所有子孙目录的记录
+        args
+            key:str 目录key
+        '''
+        prefix = os.path.join(key, '')
+        for k in [k for k in self.dirs if k == key or k.startswith(prefix)]:
+            self.dirs.pop(k)
+            self.checked.pop(k, None)
+        self.is_dirty = True
+
+    def save(self):
+        '''
+        保存目录记录到文件（没修改则不保存）
+        '''
+        with self.lock:
+            if not self.is_dirty:
+                return
+            os.makedirs(os.path.dirname(self.catalog_filepath), exist_ok=True)
+            pickle.dump(self.dirs, open(self.catalog_filepath,'wb'))
+            self.is_dirty = False
+
+    def reset(self):
+        '''
+        从文件读取目录记录（没有文件则从空记录开始）
+        '''
+        self.checked = {}
+        if not os.path.exists(self.catalog_filepath):
+            self.dirs = {}
+            self.is_dirty = False
+            return
+        self.dirs = pickle.load(open(self.catalog_filepath,'rb'))
+        self.is_dirty = False
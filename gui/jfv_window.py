@@ -10,6 +10,7 @@ import win32con
 
 from img_system import ImgSystem
 from tag_system import TagSystem
+from catalog_system import CatalogSystem
 from gui.view_widget import ViewWidget
 from gui.filter_widget import FilterWidget
 from gui.tag_widget import TagWidget
@@ -29,6 +30,7 @@ GUI界面结构
     |-FastFuncWidget    快速功能区
     |
     |-TagSystem         标签系统模块（负责标签管理）
+    |-CatalogSystem     目录系统模块（负责记录图片目录树，代替遍历文件系统）
     |-ImgSystem         图片系统模块（负责图片异步读取、缩略图、缓存管理）
 
 信号与槽结构
@@ -43,7 +45,9 @@ GUI界面结构
 viewWidget的更新
     第一类更新主要有两类：
         1. _showDir() （目录模式，显示目录的所有文件）
-        2. _showImgs() （筛选模式，显示筛选结果）
+        2. _beginImgs()+_appendImgs() （筛选模式，显示筛选结果）
+           筛选在FilterThread里进行，结果分批通过filterBatchReady信号发回来，边筛选边显示
+           新的筛选或切换目录时会取消正在进行的筛选（cancelFilter），旧筛选发回来的结果按筛选计数器丢弃
     第二类更新包括了：
         1. _showImg() （图片模式，显示大图）
         2. 鼠标点击，键盘点击等
@@ -57,14 +61,19 @@ viewWidget以外的子界面更新比较单一，包括：
 class JFVWindow(QMainWindow):
     #图片系统的callback信号
     tinyImgReady = pyqtSignal(str,int,int,int)
+    tinyImgFailed = pyqtSignal(str,int,int,int)
     imgReady = pyqtSignal(str) 
+    imgFailed = pyqtSignal(str,str)
+    #筛选线程的callback信号
+    filterBatchReady = pyqtSignal(int,list)
+    filterFinished = pyqtSignal(int,str)
 
     def __init__(self, global_args):
         super().__init__()
         # 处理全局参数
         self.global_args = global_args
         require_abs_args = ['tag_filedir','tinyimg_filedir','dir_icon_path',
-                            'file_icon_path','img_icon_path','fastfunc_filepath']
+                            'file_icon_path','img_icon_path','fastfunc_filepath','catalog_filepath']
         for name in require_abs_args:
             self.global_args[name] = os.path.join(os.getcwd(), self.global_args[name]) #参数里的路径换成绝对路径
 
@@ -80,11 +89,24 @@ class JFVWindow(QMainWindow):
         # 创建其他模块
         self.img_system = ImgSystem(self.global_args['img_poolsize'],
                                    self.global_args['tinyimg_poolsize'],
+                                   self.global_args['img_poolmem'],
+                                   self.global_args['tinyimg_poolmem'],
+                                   self.global_args['img_decoded_poolmem'],
+                                   self.global_args['tinyimg_decoded_poolmem'],
                                    self.global_args['img_extnames'],
                                    self.global_args['tinyimg_filedir'],
+                                   self.global_args['tinyimg_workers'],
                                    self)
+        self.catalog_system = CatalogSystem(self.global_args['catalog_filepath'],
+                                            self.global_args['img_extnames'],
+                                            self.global_args['catalog_ttl'])
         self.tag_system = TagSystem(self.global_args['tag_filedir'],
-                                   self.global_args['img_extnames'])
+                                   self.global_args['img_extnames'],
+                                   self.catalog_system,
+                                   self.global_args['filter_workers'],
+                                   self.global_args['tag_storage'],
+                                   self.global_args['snapshot_keep'],
+                                   self.global_args['snapshot_keep_days'])
 
         # 创建GUI界面
         self.createAction()
@@ -92,9 +114,18 @@ class JFVWindow(QMainWindow):
         self.createToolBar()
         self.createBody()
 
+        # 筛选线程
+        self.filter_cnt = 0 #筛选计数器（每次开始或取消筛选+1，用来丢弃旧筛选的结果）
+        self.filter_thread = None #正在进行的筛选线程
+        self.old_filter_threads = [] #已取消但还没结束的筛选线程（需要保留引用直到结束）
+
         # GUI信号
         self.tinyImgReady.connect(self.slotTinyImgLoaded)
+        self.tinyImgFailed.connect(self.slotTinyImgFailed)
         self.imgReady.connect(self.slotImgLoaded)
+        self.imgFailed.connect(self.slotImgFailed)
+        self.filterBatchReady.connect(self.slotFilterBatch)
+        self.filterFinished.connect(self.slotFilterFinished)
 
         # 初始化界面
         self.slotFilterOK()
@@ -115,6 +146,10 @@ class JFVWindow(QMainWindow):
         self.optionsAction.triggered.connect(self.slotOptionsAction)
         self.tagCntAction = QAction('标签统计', self)
         self.tagCntAction.triggered.connect(self.slotTagCntAction)
+        self.cacheStatsAction = QAction('缓存统计', self)
+        self.cacheStatsAction.triggered.connect(self.slotCacheStatsAction)
+        self.restoreSnapshotAction = QAction('恢复自动保存', self)
+        self.restoreSnapshotAction.triggered.connect(self.slotRestoreSnapshotAction)
 
     def createMenu(self):
         '''
@@ -122,6 +157,8 @@ class JFVWindow(QMainWindow):
         '''
         self.funcMenu = self.menuBar().addMenu('功能')
         self.funcMenu.addAction(self.tagCntAction)
+        self.funcMenu.addAction(self.cacheStatsAction)
+        self.funcMenu.addAction(self.restoreSnapshotAction)
         self.helpMenu = self.menuBar().addMenu('帮助')
         self.helpMenu.addAction(self.aboutAction)
         self.helpMenu.addAction(self.helpAction)
@@ -162,26 +199,29 @@ class JFVWindow(QMainWindow):
         self.setCorner(Qt.TopLeftCorner, Qt.LeftDockWidgetArea)
         self.setCorner(Qt.TopRightCorner, Qt.RightDockWidgetArea)
 
-    def loadImg(self, path):
+    def loadImg(self, path, box):
         '''
         桥接viewWidget和tag_system函数
         viewWidget的imgWidget通过调用它来加载图片
         
         args
             path: str 图片路径
+            box: (int,int) imgWidget显示区域的宽高
         '''
-        if self.img_system.hasImg(path):
-            # 图片有缓存则马上设置
-            img = self.img_system.getImg(path)
+        img,enough = self.img_system.getImg(path, box)
+        if img is not None:
+            # 图片有缓存则马上设置（大小不够时先凑合显示）
             self.viewWidget.imgWidget.setImg(img)
-        else:
-            # 否则，先考虑加载缩略图，再异步加载原图
-            if self.img_system.hasTinyImg(path):
-                tinyimg = self.img_system.getTinyImg(path)
+        elif self.img_system.hasTinyImg(path):
+            # 否则，先考虑加载缩略图
+            tinyimg = self.img_system.getTinyImg(path)
+            if tinyimg is not None: #判断后可能已被淘汰
                 self.viewWidget.imgWidget.setImg(tinyimg)
-            self.img_system.getImg_async(path, None)
+        if not enough:
+            # 异步加载显示区域大小的原图
+            self.img_system.getImg_async(path, box, quickly=True)
 
-    def loadTinyImg(self, grid, path):
+    def loadTinyImg(self, grid, path, quickly=False):
         '''
         桥接viewWidget和tag_system函数
         viewWidget通过调用它来加载缩略图
@@ -189,14 +229,15 @@ class JFVWindow(QMainWindow):
         args
             grid: GridWidget 要设置缩略图的缩略图格子
             path: str 图片路径
+            quickly: bool grid是否在可见区域内（可见的优先加载）
         '''
-        if self.img_system.hasTinyImg(path):
+        img = self.img_system.getTinyImg(path) if self.img_system.hasTinyImg(path) else None
+        if img is not None:
             # 缩略图有缓存则马上设置
-            img = self.img_system.getTinyImg(path)
             grid.imgLabel.setPixmap(img)
         else:
-            # 否则，异步加载缩略图
-            self.img_system.getTinyImg_async(path, (grid.pos[0],grid.pos[1],self.viewWidget.cur_cnt))
+            # 否则（包括判断后已被淘汰），异步加载缩略图
+            self.img_system.getTinyImg_async(path, (grid.pos[0],grid.pos[1],self.viewWidget.cur_cnt), quickly)
 
     def setStatusInfo(self, s):
         '''
@@ -219,8 +260,25 @@ class JFVWindow(QMainWindow):
             return
         grid = self.viewWidget.gridLayout.itemAtPosition(x, y).widget() #由于槽不能传GUI类，因此用x,y来获取grid
         img = self.img_system.getTinyImg(path)
+        if img is None: #发信号后已被淘汰，重新加载
+            self.loadTinyImg(grid, path, True)
+            return
         grid.imgLabel.setPixmap(img)
 
+    def slotTinyImgFailed(self, path, x, y, cnt):
+        '''
+        缩略图载入失败（原图读不了或解码出错），响应tinyImgFailed的槽
+        显示占位图标
+        args
+            path: str 载入失败的缩略图路径
+            x,y: int 设置缩略图的gridWidget在整个网格的坐标
+            cnt: int 异步加载前，viewWidget的计数器的值
+        '''
+        if cnt != self.viewWidget.cur_cnt:
+            return
+        grid = self.viewWidget.gridLayout.itemAtPosition(x, y).widget()
+        grid.imgLabel.setPixmap(self.res['img_icon'])
+
     def slotImgLoaded(self, path):
         '''
         图片异步加载完毕，响应imgReady的槽
@@ -231,8 +289,20 @@ class JFVWindow(QMainWindow):
         if path != self.viewWidget.imgWidget.cur_path:
             return
         
-        img = self.img_system.getImg(path)
-        self.viewWidget.imgWidget.setImg(img)
+        img,_ = self.img_system.getImg(path, self.viewWidget.imgWidget.box())
+        if img is not None:
+            self.viewWidget.imgWidget.setImg(img)
+
+    def slotImgFailed(self, path, err):
+        '''
+        图片载入失败（文件读不了或已损坏），响应imgFailed的槽
+        args
+            path: str 载入失败的图片路径
+            err: str 错误信息
+        '''
+        if path != self.viewWidget.imgWidget.cur_path: #预读的相邻图片，不用提示
+            return
+        self.setStatusInfo(f'图片载入失败：{err}')
 
     def slotFilterOK(self):
         '''
@@ -248,10 +318,12 @@ class JFVWindow(QMainWindow):
         if pathStr == "":
             pathStr = self.global_args['img_default_filedir']
             self.filterWidget.pathLineEdit.setText(self.global_args['img_default_filedir'])
+        self.cancelFilter() #取消正在进行的筛选
         if tagStr != "":
-            # 标签筛选信息不为空，则进入筛选模式
-            select_imgs = self.tag_system.filterImage(pathStr, tagStr)
-            self.viewWidget._showImgs(select_imgs)
+            # 标签筛选信息不为空，则进入筛选模式（在线程里筛选，结果分批显示）
+            self.viewWidget._beginImgs()
+            self.filter_thread = FilterThread(self, self.filter_cnt, pathStr, tagStr)
+            self.filter_thread.start()
         else:
             # 否则，进入目录模式
             self.viewWidget._showDir(pathStr)
@@ -260,6 +332,47 @@ class JFVWindow(QMainWindow):
         self.infoWidget.fill_value() #图片信息更新（应该是更新成非法）
         self.fastFuncWidget.updateHistory(pathStr, tagStr) #更新路径和标签筛选历史
 
+    def cancelFilter(self, wait=False):
+        '''
+        取消正在进行的筛选
+        args
+            wait:bool 是否等待筛选线程结束（程序关闭时使用）
+        '''
+        self.filter_cnt += 1 #已经发出但还没处理的结果也会被丢弃
+        if self.filter_thread is not None:
+            self.filter_thread.cancelled = True
+            self.old_filter_threads.append(self.filter_thread)
+            self.filter_thread = None
+        self.old_filter_threads = [t for t in self.old_filter_threads if not t.isFinished()]
+        if wait:
+            for t in self.old_filter_threads:
+                t.wait()
+
+    def slotFilterBatch(self, cnt, paths):
+        '''
+        筛选线程发回一批结果，响应filterBatchReady的槽
+        args
+            cnt:int 筛选开始时的筛选计数器
+            paths:[str] 这一批筛选结果的路径列表
+        '''
+        if cnt != self.filter_cnt: #已经开始了新的筛选
+            return
+        self.viewWidget._appendImgs(paths)
+
+    def slotFilterFinished(self, cnt, err):
+        '''
+        筛选线程结束，响应filterFinished的槽
+        args
+            cnt:int 筛选开始时的筛选计数器
+            err:str 错误信息（没出错则为空串）
+        '''
+        if cnt != self.filter_cnt:
+            return
+        # 发信号是线程的最后一步，等它真正结束再释放，否则QThread对象可能在线程还在运行时被回收
+        self.filter_thread.wait()
+        self.filter_thread = None
+        self.viewWidget._finishImgs(err)
+
     def slotGridPress(self, grid):
         '''
         [第二类更新界面操作]
@@ -398,6 +511,7 @@ class JFVWindow(QMainWindow):
         打开标签统计消息框。
         '''
         cur_path = self.filterWidget.pathLineEdit.text().strip()
+        cnts,totals = self.tag_system.countTags(cur_path) #一次统计所有标签
 
         # 创建GUI树
         tree = QTreeWidget()
@@ -409,20 +523,17 @@ class JFVWindow(QMainWindow):
 
         def dfs(cur_node, deep, fa_item):
             tag = cur_node[0]
-            cur_cnt = self.tag_system.calc_tag_cnt(cur_path, tag)
             if deep == 0:
                 item = QTreeWidgetItem()
                 tree.addTopLevelItem(item)
             else:
                 item = QTreeWidgetItem(fa_item)
             item.setText(0, self.tag_system.getTagName(tag))
-            item.setText(1, str(cur_cnt))
-            son_cnt = 0
+            item.setText(1, str(cnts.get(tag, 0)))
             for son_node in cur_node[1]:
-                son_cnt += dfs(son_node, deep+1, item)
+                dfs(son_node, deep+1, item)
             if len(cur_node[1]) != 0:
-                item.setText(2, str(cur_cnt+son_cnt))
-            return cur_cnt+son_cnt
+                item.setText(2, str(totals[tag]))
         
         dfs(self.tag_system.meta_tag_tree, 0, None)
         tree.expandAll()
@@ -437,6 +548,46 @@ class JFVWindow(QMainWindow):
         layout.addWidget(tree)
         msgbox.exec_()
 
+    def slotCacheStatsAction(self):
+        '''
+        cacheStatsAction的槽。
+        显示图片系统的缓存统计信息。
+        '''
+        stats = self.img_system.getStats()
+        lines = []
+        for name,title in [('img_decoded_pool','图片解码池'),('img_pool','图片缓存池'),
+                           ('tinyimg_decoded_pool','缩略图解码池'),('tinyimg_pool','缩略图缓存池')]:
+            pool_stats = stats[name]
+            lookups = pool_stats['hits'] + pool_stats['misses']
+            hit_rate = pool_stats['hits'] / lookups if lookups > 0 else 0
+            lines.append(f"{title}：{pool_stats['entries']}项，{pool_stats['resident_bytes']/(1<<20):.1f}MB，"
+                         f"命中{pool_stats['hits']}，未命中{pool_stats['misses']}（命中率{hit_rate:.1%}），淘汰{pool_stats['evictions']}")
+        lines.append('缩略图来源：' + '，'.join(f'{k}:{v}' for k,v in stats['tinyimg_tiers'].items()))
+
+        msgbox = QMessageBox()
+        msgbox.setWindowTitle('缓存统计')
+        msgbox.setText('\n'.join(lines))
+        msgbox.exec_()
+
+    def slotRestoreSnapshotAction(self):
+        '''
+        restoreSnapshotAction的槽。
+        选择一个自动保存，把标签数据恢复成它（恢复后是未保存的状态）。
+        '''
+        names = self.tag_system.listSnapshots()
+        if len(names) == 0:
+            QMessageBox.information(self, '恢复自动保存', '没有自动保存')
+            return
+        name,ok = QInputDialog.getItem(self, '恢复自动保存', '选择自动保存的时间', list(reversed(names)), 0, False)
+        if not ok:
+            return
+        self.cancelFilter(wait=True) #筛选线程可能正在读标签数据，等它结束
+        self.tag_system.restoreSnapshot(name)
+        self.tagWidget.remake_tree()
+        self.tagWidget.saveBtn.setEnabled(True)
+        self.tagWidget.resetBtn.setEnabled(True)
+        self.slotFilterOK()
+
     def closeEvent(self, e):
         '''
         关闭事件
@@ -459,3 +610,29 @@ class JFVWindow(QMainWindow):
             return super().closeEvent(e)
         elif result == QMessageBox.DestructiveRole:
             e.ignore()
+
+
+class FilterThread(QThread):
+    '''
+    筛选线程
+    调用TagSystem的流式筛选，每得到一批结果就通过顶层窗口的信号发回GUI线程
+    '''
+    def __init__(self, mainWindow, cnt, pathStr, tagStr):
+        super().__init__()
+        self.mainWindow = mainWindow #顶层窗口，用来发送信号
+        self.cnt = cnt #筛选计数器
+        self.pathStr = pathStr #路径串
+        self.tagStr = tagStr #标签筛选串
+        self.cancelled = False #是否已取消（由GUI线程设置，每批之间检查）
+
+    def run(self):
+        err = ''
+        try:
+            for batch in self.mainWindow.tag_system.iterFilterImage(self.pathStr, self.tagStr):
+                if self.cancelled:
+                    return
+                if len(batch) > 0:
+                    self.mainWindow.filterBatchReady.emit(self.cnt, batch)
+        except Exception as e: #错误信息通过filterFinished显示在状态栏
+            err = repr(e)
+        self.mainWindow.filterFinished.emit(self.cnt, err)
@@ -39,8 +39,9 @@ class TagWidget(QDockWidget):
 
         self.saveBtn = QPushButton('保存')
         self.resetBtn = QPushButton('重设')
-        self.saveBtn.setEnabled(False) #刚开始脏位不脏
-        self.resetBtn.setEnabled(False)
+        is_dirty = self.parent().tag_system.is_dirty #刚开始脏位不脏（启动时恢复了上次未保存的修改则为脏）
+        self.saveBtn.setEnabled(is_dirty)
+        self.resetBtn.setEnabled(is_dirty)
 
         self.content = QWidget()
         layout2 = QHBoxLayout()
@@ -76,13 +77,10 @@ class TagWidget(QDockWidget):
         paths = self._get_cur_focus_paths()
         assert len(paths)!=0, "slotItemCheckStateChanged but len of paths is zero"
         #更新tag信息
-        for path in paths:
-            tagSet = tag_system.getTag(path)
-            if tag_state and tag not in tagSet:
-                tagSet[tag] = None
-            elif not tag_state and tag in tagSet:
-                tagSet.pop(tag)
-            tag_system.updateTag(path, tagSet)
+        if tag_state:
+            tag_system.addTagToPaths(paths, tag)
+        else:
+            tag_system.removeTagFromPaths(paths, tag)
         # 更新脏位相关的GUI部件状态
         self.saveBtn.setEnabled(True)
         self.resetBtn.setEnabled(True)
@@ -115,12 +113,14 @@ class TagWidget(QDockWidget):
         result = QMessageBox.question(self, '重设', '你确定要重设吗？')
         if result != QMessageBox.Yes:
             return
-        # 先reset数据结构，再reset图形界面
+        # 先等筛选线程结束（它在读标签数据），再reset数据结构，最后reset图形界面
+        self.parent().cancelFilter(wait=True)
         self.parent().tag_system.reset()
         self.remake_tree()
         
         self.saveBtn.setEnabled(False)
         self.resetBtn.setEnabled(False)
+        self.parent().slotFilterOK() #筛选被取消了，按重设后的数据刷新页面
 
     def slotMenuPopup(self, pos):
         '''
@@ -31,12 +31,16 @@ class ViewWidget(QStackedWidget):
         self.col = 2 #grid表的列数
         self.cur_cnt = 0 #页面计数器（每当刷新页面会+1，用来判断缩略图是否还要加载）
         self.cur_focus = [] #当前焦点grid列表（十分重要，其他界面都依赖它更新参数）
+        self.img_direction = 1 #图片模式最近一次切换的方向（1是下一张，-1是上一张），用于预读
+        self.cur_paths = [] #当前页面所有grid的路径（按显示顺序）
+        self.pin_range = None #钉住缩略图的grid范围[beg,end)（范围变了才重新钉住）
         # 创建GUI部件
         self.dirWidget = MyScrollArea(self.parent())
         self.dirWidget.setWidgetResizable(True) #设置这个才能动态resize
         self.contentWidget = QWidget()
         self.gridLayout = QGridLayout(self.contentWidget)
         self.dirWidget.setWidget(self.contentWidget)
+        self.dirWidget.verticalScrollBar().valueChanged.connect(self.slotScrolled) #滚动时提升可见缩略图的加载优先级
 
         self.imgWidget = ImgWidget(self.parent())
 
@@ -125,6 +129,23 @@ class ViewWidget(QStackedWidget):
             if pbeg != grid.pos:
                 self.cur_focus = self.cur_focus[::-1]
 
+    def slotScrolled(self, value):
+        '''
+        目录/筛选模式滚动的槽
+        新进入可见区域的缩略图提升加载优先级，钉住的缩略图跟着可见区域移动
+        args
+            value:int 滚动条的值
+        '''
+        self._pinVisible()
+        row_beg,row_end = self._visibleRows()
+        paths = []
+        for row in range(row_beg, row_end):
+            for col in range(self.col):
+                item = self.gridLayout.itemAtPosition(row, col)
+                if item is not None and item.widget().filetype == 'img':
+                    paths.append(item.widget().path)
+        self.parent().img_system.boostTinyImgs(paths)
+
     def slotImgDoubleClick(self):
         '''
         图片双击的假槽（信号先发到顶层窗口，然后顶层窗口调用该函数）
@@ -144,6 +165,7 @@ class ViewWidget(QStackedWidget):
         # 计算上一张/下一张图片
         assert e.key() in [Qt.Key_Left, Qt.Key_Right], f'unexpected key({e.key()})'
         is_left = e.key() == Qt.Key_Left
+        self.img_direction = -1 if is_left else 1
         old_item = self.cur_focus[0]
         old_ix = self.gridLayout.indexOf(old_item)
         new_item = self._findPreImgGrid(old_ix) if is_left else self._findNextImgGrid(old_ix)
@@ -166,16 +188,17 @@ class ViewWidget(QStackedWidget):
         args
             path:str 目录的路径
         '''
-        # 获取目录和文件列表
-        names = ['..'] + os.listdir(path) #加入返回上级的目录
-        paths = [os.path.abspath(os.path.join(path,k)) for k in names] #换成绝对路径
-        dir_paths = [k for k in paths if os.path.isdir(k)]
-        file_paths = [k for k in paths if os.path.isfile(k)]
+        # 获取目录和文件列表（从目录记录里读取，目录没变化时不访问文件系统）
+        dir_names,file_names = self.parent().catalog_system.listDir(path)
+        dir_paths = [os.path.abspath(os.path.join(path,k)) for k in ['..']+dir_names] #加入返回上级的目录，并换成绝对路径
+        file_paths = [os.path.abspath(os.path.join(path,k)) for k in file_names]
         dir_paths = self._smartSort(dir_paths)
         file_paths = self._smartSort(file_paths)
         # 设置GUI
         self.setCurrentWidget(self.dirWidget) #切换到目录/筛选模式
         self._clearGrids() #先清空grid表格
+        # 同步该目录的缩略图仓库（原图修改过的缩略图需要重新生成），在该页面的缩略图请求之前处理
+        self.parent().img_system.syncTinyImgDir(os.path.abspath(path), self.cur_cnt)
         self._addGrids(dir_paths+file_paths) #先加目录再加文件
         self.parent().setStatusInfo(f'共{len(dir_paths)+len(file_paths)}项（包括{len(dir_paths)}个目录和{len(file_paths)}个文件）')
 
@@ -185,11 +208,37 @@ class ViewWidget(QStackedWidget):
         args
             paths:[str] 所有筛选出来的图片的路径列表
         '''
-        paths = self._smartSort(paths)
+        self._beginImgs()
+        self._appendImgs(paths)
+        self._finishImgs()
+
+    def _beginImgs(self):
+        '''
+        切换到筛选模式，并清空页面，之后的筛选结果由_appendImgs分批加入
+        '''
         self.setCurrentWidget(self.dirWidget)
         self._clearGrids()
-        self._addGrids(paths)
-        self.parent().setStatusInfo(f'共{len(paths)}张图片')
+        self.parent().setStatusInfo('筛选中……')
+
+    def _appendImgs(self, paths):
+        '''
+        筛选模式下追加一批筛选结果（每批内部排序，批与批之间按到达顺序）
+        args
+            paths:[str] 这一批筛选出来的图片的路径列表
+        '''
+        self._addGrids(self._smartSort(paths))
+        self.parent().setStatusInfo(f'已找到{len(self.cur_paths)}张图片，筛选中……')
+
+    def _finishImgs(self, err=''):
+        '''
+        筛选结束，更新状态栏
+        args
+            err:str 筛选出错时的错误信息（没出错则为空串）
+        '''
+        if err != '':
+            self.parent().setStatusInfo(f'筛选出错：{err}')
+        else:
+            self.parent().setStatusInfo(f'共{len(self.cur_paths)}张图片')
 
     def _showImg(self, grid):
         '''
@@ -206,6 +255,29 @@ class ViewWidget(QStackedWidget):
         self.cur_focus = [grid]
         img_grids = [self.gridLayout.itemAt(i).widget() for i in range(self.gridLayout.count()) if self.gridLayout.itemAt(i).widget().filetype=='img']
         self.parent().setStatusInfo(f'第{img_grids.index(grid)+1}/{len(img_grids)}张图片')
+        # 后台预读前后的图片
+        self.parent().img_system.prefetchImgs(self._prefetchPaths(img_grids, img_grids.index(grid)), self.imgWidget.box())
+
+    def _prefetchPaths(self, img_grids, ix):
+        '''
+        计算图片模式下需要预读的图片
+        沿最近一次切换的方向预读img_prefetch_forward张，反方向预读img_prefetch_backward张
+        按距离由近到远排列，距离相同时切换方向的优先
+        args
+            img_grids:[GridWidget] 所有图片grid（按显示顺序）
+            ix:int 当前图片在img_grids中的位置
+        ret
+            [str] 需要预读的图片路径（越靠前越优先）
+        '''
+        global_args = self.parent().global_args
+        forward,backward = global_args['img_prefetch_forward'],global_args['img_prefetch_backward']
+        ixs = []
+        for dist in range(1, max(forward,backward)+1):
+            if dist <= forward:
+                ixs.append(ix + dist*self.img_direction)
+            if dist <= backward:
+                ixs.append(ix - dist*self.img_direction)
+        return [img_grids[k].path for k in ixs if 0 <= k < len(img_grids)]
 
     def _clearGrids(self):
         '''
@@ -216,24 +288,57 @@ class ViewWidget(QStackedWidget):
             self.gridLayout.itemAt(i).widget().deleteLater()
         self.cur_cnt += 1
         self.cur_focus = []
+        self.cur_paths = []
+        self.pin_range = None
+        self.parent().img_system.setTinyImgGeneration(self.cur_cnt) #旧页面还没加载的缩略图不用再加载
+        self.parent().img_system.unpinTinyImgs() #旧页面的缩略图不再钉住
 
     def _addGrids(self, paths):
         '''
-        添加grid项（一次刷新只能调用一次）
+        添加grid项（接在本页面已有的grid后面，_clearGrids之后从头开始）
         args
-            paths:[str] 所有要显示的文件/图片的路径列表
-        '''
-        pos = [0,0]
-        for i,path in enumerate(paths):
+            paths:[str] 要显示的文件/图片的路径列表
+        '''
+        beg = len(self.cur_paths)
+        self.cur_paths += paths
+        self._pinVisible() #新加入的grid在可见区域附近时钉住，不会被同一批载入的缩略图挤出缓存
+        row_beg,row_end = self._visibleRows()
+        for i,path in enumerate(paths, beg):
+            pos = divmod(i, self.col)
+            visible = row_beg <= pos[0] < row_end
             if i == 0 and os.path.isdir(path):
-                grid = GridWidget(self.parent(), path, tuple(pos), last_dir=True)
+                grid = GridWidget(self.parent(), path, pos, last_dir=True, visible=visible)
             else:    
-                grid = GridWidget(self.parent(), path, tuple(pos))
+                grid = GridWidget(self.parent(), path, pos, visible=visible)
             self.gridLayout.addWidget(grid, pos[0], pos[1])
-            pos[1] += 1
-            if pos[1] == self.col:
-                pos[0] += 1
-                pos[1] = 0
+
+    def _pinVisible(self):
+        '''
+        钉住可见区域上下各tinyimg_pin_rows行的缩略图，取消钉住范围外的
+        '''
+        margin = self.parent().global_args['tinyimg_pin_rows']
+        row_beg,row_end = self._visibleRows()
+        beg = max(row_beg-margin, 0) * self.col
+        end = min((row_end+margin) * self.col, len(self.cur_paths))
+        if (beg,end) == self.pin_range:
+            return
+        self.pin_range = (beg,end)
+        self.parent().img_system.pinTinyImgs(self.cur_paths[beg:end])
+
+    def _visibleRows(self):
+        '''
+        计算目录/筛选模式下可见区域内的grid行范围
+        行高用grid的建议大小估算（grid里缩略图的大小是固定的，还没有grid时按300估算）
+        ret
+            (int,int) 可见行的范围[row_beg,row_end)
+        '''
+        if self.gridLayout.count() > 0:
+            row_h = self.gridLayout.itemAt(0).widget().sizeHint().height() + max(self.gridLayout.verticalSpacing(), 0)
+        else:
+            row_h = 300
+        top = self.dirWidget.verticalScrollBar().value()
+        height = self.dirWidget.viewport().height()
+        return top//row_h, (top+height)//row_h + 1
 
     def _findNextImgGrid(self, ix):
         '''
@@ -364,7 +469,7 @@ class MyScrollArea(QScrollArea):
 
 
 class GridWidget(QWidget):
-    def __init__(self, mainWindow, path, pos, last_dir=False):
+    def __init__(self, mainWindow, path, pos, last_dir=False, visible=False):
         super().__init__()
         self.mainWindow = mainWindow #顶层窗口
         self.path = path #当前grid代表的图片路径
@@ -398,7 +503,7 @@ class GridWidget(QWidget):
         elif self.filetype == 'file':
             self.imgLabel.setPixmap(self.mainWindow.res['file_icon'])
         elif self.filetype == 'img':
-            self.mainWindow.loadTinyImg(self, self.path)
+            self.mainWindow.loadTinyImg(self, self.path, visible)
         else:
             assert False, f'not expected type:{self.filetype}'
 
@@ -504,7 +609,7 @@ class ImgWidget(QWidget):
         整条调用路径是：
             1. reset_img（设置路径）
             2. JFVWindow.loadImg（桥接GUI与ImgSystem）
-            3. ImgSystem.getImg/getImg_async（获取/加载图片）
+            3. ImgSystem.getImg/getImg_async（获取/加载显示区域大小的图片）
             4. JFVWindow.slotImgLoaded（异步回调）
             5. setImg（GUI设置）
         args
@@ -514,12 +619,21 @@ class ImgWidget(QWidget):
         if self.cur_path is None:
             self.imgLabel.setText('')
         else:
-            self.mainWindow.loadImg(self.cur_path)
+            self.mainWindow.loadImg(self.cur_path, self.box())
+
+    def box(self):
+        '''
+        显示区域的宽高（ImgSystem按这个大小解码图片）
+        ret
+            (int,int) 宽高
+        '''
+        return self.size().width(),self.size().height()
 
     def setImg(self, img):
         '''
         reset_img的最后一步
         先resize成最大的大小，再设置
+        （传入的图片已经是接近显示区域的大小，这里的缩放代价很小）
         args
             img:QPixmap 图片
         '''
@@ -565,5 +679,5 @@ class ImgWidget(QWidget):
             e:QEvent
         '''
         if self.mainWindow.viewWidget.currentWidget() is self:
-            self.mainWindow.loadImg(self.cur_path)
+            self.mainWindow.loadImg(self.cur_path, self.box())
         return super().resizeEvent(e)
\ No newline at end of file
@@ -1,11 +1,17 @@
 import os
 import io
+import math
+import mmap
+import struct
+import pickle
 import collections
+import functools
+import heapq
 import threading
 import multiprocessing
 from hashlib import md5
-import pickle
 
+import exifread
 from PIL import Image
 from PIL import ImageQt
 from PyQt5.QtGui import QPixmap
@@ -20,35 +26,77 @@ ImgSystem模块管理的图片包括原图和缩略图两大类
 ImgSystem
 |-ImgReadThread 用于异步读取图片的线程
 |-TinyImgReadThread 用于异步读取缩略图的线程
+|   |-tinyimg_workers 生成缩略图的进程池（第一次需要生成缩略图时才创建，worker执行模块级函数make_tinyimg）
 |
-|-CachedPool 用于缓存的核心数据结构
+|-RequestScheduler 线程的请求队列（按优先级处理，丢弃过期请求）
+|-CachedPool 用于缓存的核心数据结构（按项数或按字节数限制大小，并统计命中率）
+|-TinyImgStore 缩略图在硬盘上的仓库（一个目录对应一个仓库）
+
+请求调度
+    原图和缩略图各有一个线程和一个RequestScheduler，原图线程不会排在缩略图请求后面
+    1. 请求带有代数（ViewWidget的cur_cnt），页面刷新后，旧页面的缩略图请求在读取前就被丢弃
+    2. 优先级：原图 > 可见的缩略图 > 不可见的缩略图，滚动时新露出的缩略图会被提升优先级
+    3. 图片模式显示一张图片后，会在后台预读前后的图片（prefetchImgs），优先级低于要显示的原图
+       每次加急载入原图时原图请求的代数+1，之前位置的预读请求随之作废
+    4. 同一张缩略图正在进程池里生成时，新的请求不会重复生成，而是合并到等待列表，生成完一起发送回调信号
 
 缓存结构
-    图片只有一级缓存结构（内存），缩略图有两极缓存结构（内存，硬盘）
-    缩略图的缓存：
-    1. 该模块会将同一目录的所有图片加载，生成缩略图，并一同保存成一个文件存入电脑
-    2. 异步获取时，模块文件将加载到内存后，是以二进制串存放缩略图，而不是数字格式
-    3. 同步获取时，模块会将二进制串的图片解码成QPixmap，供GUI使用
+    图片有两级缓存结构（内存里的解码池和二进制池），缩略图有三级缓存结构（解码池，二进制池，硬盘）
+    1. 解码池（热）：线程里解码好的QImage，GUI线程命中时只需QPixmap.fromImage
+       原图不解码成原始大小，而是用draft解码成显示区域需要的大小（长边按256像素取整），
+       每张原图最多缓存img_decoded_sizes种大小，窗口大小改变和再次访问时直接复用
+    2. 二进制池（冷）：图片的二进制串，解码池被淘汰后还能在线程里重新解码，而不用读硬盘
+    3. 同步获取时，解码池没有的话才在GUI线程解码二进制串
+    缩略图的硬盘缓存：
+    1. 同一目录的缩略图存放在一个仓库里，仓库由只追加的pack文件和索引文件组成
+    2. 读取时只通过mmap读出需要的那一张缩略图，仓库里没有的缩略图才读原图生成，并追加到仓库
+       仓库为每张缩略图记录原图的大小和修改时间，打开仓库或显示目录时用os.scandir对比，
+       只删除变化了的条目（之后按需重新生成），而不是整个目录重建
+       显示目录时的同步也作为请求交给缩略图线程，先于该页面的缩略图处理，GUI线程不扫描目录
+       以前版本每个目录一个的.pkl缓存，在第一次打开该目录的仓库时导入（原图没改过的）并删除
+    3. 生成缩略图交给进程池并行执行，每生成完一张就马上缓存和发送回调信号
+    4. 可见区域连同上下余量的缩略图在二进制池里被钉住（pinTinyImgs），随滚动移动，目录比缓存池大时，
+       后载入的缩略图不会淘汰正在看的缩略图，钉住的项数有上限，缓存池的大小限制仍然有效
+    缩略图的生成分三级（make_tinyimg），依次尝试：
+    1. exif：直接使用EXIF内嵌的预览图（预览图不小于缩略图大小时）
+    2. draft：JPEG按DCT缩放解码到接近缩略图的大小
+    3. full：完整解码原图再缩放
+    每一级的使用次数记录在ImgSystem.tinyimg_stats
 '''
 
 class ImgSystem(object):
-    def __init__(self, img_poolsize, tinyimg_poolsize, img_extnames, tinyimg_filedir, mainWindow):
+    def __init__(self, img_poolsize, tinyimg_poolsize, img_poolmem, tinyimg_poolmem,
+                 img_decoded_poolmem, tinyimg_decoded_poolmem, img_extnames, tinyimg_filedir, tinyimg_workers, mainWindow):
         self.img_poolsize = img_poolsize #int 图片缓存池的大小
         self.tinyimg_poolsize = tinyimg_poolsize #int 缩略图缓存池的大小
+        self.img_poolmem = img_poolmem #int 图片缓存池的内存上限（MB，0表示按项数限制）
+        self.tinyimg_poolmem = tinyimg_poolmem #int 缩略图缓存池的内存上限（MB，0表示按项数限制）
+        self.img_decoded_poolmem = img_decoded_poolmem #int 图片解码池的内存上限（MB）
+        self.tinyimg_decoded_poolmem = tinyimg_decoded_poolmem #int 缩略图解码池的内存上限（MB）
         self.img_extnames = img_extnames #[str] 图片后缀列表
         self.tinyimg_filedir = tinyimg_filedir #str 保存缩略图的目录路径
+        self.tinyimg_workers = tinyimg_workers #int 生成缩略图的进程数（0表示CPU核数）
         self.mainWindow = mainWindow #JFVWindow GUI顶层窗口
+        self.tinyimg_stats = collections.Counter() #str->int 缩略图来源的统计（store/exif/draft/full）
+        self.img_generation = 0 #原图请求的代数（加急载入原图时+1，用于作废之前的预读）
 
         # 初始化文件系统
         os.makedirs(self.tinyimg_filedir, exist_ok=True)
 
         # 创建缓存池
-        self.img_pool = CachedPool(self.img_poolsize)
-        self.tinyimg_pool = CachedPool(self.tinyimg_poolsize)
+        self.img_pool = CachedPool(self.img_poolsize, self.img_poolmem<<20)
+        self.tinyimg_pool = CachedPool(self.tinyimg_poolsize, self.tinyimg_poolmem<<20)
+        self.img_decoded_pool = CachedPool(0, self.img_decoded_poolmem<<20, sizeof_scaled_imgs)
+        self.tinyimg_decoded_pool = CachedPool(0, self.tinyimg_decoded_poolmem<<20, sizeof_qimage)
+
+        # 创建与线程通信的请求队列
+        self.img_queue = RequestScheduler()
+        self.tinyimg_queue = RequestScheduler()
 
-        # 创建与线程通信的消息队列
-        self.img_queue = multiprocessing.Queue()
-        self.tinyimg_queue = multiprocessing.Queue()
+        # 生成缩略图的进程池（第一次需要生成缩略图时才创建，缩略图都在仓库里时不用启动进程）
+        self.tinyimg_worker_pool = None
+        self.tinyimg_worker_lock = threading.Lock() #进程池会被线程创建，被GUI线程关闭
+        self.closed = False
 
         # 创建线程
         self.p_img = ImgReadThread(self)
@@ -58,15 +106,26 @@ class ImgSystem(object):
         self.p_img.start()
         self.p_tinyimg.start()
 
-    def getImg(self, path):
+    def getImg(self, path, box):
         '''
         获取图片（同步方式）
+        从解码池里已解码的大小中，选不小于显示需要的最小一种；都比需要的小时选最大的一种
         args
             path: str 图片路径
+            box: (int,int) 显示区域的宽高
         ret
-            QPixmap 目标图片
+            QPixmap|None 目标图片（还没解码过时为None）
+            bool 该图片的大小是否足够显示（不够时应再异步载入）
         '''
-        return self.decodeImg(self.img_pool.get(path))
+        decoded = self.img_decoded_pool.get_or_none(path, count=True)
+        if decoded is None:
+            return None,False
+        img_wh,sizes = decoded
+        need_long = max(fit_size(img_wh, box, 1))
+        enough_longs = [long for long in sizes if long >= need_long]
+        if len(enough_longs) > 0:
+            return QPixmap.fromImage(sizes[min(enough_longs)]),True
+        return QPixmap.fromImage(sizes[max(sizes)]),False
 
     def getTinyImg(self, path):
         '''
@@ -74,9 +133,31 @@ class ImgSystem(object):
         args
             path: str 缩略图路径
         ret
-            QPixmap 目标缩略图
+            QPixmap|None 目标缩略图（不在缓存里时为None）
+        '''
+        return self._getFromTiers(self.tinyimg_decoded_pool, self.tinyimg_pool, path)
+
+    def _getFromTiers(self, decoded_pool, pool, path):
+        '''
+        从两级缓存中获取图片
+        解码池命中时直接转换成QPixmap，否则在GUI线程解码二进制串，并放入解码池
+        两级都没有（例如刚被其他线程淘汰）时返回None，调用者应改为异步载入
+        args
+            decoded_pool:CachedPool 解码池
+            pool:CachedPool 二进制池
+            path:str 图片路径
+        ret
+            QPixmap|None 目标图片
         '''
-        return self.decodeImg(self.tinyimg_pool.get(path))
+        qimg = decoded_pool.get_or_none(path)
+        if qimg is not None:
+            return QPixmap.fromImage(qimg)
+        img_b = pool.get_or_none(path)
+        if img_b is None:
+            return None
+        qimg = decode_qimage(img_b)
+        decoded_pool.put(path, qimg)
+        return QPixmap.fromImage(qimg)
 
     def hasImg(self, path):
         '''
@@ -86,7 +167,7 @@ class ImgSystem(object):
         ret
             bool 是否包含
         '''
-        return self.img_pool.has(path)
+        return path in self.img_decoded_pool or path in self.img_pool
 
     def hasTinyImg(self, path):
         '''
@@ -96,7 +177,7 @@ class ImgSystem(object):
         ret
             bool 是否包含
         '''
-        return self.tinyimg_pool.has(path)
+        return self.tinyimg_decoded_pool.has(path) or self.tinyimg_pool.has(path)
 
     def getImg_async(self, path, args, quickly=False):
         '''
@@ -104,10 +185,64 @@ class ImgSystem(object):
         载入后线程会向主线程发信号
         args
             path: str 图片路径
-            args: （未启用）
-            quickly: 是否加急载入（未启用）
+            args: (int,int) 显示区域的宽高（线程会解码成这个大小）
+            quickly: 是否加急载入（ImgWidget要显示的图片）
+        '''
+        if quickly:
+            # 要显示的图片变了，之前的预读请求作废
+            self.img_generation += 1
+            self.img_queue.setGeneration(self.img_generation)
+            self.img_queue.put(path, args, RequestScheduler.PRIORITY_URGENT, self.img_generation)
+        else:
+            self.img_queue.put(path, args, RequestScheduler.PRIORITY_NORMAL, self.img_generation)
+
+    def prefetchImgs(self, paths, box):
+        '''
+        预读图片到缓存池（异步，不需要回调）
+        args
+            paths:[str] 图片路径列表，越靠前越优先
+            box:(int,int) 显示区域的宽高
+        '''
+        for i,path in enumerate(paths):
+            self.img_queue.put(path, box, RequestScheduler.PRIORITY_NORMAL+i, self.img_generation)
+
+    def getStats(self):
+        '''
+        获取缓存的统计信息（给GUI和benchmark用）
+        ret
+            dict 包括两个缓存池的统计，以及缩略图来源的统计
+        '''
+        return {
+            'img_pool': self.img_pool.stats(),
+            'tinyimg_pool': self.tinyimg_pool.stats(),
+            'img_decoded_pool': self.img_decoded_pool.stats(),
+            'tinyimg_decoded_pool': self.tinyimg_decoded_pool.stats(),
+            'tinyimg_tiers': dict(self.tinyimg_stats),
+        }
+
+    def syncTinyImgDir(self, dirpath, cnt):
+        '''
+        同步某目录的缩略图仓库（异步方式，在缩略图线程里扫描目录，不阻塞GUI线程）
+        原图被修改或删除的缩略图会从仓库和缓存池中删除，之后请求时会重新生成
+        同步请求的优先级比该页面的缩略图请求高，因此会先于它们处理
+        args
+            dirpath:str 目录路径
+            cnt:int ViewWidget的全局计数器（页面刷新后，还没处理的同步请求被丢弃）
         '''
-        self.img_queue.put([path,args])
+        self.tinyimg_queue.put((TinyImgReadThread.SYNC_REQUEST,dirpath), None, RequestScheduler.PRIORITY_SYNC, cnt)
+
+    def get_tinyimg_worker_pool(self):
+        '''
+        获取生成缩略图的进程池，第一次调用时创建（在缩略图线程调用）
+        ret
+            multiprocessing.Pool|None 进程池，ImgSystem已关闭时为None
+        '''
+        with self.tinyimg_worker_lock:
+            if self.closed:
+                return None
+            if self.tinyimg_worker_pool is None:
+                self.tinyimg_worker_pool = multiprocessing.Pool(self.tinyimg_workers or None)
+            return self.tinyimg_worker_pool
 
     def getTinyImg_async(self, path, args, quickly=False):
         '''
@@ -115,18 +250,58 @@ class ImgSystem(object):
         载入后线程会向主线程发信号
         args
             path: str 图片路径
-            args: (int,int,int) 需要缩略图的grid的x，y坐标，以及点击时ViewWidget的全局计数器
-            quickly: 是否加急载入（未启用）
+            args: (int,int,int) 需要缩略图的grid的x，y坐标，以及点击时ViewWidget的全局计数器（同时是请求的代数）
+            quickly: 是否加急载入（grid在可见区域内）
         '''
-        self.tinyimg_queue.put([path,args])
+        priority = RequestScheduler.PRIORITY_URGENT if quickly else RequestScheduler.PRIORITY_NORMAL
+        self.tinyimg_queue.put(path, args, priority, args[2])
+
+    def setTinyImgGeneration(self, cnt):
+        '''
+        设置缩略图请求的当前代数
+        比它旧的请求（旧页面的缩略图）会在读取前被丢弃
+        args
+            cnt:int ViewWidget的全局计数器
+        '''
+        self.tinyimg_queue.setGeneration(cnt)
+
+    def boostTinyImgs(self, paths):
+        '''
+        提升缩略图请求的优先级（grid滚动进可见区域时调用）
+        不在队列里的路径会被忽略
+        args
+            paths:[str] 图片路径列表
+        '''
+        for path in paths:
+            self.tinyimg_queue.boost(path, RequestScheduler.PRIORITY_URGENT)
+
+    def pinTinyImgs(self, paths):
+        '''
+        钉住可见区域（连同上下余量）的缩略图（二进制池），页面加入grid或滚动时调用
+        载入大目录时，后面的缩略图不会把可见的缩略图挤出缓存；滚出余量的缩略图取消钉住，缓存池仍受大小限制
+        args
+            paths:[str] 要钉住的图片路径列表（取代之前钉住的）
+        '''
+        self.tinyimg_pool.repin(paths)
+
+    def unpinTinyImgs(self):
+        '''
+        取消钉住所有缩略图，页面清空时调用
+        '''
+        self.tinyimg_pool.unpinAll()
 
     def close(self):
         '''
         程序关闭时的处理
-        向队列发送None请求，让线程退出
+        向队列发送None请求，让线程退出，并结束进程池（创建过的话）
         '''
-        self.img_queue.put([None,None])
-        self.tinyimg_queue.put([None,None])
+        self.img_queue.close()
+        self.tinyimg_queue.close()
+        with self.tinyimg_worker_lock:
+            self.closed = True
+            if self.tinyimg_worker_pool is not None:
+                self.tinyimg_worker_pool.terminate()
+                self.tinyimg_worker_pool = None
         # self.p_img.join()
         # self.p_tinyimg.join()
         
@@ -138,9 +313,7 @@ class ImgSystem(object):
         ret
             QPixmap 图片的数字格式
         '''
-        s = io.BytesIO(imgBytes)
-        img = Image.open(s).convert('RGBA') #Qt要求4通道
-        return img.toqpixmap()
+        return QPixmap.fromImage(decode_qimage(imgBytes))
 
 class ImgReadThread(QThread):
     def __init__(self, system):
@@ -148,27 +321,67 @@ class ImgReadThread(QThread):
         self.system = system #imgSystem，用来与mainWindow通信
         self.q = system.img_queue #线程队列
         self.pool = system.img_pool #缓存池
+        self.decoded_pool = system.img_decoded_pool #解码池（path->((int,int),OrderedDict(int->QImage))，即原图大小，长边->解码的图片）
+        self.max_sizes = system.mainWindow.global_args['img_decoded_sizes'] #每张图片最多缓存的大小种数
 
     def run(self):
         while True:
-            path,_ = self.q.get() #获取新请求
+            path,box = self.q.get() #获取新请求
             if path is None: #退出请求
                 break
-
-            if self.pool.has(path):
+            try:
+                self.load(path, box)
+            except Exception as e: #文件读不了或已损坏（可能只是预读的相邻图片），不影响之后的请求
+                self.pool.remove(path) #下次重新读文件
+                print(f"load img error({path}): {e!r}")
+                self.system.mainWindow.imgFailed.emit(path, repr(e))
                 continue
-            img_b = open(path, 'rb').read()
-            self.pool.add(path, img_b)
             self.system.mainWindow.imgReady.emit(path) #回调信号
 
+    def load(self, path, box):
+        '''
+        读取图片并解码成显示区域需要的大小，放入缓存池和解码池
+        args
+            path:str 图片路径
+            box:(int,int) 显示区域的宽高
+        '''
+        img_b = self.pool.get_or_none(path)
+        if img_b is None:
+            img_b = open(path, 'rb').read()
+            self.pool.put(path, img_b) #GUI线程也可能同时写入，用put
+        img = Image.open(io.BytesIO(img_b)) #只读了文件头，还没解码
+        img_wh = img.size
+        w,h = fit_size(img_wh, box)
+        decoded = self.decoded_pool.get_or_none(path)
+        if decoded is not None:
+            sizes = collections.OrderedDict(decoded[1]) #复制一份再修改，GUI线程可能正在读
+        else:
+            sizes = collections.OrderedDict()
+        if max(w,h) not in sizes:
+            # 在线程里解码成需要的大小，GUI线程就不用再解码和缩放大图
+            img.draft('RGB', (w,h))
+            sizes[max(w,h)] = ImageQt.ImageQt(img.convert('RGBA').resize((w,h))) #Qt要求4通道
+            while len(sizes) > self.max_sizes:
+                sizes.popitem(False)
+            self.decoded_pool.put(path, (img_wh,sizes))
+
 class TinyImgReadThread(QThread):
+    SYNC_REQUEST = 'sync' #同步目录请求的key为(SYNC_REQUEST,目录路径)
+
     def __init__(self, system):
         super().__init__()
         self.system = system #imgSystem，用来与mainWindow通信
         self.q = system.tinyimg_queue #线程队列
         self.pool = system.tinyimg_pool #缓存池
+        self.decoded_pool = system.tinyimg_decoded_pool #解码池
         self.img_extnames = system.img_extnames #图片后缀列表
         self.tinyimg_filedir = system.tinyimg_filedir #缩略图保存目录
+        self.tinyimg_size = system.mainWindow.global_args['tinyimg_size'] #缩略图大小
+        self.stores = collections.OrderedDict() #目录->TinyImgStore 已打开的缩略图仓库
+        self.stores_lock = threading.RLock() #仓库会被本线程和进程池的回调线程同时使用
+        self.max_open_stores = 16 #同时打开的仓库数上限
+        self.inflight = {} #path->[args] 正在进程池里生成的缩略图，以及等待它的请求参数
+        self.inflight_lock = threading.Lock() #inflight会被本线程和进程池的回调线程同时使用
 
     def run(self):
         try:
@@ -182,91 +395,562 @@ class TinyImgReadThread(QThread):
             path,args = self.q.get() #获取请求
             if path is None: #退出请求
                 break
+            if isinstance(path, tuple): #同步目录请求
+                self.sync_dir(path[1])
+                continue
 
-            if not self.pool.has(path):
-                dirpath = os.path.dirname(path)
-                pkl_dirpath = self.translate_path(dirpath) #计算缩略图所属目录的缓存文件的路径
-                if os.path.exists(pkl_dirpath): 
-                    #如果该目录缓存过，则加载该文件即可
-                    data = pickle.load(open(pkl_dirpath,'rb'))
-                    for img_path,img_b in data.items():
-                        self.pool.add(img_path,img_b)
-                else:
-                    #否则，需要读入该目录的所有图片，然后生成缩略图，再保存成文件
-                    names = os.listdir(dirpath)
-                    img_paths = []
-                    # 获取该目录的所有图片路径
-                    for name in names:
-                        img_path = os.path.join(dirpath,name)
-                        if os.path.isfile(img_path) and os.path.splitext(img_path)[1] in self.img_extnames:
-                            img_paths.append(img_path)
-                    imgs = {}
-                    for img_path in img_paths:
-                        img = Image.open(img_path).convert('RGB') #载入图片
-                        tinyimg,tinyimg_b = self.make_tinyimg(img) #生成缩略图
-                        self.pool.add(img_path, tinyimg_b) #缓存
-                        imgs[img_path] = tinyimg_b
-                    pickle.dump(imgs, open(pkl_dirpath,'wb')) #该目录的所有缩略图一并保存成文件
+            if path not in self.decoded_pool:
+                tinyimg_b = self.pool.get_or_none(path)
+                if tinyimg_b is None:
+                    try:
+                        with self.stores_lock:
+                            tinyimg_b = self.get_store(os.path.dirname(path)).get(path) #从缩略图所属目录的仓库读取
+                    except OSError as e: #目录读不了（如已被删除或没有权限），也要回应请求
+                        self.answer_failed(path, [args], e)
+                        continue
+                    if tinyimg_b is None:
+                        #仓库里没有，则交给进程池生成缩略图，生成完在回调里缓存和发信号
+                        with self.inflight_lock:
+                            if path in self.inflight: #已在生成中，合并请求，生成完一起发信号
+                                self.inflight[path].append(args)
+                                continue
+                            self.inflight[path] = [args]
+                        try:
+                            st = os.stat(path) #生成前记录原图状态，生成期间原图被修改的话下次同步会发现
+                        except OSError as e:
+                            self.on_tinyimg_error(path, e)
+                            continue
+                        worker_pool = self.system.get_tinyimg_worker_pool()
+                        if worker_pool is None: #已关闭，马上就会收到退出请求
+                            continue
+                        worker_pool.apply_async(make_tinyimg, (path, self.tinyimg_size),
+                                                     callback=functools.partial(self.on_tinyimg_made, path, (st.st_size,st.st_mtime_ns)),
+                                                     error_callback=functools.partial(self.on_tinyimg_error, path))
+                        continue
+                    self.pool.put(path, tinyimg_b) #缓存（回调线程可能同时写入，用put）
+                    self.system.tinyimg_stats['store'] += 1
+                self.decoded_pool.put(path, decode_qimage(tinyimg_b)) #在线程里解码
 
             self.system.mainWindow.tinyImgReady.emit(path, *args) #发送回调信号
 
+        with self.stores_lock:
+            for store in self.stores.values():
+                store.close()
+            self.stores.clear()
+
+    def on_tinyimg_made(self, path, stat, result):
+        '''
+        进程池生成完一张缩略图的回调（在进程池的回调线程执行）
+        先放入缓存池和解码池，再追加到仓库，最后向所有等待的请求发送回调信号
+        回调里的异常会让进程池的回调线程退出，之后所有结果都收不到，因此这里的错误都要接住
+        args
+            path:str 图片路径
+            stat:(int,int) 生成前原图的大小和修改时间
+            result:(bytes,str) 缩略图的二进制串和生成方式
+        '''
+        try:
+            tinyimg_b,tier = result
+            self.system.tinyimg_stats[tier] += 1
+            self.pool.put(path, tinyimg_b)
+            self.decoded_pool.put(path, decode_qimage(tinyimg_b))
+        except Exception as e:
+            self.on_tinyimg_error(path, e)
+            return
+        try:
+            with self.stores_lock:
+                self.get_store(os.path.dirname(path)).add(path, tinyimg_b, stat)
+        except Exception as e: #写不进仓库（如磁盘满）不影响这次显示，下次再生成
+            print(f"store tinyimg error({path}): {e!r}")
+        with self.inflight_lock:
+            waiting = self.inflight.pop(path, [])
+        for args in waiting:
+            self.system.mainWindow.tinyImgReady.emit(path, *args)
+
+    def on_tinyimg_error(self, path, e):
+        '''
+        进程池生成缩略图出错的回调（也在本线程读原图状态出错时调用）
+        所有等待该缩略图的请求都会收到失败信号
+        args
+            path:str 图片路径
+            e:Exception 错误
+        '''
+        with self.inflight_lock:
+            waiting = self.inflight.pop(path, [])
+        self.answer_failed(path, waiting, e)
+
+    def answer_failed(self, path, waiting, e):
+        '''
+        向等待的请求发送缩略图载入失败的信号，grid会显示占位图标，而不是一直等待
+        args
+            path:str 图片路径
+            waiting:[args] 等待的请求参数
+            e:Exception 错误
+        '''
+        print(f"make tinyimg error({path}): {e!r}")
+        for args in waiting:
+            self.system.mainWindow.tinyImgFailed.emit(path, *args)
+
+    def get_store(self, dirpath):
+        '''
+        获取目录对应的缩略图仓库（调用者需持有stores_lock）
+        打开的仓库会缓存起来，超过上限时关闭最久没用的仓库
+        新打开的仓库会先与目录同步一次（以前版本的目录缓存.pkl也在这时导入）
+        args
+            dirpath:str 目标目录
+        ret
+            TinyImgStore 该目录的缩略图仓库
+        '''
+        if dirpath in self.stores:
+            self.stores.move_to_end(dirpath)
+            return self.stores[dirpath]
+        if len(self.stores) == self.max_open_stores:
+            _,old_store = self.stores.popitem(False)
+            old_store.close()
+        store_path = self.translate_path(dirpath)
+        store = TinyImgStore(store_path)
+        try:
+            self._sync_store(store, dirpath, store_path+'.pkl')
+        except:
+            store.close()
+            raise
+        self.stores[dirpath] = store
+        return store
+
+    def sync_dir(self, dirpath):
+        '''
+        同步目录的缩略图仓库（处理同步目录请求）
+        args
+            dirpath:str 目录路径
+        '''
+        try:
+            with self.stores_lock:
+                is_open = dirpath in self.stores
+                store = self.get_store(dirpath)
+                if is_open: #新打开的仓库在get_store里已经同步过
+                    self._sync_store(store, dirpath)
+        except OSError as e: #目录读不了，该目录的缩略图请求会各自回应失败
+            print(f"sync tinyimg dir error({dirpath}): {e!r}")
+
+    def _sync_store(self, store, dirpath, legacy_path=None):
+        '''
+        用os.scandir获取目录里所有图片的大小和修改时间，与仓库对比
+        变化了的缩略图同时从缓存池中删除
+        args
+            store:TinyImgStore 目录的仓库
+            dirpath:str 目录路径
+            legacy_path:str 以前版本的目录缓存（存在时先导入再删除）
+        '''
+        entries = {}
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_file() and os.path.splitext(entry.name)[1] in self.img_extnames:
+                    st = entry.stat()
+                    entries[entry.path] = (st.st_size,st.st_mtime_ns)
+        if legacy_path is not None and os.path.exists(legacy_path):
+            self._import_legacy(store, legacy_path, entries)
+        for path in store.sync(entries):
+            self.pool.remove(path)
+            self.decoded_pool.remove(path)
+
+    def _import_legacy(self, store, legacy_path, entries):
+        '''
+        导入以前版本的目录缓存（整个目录的path->缩略图二进制串pickle成一个文件），导入后删除
+        旧缓存不记录原图状态，写入后也不再更新，因此只导入缓存写入之后原图没改过、且大小和现在的缩略图相同的
+        args
+            store:TinyImgStore 目录的仓库
+            legacy_path:str 旧缓存文件的路径
+            entries:dict(str->(int,int)) 目录里所有图片的路径->(大小,修改时间)
+        '''
+        try:
+            legacy_mtime = os.stat(legacy_path).st_mtime_ns
+            with open(legacy_path, 'rb') as f:
+                data = pickle.load(f)
+            for path,tinyimg_b in data.items():
+                stat = entries.get(path)
+                if stat is None or stat[1] > legacy_mtime or store.has(path):
+                    continue
+                if max(Image.open(io.BytesIO(tinyimg_b)).size) != self.tinyimg_size:
+                    continue
+                store.add(path, tinyimg_b, stat)
+        except Exception as e: #旧缓存损坏时丢弃，缩略图之后按需重新生成
+            print(f"import legacy tinyimg error({legacy_path}): {e!r}")
+        try:
+            os.remove(legacy_path)
+        except OSError as e:
+            print(f"remove legacy tinyimg error({legacy_path}): {e!r}")
+
     def translate_path(self, path):
         '''
-        计算目标目录对应的缓存文件保存路径
+        计算目标目录对应的缩略图仓库保存路径（不含后缀）
         规则是：
             1. 目录是缩略图缓存目录
-            2. 文件名是目标目录中将所有目录分割符换成'_'，然后在后缀前加上目录的md5的前10位
+            2. 文件名是目标目录中将所有目录分割符换成'_'，然后在最后加上目录的md5的前10位
         args
             path:str 目标目录
         ret
-            str 对应的缓存文件保存路径
+            str 对应的缩略图仓库保存路径（仓库会在后面加上.pack和.idx）
         '''
         path_md5 = md5(path.encode()).hexdigest()
         path = path.replace('\\','_').replace(':','')
-        return os.path.join(self.tinyimg_filedir, f"{path}_{path_md5[:10]}.pkl")
+        return os.path.join(self.tinyimg_filedir, f"{path}_{path_md5[:10]}")
+
+
+def decode_qimage(img_b):
+    '''
+    将图片从二进制格式解码成QImage（QImage可以在非GUI线程创建，QPixmap不行）
+    args
+        img_b:bytes 图片的二进制串
+    ret
+        QImage 解码后的图片
+    '''
+    img = Image.open(io.BytesIO(img_b)).convert('RGBA') #Qt要求4通道
+    return ImageQt.ImageQt(img)
+
+def fit_size(img_wh, box, step=256):
+    '''
+    计算图片放进显示区域时的解码大小
+    先按比例缩放到刚好放进显示区域（不放大），再把长边按step向上取整（不超过原图），
+    这样窗口大小稍微改变时还是同一种大小，可以复用
+    args
+        img_wh:(int,int) 原图的宽高
+        box:(int,int) 显示区域的宽高
+        step:int 长边取整的单位
+    ret
+        (int,int) 解码后的宽高
+    '''
+    w,h = img_wh
+    ratio = min(box[0]/w, box[1]/h, 1)
+    long = min(math.ceil(max(w,h)*ratio/step)*step, max(w,h))
+    ratio = long / max(w,h)
+    return max(round(w*ratio),1),max(round(h*ratio),1)
+
+def sizeof_qimage(qimg):
+    '''
+    计算QImage占用的字节数（解码池用）
+    args
+        qimg:QImage 图片
+    ret
+        int 字节数
+    '''
+    return qimg.sizeInBytes()
+
+def sizeof_scaled_imgs(entry):
+    '''
+    计算一张原图所有解码大小占用的字节数（原图解码池用）
+    args
+        entry:((int,int),dict(int->QImage)) 原图大小，长边->解码的图片
+    ret
+        int 字节数
+    '''
+    return sum(qimg.sizeInBytes() for qimg in entry[1].values())
+
+def make_tinyimg(path, max_hw):
+    '''
+    用原图生成缩略图（在进程池的worker里执行，因此是模块级函数）
+    依次尝试三种方式，前一种不可用时才用下一种：
+        1. exif：EXIF内嵌的预览图
+        2. draft：JPEG的DCT缩放解码
+        3. full：完整解码
+    args
+        path:str 原图路径
+        max_hw:int 缩略图的最大边长
+    ret
+        (bytes,str) 缩略图的二进制串和使用的方式
+    '''
+    for tier,func in tinyimg_tiers:
+        tinyimg_b = func(path, max_hw)
+        if tinyimg_b is not None:
+            return tinyimg_b,tier
+    assert False, f'no tinyimg tier works for {path}'
+
+def tinyimg_from_exif(path, max_hw):
+    '''
+    用EXIF内嵌的预览图生成缩略图
+    args
+        path:str 原图路径
+        max_hw:int 缩略图的最大边长
+    ret
+        bytes|None 缩略图的二进制串，不是JPEG/TIFF、没有预览图、预览图太小或EXIF/预览图损坏时返回None
+    '''
+    if os.path.splitext(path)[1].lower() not in exif_extnames:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            # 只要预览图：不解析MakerNote等细节，读到预览图长度后不再读预览图IFD余下的标签
+            tags = exifread.process_file(f, details=False, stop_tag='JPEGInterchangeFormatLength')
+        if 'JPEGThumbnail' not in tags:
+            return None
+        img = Image.open(io.BytesIO(tags['JPEGThumbnail']))
+        if max(img.size) < max_hw:
+            return None
+        return encode_tinyimg(img.convert('RGB'), max_hw)
+    except Exception: #EXIF损坏不影响原图本身，交给后面的方式处理
+        return None
+
+def tinyimg_from_draft(path, max_hw):
+    '''
+    用JPEG的DCT缩放解码（1/2,1/4,1/8）生成缩略图，解码出的大小不小于缩略图大小
+    args
+        path:str 原图路径
+        max_hw:int 缩略图的最大边长
+    ret
+        bytes|None 缩略图的二进制串，不是JPEG时返回None
+    '''
+    img = Image.open(path)
+    if img.format != 'JPEG':
+        return None
+    img.draft('RGB', (max_hw,max_hw))
+    return encode_tinyimg(img.convert('RGB'), max_hw)
+
+def tinyimg_from_full(path, max_hw):
+    '''
+    完整解码原图生成缩略图
+    args
+        path:str 原图路径
+        max_hw:int 缩略图的最大边长
+    ret
+        bytes 缩略图的二进制串
+    '''
+    img = Image.open(path).convert('RGB')
+    return encode_tinyimg(img, max_hw)
 
-    def make_tinyimg(self, img):
+def encode_tinyimg(img, max_hw):
+    '''
+    缩放并编码缩略图
+    args
+        img:PIL.Image 解码后的图片
+        max_hw:int 缩略图的最大边长
+    ret
+        bytes 缩略图的二进制串
+    '''
+    w,h = img.size
+    ratio = max(w,h) / max_hw
+    w2,h2 = round(w/ratio),round(h/ratio)
+    tinyimg = img.resize((w2,h2))
+    s = io.BytesIO()
+    tinyimg.save(s,'jpeg')
+    return s.getvalue()
+
+# 尝试EXIF预览图的扩展名（其它格式很少带预览图，解析EXIF是白费）
+exif_extnames = {'.jpg', '.jpeg', '.tif', '.tiff'}
+
+# 缩略图的生成方式，按尝试顺序排列
+tinyimg_tiers = [
+    ('exif', tinyimg_from_exif),
+    ('draft', tinyimg_from_draft),
+    ('full', tinyimg_from_full),
+]
+
+
+class RequestScheduler(object):
+    '''
+    线程的请求队列
+    1. 按优先级取出请求（数字越小越优先），同优先级先进先出
+    2. 每个请求带有代数，取出时比当前代数旧的请求直接丢弃
+    3. 同一个key只保留一个请求，重复请求时取更高的优先级和更新的参数
+    关闭后get返回(None,None)，作为线程的退出请求
+    '''
+    PRIORITY_SYNC = -1 #同步目录（要先于该目录的缩略图处理）
+    PRIORITY_URGENT = 0 #加急（要显示的原图，可见的缩略图）
+    PRIORITY_NORMAL = 10 #普通（不可见的缩略图）
+
+    def __init__(self):
+        self.heap = [] #[priority,seq,key,args,generation] 堆，key为None的项已作废
+        self.key2entry = {} #key->[priority,seq,key,args,generation] 每个key当前有效的请求
+        self.seq = 0 #请求序号，保证同优先级先进先出
+        self.generation = 0 #当前代数
+        self.dropped = 0 #被丢弃的过期请求数
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, key, args, priority, generation=0):
         '''
-        用原图生成缩略图
-        两个步骤：
-            1. 缩放 
-            2. 生成二进制串
+        加入请求
         args
-            img: PIL.Image 原图图片
+            key:str 请求的key（图片路径）
+            args:object 请求附带的参数
+            priority:int 优先级
+            generation:int 请求的代数
+        '''
+        with self.cond:
+            if key in self.key2entry:
+                old_entry = self.key2entry[key]
+                priority = min(priority, old_entry[0])
+                old_entry[2] = None #作废旧项
+            self._push(key, args, priority, generation)
+            self.cond.notify()
+
+    def boost(self, key, priority):
+        '''
+        提升已有请求的优先级
+        args
+            key:str 请求的key
+            priority:int 新的优先级（不比原来高时不处理）
+        '''
+        with self.cond:
+            if key not in self.key2entry:
+                return
+            old_entry = self.key2entry[key]
+            if old_entry[0] <= priority:
+                return
+            old_entry[2] = None
+            self._push(key, old_entry[3], priority, old_entry[4])
+
+    def _push(self, key, args, priority, generation):
+        '''
+        入堆（调用者需持有cond）
+        '''
+        entry = [priority,self.seq,key,args,generation]
+        self.seq += 1
+        self.key2entry[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def setGeneration(self, generation):
+        '''
+        设置当前代数，之前的请求都作废
+        args
+            generation:int 新的代数
+        '''
+        with self.cond:
+            self.generation = generation
+
+    def get(self):
+        '''
+        取出优先级最高的有效请求（没有请求时阻塞）
         ret
-            (PIL.Image,bytes) 缩略图图片和对应的二进制串
+            (key,args) 请求的key和参数，队列关闭时返回(None,None)
         '''
-        max_hw = self.system.mainWindow.global_args['tinyimg_size']
-        w,h = img.size
-        ratio = max(w,h) / max_hw
-        w2,h2 = round(w/ratio),round(h/ratio)
-        tinyimg = img.resize((w2,h2))
-        s = io.BytesIO()
-        tinyimg.save(s,'jpeg')
-        s.seek(0)
-        tinyimg_b = s.read()
-        return tinyimg,tinyimg_b
+        with self.cond:
+            while True:
+                while len(self.heap) == 0 and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return None,None
+                _,_,key,args,generation = heapq.heappop(self.heap)
+                if key is None: #已作废
+                    continue
+                self.key2entry.pop(key)
+                if generation < self.generation: #过期
+                    self.dropped += 1
+                    continue
+                return key,args
+
+    def close(self):
+        '''
+        关闭队列，让等待的线程退出
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
 
 
 class CachedPool(object):
-    def __init__(self, pool_size):
+    '''
+    LRU缓存池
+    有两种限制大小的模式：
+        1. 按项数：最多缓存pool_size项
+        2. 按字节数：pool_bytes大于0时，所有项的总字节数不超过pool_bytes（至少保留最新的一项）
+    被钉住（pin）的项不会被淘汰，用于保证当前页面的缩略图不被同一批载入的其他缩略图挤掉
+    钉住的项放在pinned_k2v里，不参与LRU排序，淘汰时只看k2v，每次淘汰都是O(1)
+    has()会记录命中/未命中次数，线程内部的判断用in，不计入统计
+    '''
+    def __init__(self, pool_size, pool_bytes=0, sizeof=len):
         self.pool_size = pool_size #缓存池大小
-        self.k2v = collections.OrderedDict() #核心数据结构，Ordered用于保证先进先出
+        self.pool_bytes = pool_bytes #缓存池的字节数上限（0表示按项数限制）
+        self.sizeof = sizeof #func 计算一项的字节数
+        self.k2v = collections.OrderedDict() #核心数据结构（没被钉住的项），Ordered用于保证先进先出
+        self.pinned_k2v = {} #被钉住的项
+        self.k2size = {} #k->int 每一项的字节数
+        self.pinned = set() #被钉住、不会被淘汰的key（可以还没有缓存）
         self.lock = threading.Lock() #互斥锁，保证线程安全
 
+        # 统计信息
+        self.hits = 0 #命中次数
+        self.misses = 0 #未命中次数
+        self.evictions = 0 #淘汰次数
+        self.resident_bytes = 0 #当前总字节数
+
     def add(self, k, v):
         '''
         增加操作
+        超过限制时，淘汰最久没用的项，直到满足限制
         args
             k:str 图片路径
             v:bytes 图片二进制串
         '''
-        assert k not in self.k2v, f'multi add the same key:{k}'
+        assert k not in self, f'multi add the same key:{k}'
+        size = self.sizeof(v)
         self.lock.acquire()
-        if len(self.k2v) == self.pool_size:
-            self.k2v.popitem(False)
-        self.k2v[k] = v
+        self._add(k, v, size)
         self.lock.release()
+
+    def put(self, k, v):
+        '''
+        增加操作（已存在时替换，用于多个线程可能同时写入的解码池）
+        args
+            k:str 图片路径
+            v:object 缓存的值
+        '''
+        size = self.sizeof(v)
+        self.lock.acquire()
+        self._pop(k)
+        self._add(k, v, size)
+        self.lock.release()
+
+    def _add(self, k, v, size):
+        '''
+        增加一项并淘汰超出限制的项（调用者需持有lock）
+        args
+            k:str 图片路径
+            v:object 缓存的值
+            size:int 该项的字节数
+        '''
+        if k in self.pinned:
+            self.pinned_k2v[k] = v
+        else:
+            self.k2v[k] = v
+        self.k2size[k] = size
+        self.resident_bytes += size
+        self._evict(k)
+
+    def _evict(self, keep=None):
+        '''
+        淘汰最久没用的没被钉住的项，直到满足限制（调用者需持有lock）
+        args
+            keep:str 不淘汰的项（刚加入的项）
+        '''
+        while self._is_over() and len(self.k2v) > 0:
+            old_k = next(iter(self.k2v))
+            if old_k == keep: #只剩刚加入的项可以淘汰时，保留它
+                if len(self.k2v) == 1:
+                    break
+                self.k2v.move_to_end(old_k)
+                continue
+            self.k2v.pop(old_k)
+            self.resident_bytes -= self.k2size.pop(old_k)
+            self.evictions += 1
+
+    def _pop(self, k):
+        '''
+        删除一项（不存在时忽略，调用者需持有lock）
+        '''
+        if k in self.k2v:
+            self.k2v.pop(k)
+        elif k in self.pinned_k2v:
+            self.pinned_k2v.pop(k)
+        else:
+            return
+        self.resident_bytes -= self.k2size.pop(k)
+
+    def _is_over(self):
+        '''
+        判断是否超过限制
+        ret
+            bool 是否超过
+        '''
+        if self.pool_bytes > 0:
+            return self.resident_bytes > self.pool_bytes
+        return len(self.k2v) + len(self.pinned_k2v) > self.pool_size
     
     def get(self, k):
         '''
@@ -276,19 +960,275 @@ class CachedPool(object):
         ret
             v:bytes 图片二进制串
         '''
-        assert k in self.k2v, f'no this key to get:{k}'
+        v = self.get_or_none(k)
+        assert v is not None, f'no this key to get:{k}'
+        return v
+
+    def get_or_none(self, k, count=False):
+        '''
+        获取操作（不存在时返回None）
+        判断和获取在同一次加锁里完成，不会出现判断时还在、获取时已被其他线程淘汰的情况
+        args
+            k:str 图片路径
+            count:bool 是否计入命中/未命中统计
+        ret
+            v:bytes|None 图片二进制串
+        '''
         self.lock.acquire()
-        v = self.k2v[k]
-        self.k2v.move_to_end(k)
+        if k in self.k2v:
+            v = self.k2v[k]
+            self.k2v.move_to_end(k)
+        else:
+            v = self.pinned_k2v.get(k)
         self.lock.release()
+        if count:
+            if v is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
         return v
 
     def has(self, k):
         '''
-        判断是否已缓存
+        判断是否已缓存（计入命中/未命中统计）
         args
             k:str 图片路径
         ret
             bool 是否已缓存
         '''
-        return k in self.k2v
+        ret = k in self
+        if ret:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return ret
+
+    def __contains__(self, k):
+        '''
+        判断是否已缓存（不计入统计）
+        '''
+        return k in self.k2v or k in self.pinned_k2v
+
+    def stats(self):
+        '''
+        获取统计信息
+        ret
+            dict 命中，未命中，淘汰次数，项数，总字节数
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.k2v) + len(self.pinned_k2v),
+            'resident_bytes': self.resident_bytes,
+            'pinned': len(self.pinned),
+        }
+
+    def repin(self, keys):
+        '''
+        把钉住的项换成keys（耗时只和新旧钉住的项数有关）
+        不再钉住的项回到LRU的队尾（最近使用），再淘汰超出限制的项
+        钉住的项可以还没有缓存，之后加入时同样不会被淘汰
+        args
+            keys:[str] 图片路径列表
+        '''
+        keys = set(keys)
+        self.lock.acquire()
+        for k in self.pinned - keys:
+            if k in self.pinned_k2v:
+                self.k2v[k] = self.pinned_k2v.pop(k)
+        for k in keys - self.pinned:
+            if k in self.k2v:
+                self.pinned_k2v[k] = self.k2v.pop(k)
+        self.pinned = keys
+        self._evict()
+        self.lock.release()
+
+    def unpinAll(self):
+        '''
+        取消所有钉住的项，它们回到LRU的队尾（最近使用），再淘汰超出限制的项
+        '''
+        self.lock.acquire()
+        self.k2v.update(self.pinned_k2v)
+        self.pinned_k2v = {}
+        self.pinned = set()
+        self._evict()
+        self.lock.release()
+
+    def remove(self, k):
+        '''
+        删除操作（不存在时忽略）
+        args
+            k:str 图片路径
+        '''
+        self.lock.acquire()
+        self._pop(k)
+        self.lock.release()
+
+
+class TinyImgStore(object):
+    '''
+    缩略图仓库，一个目录对应一个仓库，由两个文件组成：
+        1. pack文件：所有缩略图的二进制串首尾相接，只追加不改写
+        2. idx文件：文件头之后每条记录是(偏移,长度,原图大小,原图修改时间,路径长度)+路径，同样只追加
+           同一路径以最后一条记录为准，长度为0的记录表示该缩略图已删除
+    打开仓库时只读入索引，读取缩略图时用mmap映射pack文件，只取出需要的那一段
+    被覆盖和删除的数据超过一半时，打开仓库时会重写（压缩）两个文件
+    '''
+    IDX_MAGIC = b'JFVTIDX2' #索引文件的文件头（格式版本）
+    IDX_RECORD = struct.Struct('<QIQqH') #索引记录：偏移，长度，原图大小，原图修改时间（ns），路径（utf-8）长度
+    COMPACT_MIN_BYTES = 1<<20 #废弃数据至少这么多才压缩
+
+    def __init__(self, filepath):
+        self.pack_path = filepath + '.pack' #缩略图数据文件
+        self.idx_path = filepath + '.idx' #索引文件
+        self.index = {} #path->(int,int,(int,int)) 缩略图在pack文件里的偏移和长度，以及原图的大小和修改时间
+        self.dead_bytes = 0 #pack文件里被覆盖或删除的数据量
+        self.lock = threading.Lock() #互斥锁，保证线程安全
+
+        self._load_index()
+        live_bytes = sum(length for _,length,_ in self.index.values())
+        if self.dead_bytes > max(live_bytes, self.COMPACT_MIN_BYTES):
+            self._compact()
+        self.pack_file = open(self.pack_path, 'ab') #追加写入
+        self.idx_file = open(self.idx_path, 'ab')
+        self.read_file = open(self.pack_path, 'rb') #mmap用的只读文件
+        self.mm = None #pack文件的映射（空文件不能映射，因此延迟创建）
+
+    def _load_index(self):
+        '''
+        读入索引文件
+        索引文件不存在或格式不对时，丢弃旧仓库重新开始
+        末尾不完整的记录（写入时崩溃）会被截掉
+        '''
+        data = b''
+        if os.path.exists(self.idx_path):
+            data = open(self.idx_path, 'rb').read()
+        if data[:len(self.IDX_MAGIC)] != self.IDX_MAGIC:
+            open(self.pack_path, 'wb').close()
+            open(self.idx_path, 'wb').write(self.IDX_MAGIC)
+            return
+
+        pack_size = os.path.getsize(self.pack_path) if os.path.exists(self.pack_path) else 0
+        pos = len(self.IDX_MAGIC)
+        rec_size = self.IDX_RECORD.size
+        while pos + rec_size <= len(data):
+            offset,length,size,mtime,path_len = self.IDX_RECORD.unpack_from(data, pos)
+            if pos + rec_size + path_len > len(data) or offset + length > pack_size:
+                break
+            path = data[pos+rec_size:pos+rec_size+path_len].decode('utf-8')
+            if path in self.index:
+                self.dead_bytes += self.index.pop(path)[1]
+            if length > 0:
+                self.index[path] = (offset,length,(size,mtime))
+            pos += rec_size + path_len
+        if pos != len(data):
+            with open(self.idx_path, 'r+b') as f:
+                f.truncate(pos)
+
+    def _compact(self):
+        '''
+        压缩仓库：只把有效的缩略图重新写成新的pack和idx文件，再替换旧文件
+        '''
+        index = {}
+        with open(self.pack_path, 'rb') as f_old, \
+             open(self.pack_path+'.tmp', 'wb') as f_pack, \
+             open(self.idx_path+'.tmp', 'wb') as f_idx:
+            f_idx.write(self.IDX_MAGIC)
+            for path,(offset,length,stat) in self.index.items():
+                f_old.seek(offset)
+                new_offset = f_pack.tell()
+                f_pack.write(f_old.read(length))
+                path_b = path.encode('utf-8')
+                f_idx.write(self.IDX_RECORD.pack(new_offset, length, *stat, len(path_b)) + path_b)
+                index[path] = (new_offset,length,stat)
+        os.replace(self.pack_path+'.tmp', self.pack_path)
+        os.replace(self.idx_path+'.tmp', self.idx_path)
+        self.index = index
+        self.dead_bytes = 0
+
+    def _append_record(self, path, offset, length, stat):
+        '''
+        追加一条索引记录（调用者需持有lock）
+        args
+            path:str 图片路径
+            offset,length:int 缩略图在pack文件里的偏移和长度（长度为0表示删除）
+            stat:(int,int) 原图的大小和修改时间
+        '''
+        path_b = path.encode('utf-8')
+        self.idx_file.write(self.IDX_RECORD.pack(offset, length, *stat, len(path_b)) + path_b)
+        self.idx_file.flush()
+        if path in self.index:
+            self.dead_bytes += self.index.pop(path)[1]
+        if length > 0:
+            self.index[path] = (offset,length,stat)
+
+    def has(self, path):
+        '''
+        判断仓库里是否有该缩略图
+        args
+            path:str 图片路径
+        ret
+            bool 是否存在
+        '''
+        return path in self.index
+
+    def get(self, path):
+        '''
+        读取缩略图
+        args
+            path:str 图片路径
+        ret
+            bytes|None 缩略图的二进制串，没有则返回None
+        '''
+        with self.lock:
+            if path not in self.index:
+                return None
+            offset,length,_ = self.index[path]
+            if self.mm is None or offset + length > len(self.mm):
+                # pack文件追加过，需要重新映射
+                if self.mm is not None:
+                    self.mm.close()
+                self.mm = mmap.mmap(self.read_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mm[offset:offset+length]
+
+    def add(self, path, tinyimg_b, stat):
+        '''
+        追加缩略图（已有的会被覆盖，旧数据留在pack文件里）
+        args
+            path:str 图片路径
+            tinyimg_b:bytes 缩略图的二进制串
+            stat:(int,int) 生成缩略图时原图的大小和修改时间
+        '''
+        with self.lock:
+            offset = self.pack_file.seek(0, os.SEEK_END)
+            self.pack_file.write(tinyimg_b)
+            self.pack_file.flush()
+            self._append_record(path, offset, len(tinyimg_b), stat)
+
+    def sync(self, entries):
+        '''
+        与目录的实际状态对比，删除原图已删除或已变化的缩略图
+        目录里新增的图片不需要处理，请求时会生成
+        args
+            entries:dict(str->(int,int)) 目录里所有图片的路径->(大小,修改时间)
+        ret
+            [str] 被删除的缩略图的路径
+        '''
+        with self.lock:
+            stale_paths = [path for path,(_,_,stat) in self.index.items() if entries.get(path) != stat]
+            for path in stale_paths:
+                self._append_record(path, 0, 0, (0,0))
+        return stale_paths
+
+    def close(self):
+        '''
+        关闭仓库的所有文件
+        '''
+        with self.lock:
+            if self.mm is not None:
+                self.mm.close()
+                self.mm = None
+            self.pack_file.close()
+            self.idx_file.close()
+            self.read_file.close()
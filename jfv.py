@@ -20,7 +20,10 @@ class JFV(object):
         '''
         关闭线程，保存数据
         '''
+        self.gui.cancelFilter(wait=True)
         self.gui.tag_system.auto_save()
+        self.gui.tag_system.close()
+        self.gui.catalog_system.save()
         self.gui.img_system.close()
         self.gui.fastFuncWidget.saveData()
 
@@ -0,0 +1,208 @@
+import os
+import re
+import time
+import zlib
+import pickle
+import hashlib
+
+'''
+TagSnapshot模块可独立于Qt/GUI使用
+
+该模块负责标签数据的自动保存（TagSystem.auto_save，每次退出程序时调用），代替每次整个另存一份tag_{time}.pkl：
+    1. 图片按路径的crc32分到snapshot_buckets个桶里，每个桶和元标签数据各自pickle成一个块
+    2. 块按内容的sha1命名，zlib压缩后保存在chunks目录里（按sha1前两位分子目录），内容相同的块只存一份
+       两次自动保存之间通常只改了少数图片，大部分桶没变化，不会重复保存
+    3. 每次自动保存写一个清单文件{time_str}.snap，记录元标签块和每个桶的块
+    4. 保留策略：保留最新的keep个自动保存，以及最近keep_days天里每天最后一个自动保存，其余的清单删除，
+       再删除没有清单引用的块
+    5. load可以从任何保留的清单还原出完整的标签数据
+    6. 和最新的自动保存内容完全相同时不写新的清单（TagSystem在数据没修改过时连计算块都跳过）
+    7. 以前版本的自动保存（标签目录里的tag_{time_str}.pkl）在第一次自动保存时导入成清单，导入后删除
+
+目录结构：
+    snapshot_dir
+    |-{time_str}.snap 清单：{'meta':sha1, 'buckets':[sha1]}
+    |-chunks
+      |-{sha1[:2]}
+        |-{sha1}.z 压缩的块
+'''
+
+snapshot_buckets = 256 #图片分桶数
+legacy_name_re = re.compile(r'tag_\d{4}(?:_\d{2}){5}\.pkl') #以前版本的自动保存的文件名
+
+class TagSnapshotStore(object):
+    def __init__(self, snapshot_dir, keep, keep_days):
+        self.snapshot_dir = snapshot_dir #自动保存的目录
+        self.chunk_dir = os.path.join(snapshot_dir,'chunks') #块目录
+        self.keep = keep #保留最新的多少个自动保存
+        self.keep_days = keep_days #最近多少天里每天保留最后一个自动保存
+
+    def save(self, data, time_str):
+        '''
+        自动保存标签数据，然后按保留策略清理
+        args
+            data:list 标签数据[meta_tag_cnt,meta_tag_tree,meta_kvtag_list,meta_tag2name,tag_dict]
+            time_str:str 时间串（%Y_%m_%d_%H_%M_%S，作为清单名字）
+        ret
+            bool 是否写了新的清单（和最新的自动保存相同时不写）
+        '''
+        manifest = self._put_data(data)
+        names = self.names()
+        if len(names) > 0 and self._read_manifest(names[-1]) == manifest:
+            return False
+        self._write_manifest(time_str, manifest)
+        self._prune()
+        return True
+
+    def import_legacy(self, legacy_dir):
+        '''
+        把以前版本的自动保存（legacy_dir里的tag_{time_str}.pkl）导入成清单，导入后删除，再按保留策略清理
+        先对以前版本的和已有的自动保存一起应用保留策略，只导入会被保留的，其余的直接删除（不用读）
+        读不了的文件改名成.pkl.bad，不再重复尝试
+        args
+            legacy_dir:str 以前版本保存自动保存的目录（标签目录）
+        '''
+        if not os.path.exists(legacy_dir):
+            return
+        names = [name[4:-4] for name in os.listdir(legacy_dir) if legacy_name_re.fullmatch(name)]
+        if len(names) == 0:
+            return
+        keep_names = self._keep_names(sorted(set(names) | set(self.names())))
+        for name in sorted(names):
+            filepath = os.path.join(legacy_dir,f'tag_{name}.pkl')
+            if name not in keep_names:
+                os.remove(filepath)
+                continue
+            try:
+                data = pickle.load(open(filepath,'rb'))
+            except Exception as e:
+                print(f"import legacy snapshot error({filepath}): {e!r}")
+                os.replace(filepath, filepath + '.bad')
+                continue
+            self._write_manifest(name, self._put_data(data))
+            os.remove(filepath)
+        self._prune()
+
+    def _put_data(self, data):
+        '''
+        把标签数据分桶保存成块
+        args
+            data:list 标签数据
+        ret
+            dict 清单{'meta':sha1, 'buckets':[sha1]}
+        '''
+        buckets = [[] for _ in range(snapshot_buckets)]
+        for path,tagDict in data[4].items():
+            buckets[zlib.crc32(path.encode('utf-8')) % snapshot_buckets].append((path, tuple(sorted(tagDict.items()))))
+        return {
+            'meta':self._put_chunk(list(data[:4])),
+            'buckets':[self._put_chunk(sorted(bucket)) for bucket in buckets],
+        }
+
+    def _write_manifest(self, name, manifest):
+        write_file(os.path.join(self.snapshot_dir,f'{name}.snap'), pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL))
+
+    def names(self):
+        '''
+        列出保留的自动保存
+        ret
+            [str] 自动保存的名字（时间串），从旧到新
+        '''
+        if not os.path.exists(self.snapshot_dir):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.snapshot_dir) if name.endswith('.snap'))
+
+    def load(self, name):
+        '''
+        还原一个自动保存的标签数据
+        args
+            name:str 自动保存的名字
+        ret
+            list 标签数据（tag_dict为dict）
+        '''
+        manifest = self._read_manifest(name)
+        data = self._get_chunk(manifest['meta'])
+        tag_dict = {}
+        for sha1 in manifest['buckets']:
+            for path,items in self._get_chunk(sha1):
+                tag_dict[path] = dict(items)
+        return data + [tag_dict]
+
+    def _put_chunk(self, obj):
+        '''
+        保存一个块（内容相同的块已存在则跳过）
+        args
+            obj:object 块的内容
+        ret
+            str 块的sha1
+        '''
+        raw = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        sha1 = hashlib.sha1(raw).hexdigest()
+        filepath = self._chunk_path(sha1)
+        if not os.path.exists(filepath):
+            write_file(filepath, zlib.compress(raw))
+        return sha1
+
+    def _get_chunk(self, sha1):
+        return pickle.loads(zlib.decompress(open(self._chunk_path(sha1),'rb').read()))
+
+    def _chunk_path(self, sha1):
+        return os.path.join(self.chunk_dir, sha1[:2], f'{sha1}.z')
+
+    def _read_manifest(self, name):
+        filepath = os.path.join(self.snapshot_dir,f'{name}.snap')
+        assert os.path.exists(filepath), f'snapshot({name}) not found'
+        return pickle.load(open(filepath,'rb'))
+
+    def _keep_names(self, names):
+        '''
+        按保留策略选出要保留的自动保存
+        args
+            names:[str] 自动保存的名字，从旧到新
+        ret
+            set(str) 要保留的名字
+        '''
+        keep_names = set(names[-self.keep:]) if self.keep > 0 else set()
+        min_day = time.strftime('%Y_%m_%d', time.localtime(time.time() - self.keep_days * 86400))
+        last_of_day = {}
+        for name in names: #从旧到新，最后留下的就是当天最后一个
+            last_of_day[name[:10]] = name
+        keep_names |= {name for day,name in last_of_day.items() if day >= min_day}
+        return keep_names
+
+    def _prune(self):
+        '''
+        按保留策略删除清单，再删除没有被引用的块
+        '''
+        names = self.names()
+        keep_names = self._keep_names(names)
+        removed = False
+        for name in names:
+            if name not in keep_names:
+                os.remove(os.path.join(self.snapshot_dir,f'{name}.snap'))
+                removed = True
+        if not removed:
+            return
+
+        used = set()
+        for name in keep_names:
+            manifest = self._read_manifest(name)
+            used.add(manifest['meta'])
+            used.update(manifest['buckets'])
+        for sub_dir in os.listdir(self.chunk_dir):
+            for file in os.listdir(os.path.join(self.chunk_dir, sub_dir)):
+                if file[:-2] not in used:
+                    os.remove(os.path.join(self.chunk_dir, sub_dir, file))
+
+def write_file(filepath, content):
+    '''
+    写文件（先写临时文件再替换，写到一半中断不会留下损坏的文件）
+    args
+        filepath:str 文件路径
+        content:bytes 文件内容
+    '''
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_path = filepath + '.tmp'
+    with open(tmp_path,'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, filepath)
@@ -0,0 +1,943 @@
+import os
+import re
+import copy
+import mmap
+import array
+import time
+import zlib
+import pickle
+import struct
+import sqlite3
+import operator
+import itertools
+import threading
+import collections.abc
+
+'''
+TagStorage模块可独立于Qt/GUI使用
+
+该模块负责TagSystem的标签文件，有两种储存方式（global.yml的tag_storage）：
+    1. pickle：标签数据保存在快照tag.pkl和日志tag.journal里，启动时整个读入内存
+       1. 每次修改往日志里追加一条记录（图片的新标签集或整份元标签数据），按记录数或时间批量fsync
+       2. save只追加一个保存记录并fsync，耗时只和修改量有关；日志大了才在后台线程把数据写成新快照
+       3. load读快照后重放日志；启动时连最后一个保存记录之后的记录也重放（上次崩溃或没保存时的修改）
+       4. 程序正常关闭时截掉未保存的记录（退出前auto_save已经自动保存了一份，见tag_snapshot.py）
+    2. sqlite：标签数据保存在tag.db的表里
+       1. 图片的标签按(路径,标签码)一行，修改标签时只改该图片的行，需要时再按路径查询，不整个读入内存
+       2. 修改在一个事务里进行，save时提交，reset时回滚（和pickle一样，不保存就不会写进文件）
+       3. 元标签数据很小，读入内存使用，save时整个重写元标签的表
+       4. tag.db不存在而tag.pkl存在时，第一次启动会把tag.pkl的数据导入tag.db
+       5. 标签筛选的倒排索引也是对表的查询（index），按(标签码,值)建了索引，每次筛选只查询用到的标签
+          （多进程筛选时进程里仍是整份标签数据的快照，见TagSystem）
+
+    3. mmap：同pickle，但快照是内存映射的文件（MmapTagFile），启动时只读文件头和元标签数据，耗时和图片数无关
+       1. tag_dict是MmapTagDict，图片的标签集第一次访问（getTag或筛选）时才从文件里解析
+       2. 日志重放和之后的修改都记在MmapTagDict的overlay里，合并时把文件和overlay一起写成下一代文件
+       3. 快照文件不存在而tag.pkl存在时，第一次启动会把tag.pkl的数据导入
+
+三种储存方式的接口相同：
+    load(recover) -> [meta_tag_cnt,meta_tag_tree,meta_kvtag_list,meta_tag2name,tag_dict]，文件不存在时返回None
+    save(data) 保存数据（结构同load的返回值）
+    log_tag(path, tagDict)、log_tags(items)、log_meta(meta) 记录修改
+    close() 程序关闭时的处理
+    recovered load时是否恢复了未保存的修改
+sqlite方式下tag_dict是SqliteTagDict（和dict用法相同），对它的修改会直接写进数据库
+'''
+
+# sqlite表结构
+sqlite_schema = [
+    'CREATE TABLE IF NOT EXISTS tags(path TEXT NOT NULL, tag INTEGER NOT NULL, value, PRIMARY KEY(path,tag)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS meta_tags(tag INTEGER PRIMARY KEY, name TEXT NOT NULL, father INTEGER, pos INTEGER NOT NULL, is_kv INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value)',
+    'CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag, value)', #筛选时按标签码和值查询
+]
+sqlite_page_size = 10000 #按路径顺序扫描时每次查询的行数
+journal_sync_records = 256 #日志每追加多少条记录fsync一次
+journal_sync_interval = 1.0 #日志距离上次fsync多少秒后，追加记录时fsync
+journal_compact_size = 4 * 1024 * 1024 #日志超过多少字节（且超过快照的1/4）时，保存后在后台合并进快照
+mmap_magic = b'JFVTAG1\0' #MmapTagFile的魔数
+mmap_header_fmt = '=8sQQQQ' #MmapTagFile的文件头
+mmap_name_re = re.compile(r'tag\.\d+\.mmap') #MmapTagFile的文件名
+mmap_bisect_lookups = 1000 #MmapTagFile二分查找多少次后把所有路径读进dict
+
+class PickleTagStorage(object):
+    def __init__(self, tag_filedir):
+        self.tag_filedir = tag_filedir #保存标签文件的目录
+        self.snapshot_path = os.path.join(tag_filedir,'tag.pkl') #快照
+        self.journal_path = os.path.join(tag_filedir,'tag.journal') #日志
+        self.old_journal_path = os.path.join(tag_filedir,'tag.journal.old') #正在合并进快照的日志
+
+        self.journal = None #日志文件（第一次追加记录时打开）
+        self.journal_end = 0 #日志有效部分的末尾（下一条记录写在这里）
+        self.saved_end = 0 #最后一个保存记录的末尾
+        self.snapshot_size = 0 #快照的大小（决定何时合并）
+        self.unsynced = 0 #还没fsync的记录数
+        self.last_sync = time.time() #上次fsync的时间
+        self.compact_thread = None #后台合并线程
+        self.recovered = False #load时是否恢复了上次未保存的修改
+
+    def load(self, recover=False):
+        '''
+        读取快照，再重放日志
+        args
+            recover:bool 是否重放最后一个保存记录之后的记录（上次没保存就退出或崩溃时留下的修改）
+        ret
+            list 标签数据，文件不存在时返回None
+        '''
+        self._wait_compact()
+        self._close_journal()
+        if not self._has_snapshot():
+            return None
+        data = self._read_snapshot()
+        for rec,_ in read_journal(self.old_journal_path): #合并中断时，该日志的记录都已保存
+            apply_record(data, rec)
+
+        recs = read_journal(self.journal_path)
+        saved_ix = max([i+1 for i,(rec,_) in enumerate(recs) if rec[0] == 'save'], default=0)
+        self.saved_end = recs[saved_ix-1][1] if saved_ix > 0 else 0
+        if recover:
+            self.recovered = len(recs) > saved_ix
+            self.journal_end = recs[-1][1] if len(recs) > 0 else 0
+        else: #马上截掉未保存的记录，否则之后崩溃的话，下次启动恢复时会把放弃了的修改又恢复回来
+            self.recovered = False
+            self.journal_end = self.saved_end
+            recs = recs[:saved_ix]
+            if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > self.saved_end:
+                truncate_file(self.journal_path, self.saved_end)
+        for rec,_ in recs:
+            apply_record(data, rec)
+        return data
+
+    def save(self, data):
+        '''
+        保存数据
+        往日志里追加保存记录并fsync，日志太大时在后台把日志合并进快照；没有快照时直接写快照
+        args
+            data:list 标签数据
+        '''
+        if not self._has_snapshot():
+            self._wait_compact()
+            self._close_journal()
+            self._write_snapshot(data)
+            for path in (self.journal_path, self.old_journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.journal_end = self.saved_end = 0
+            return
+
+        self._append(('save',))
+        self._sync()
+        self.saved_end = self.journal_end
+        if self.compact_thread is not None and not self.compact_thread.is_alive(): #上次的合并已经完成
+            self._wait_compact()
+            self._compacted(data)
+        if self.journal_end >= max(journal_compact_size, self.snapshot_size // 4) and self.compact_thread is None:
+            self._compact(data)
+
+    def log_tag(self, path, tagDict):
+        '''
+        记录一个图片标签集的修改
+        args
+            path:str 图片路径
+            tagDict:dict(k->v) 新的标签集，None表示删除该图片
+        '''
+        self._append(('tag', path, tagDict))
+
+    def log_tags(self, items):
+        '''
+        记录一批图片标签集的修改（批量修改时只追加一条记录）
+        args
+            items:[(str,dict(k->v))] 图片路径和新的标签集，None表示删除该图片
+        '''
+        self._append(('tags', list(items)))
+
+    def log_meta(self, meta):
+        '''
+        记录元标签的修改（元标签数据很小，每次记录整份）
+        args
+            meta:list [meta_tag_cnt,meta_tag_tree,meta_kvtag_list,meta_tag2name]
+        '''
+        self._append(('meta', meta))
+
+    def close(self):
+        '''
+        程序关闭时的处理，等待后台合并完成，截掉未保存的记录（退出前已经auto_save过）
+        '''
+        self._wait_compact()
+        self._close_journal()
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > self.saved_end:
+            truncate_file(self.journal_path, self.saved_end)
+
+    def _append(self, rec):
+        '''
+        往日志里追加一条记录，记录数或时间到了就fsync
+        args
+            rec:tuple 记录
+        '''
+        if self.journal is None:
+            os.makedirs(self.tag_filedir, exist_ok=True)
+            if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) != self.journal_end:
+                os.truncate(self.journal_path, self.journal_end) #截掉不要的记录和写了一半的记录
+            self.journal = open(self.journal_path,'ab')
+        payload = pickle.dumps(rec, pickle.HIGHEST_PROTOCOL)
+        self.journal.write(struct.pack('<II', len(payload), zlib.crc32(payload)) + payload)
+        self.journal.flush()
+        self.journal_end += 8 + len(payload)
+        self.unsynced += 1
+        if self.unsynced >= journal_sync_records or time.time() - self.last_sync >= journal_sync_interval:
+            self._sync()
+
+    def _sync(self):
+        '''
+        把日志fsync到磁盘
+        '''
+        if self.journal is not None and self.unsynced > 0:
+            os.fsync(self.journal.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def _close_journal(self):
+        if self.journal is not None:
+            self._sync()
+            self.journal.close()
+            self.journal = None
+
+    def _compact(self, data):
+        '''
+        把日志合并进快照
+        当前日志改名为tag.journal.old，之后的记录写进新日志；后台线程写好新快照（已fsync）后才删除tag.journal.old
+        写快照前崩溃时，下次load会重放tag.journal.old（记录都是幂等的，重放多少次结果都一样）
+        tag.journal.old已存在时（上次合并没完成就崩溃了，它的记录还不在快照里），不能覆盖，而是把当前日志接在它后面
+        args
+            data:list 标签数据
+        '''
+        snapshot = [data[0], copy.deepcopy(data[1]), list(data[2]), dict(data[3]), self._copy_tag_dict(data[4])]
+        self._close_journal()
+        if os.path.exists(self.old_journal_path):
+            recs = read_journal(self.old_journal_path)
+            with open(self.journal_path,'rb') as f:
+                buf = f.read(self.journal_end)
+            with open(self.old_journal_path,'r+b') as f:
+                f.truncate(recs[-1][1] if len(recs) > 0 else 0) #去掉写了一半的记录，否则接上的记录读不出来
+                f.seek(0, os.SEEK_END)
+                f.write(buf)
+                f.flush()
+                os.fsync(f.fileno())
+            os.remove(self.journal_path) #中间崩溃时两份日志都有这些记录，重放两次结果一样
+        else:
+            os.replace(self.journal_path, self.old_journal_path)
+        self.journal_end = self.saved_end = 0
+        self.compact_thread = threading.Thread(target=self._compact2, args=(snapshot,))
+        self.compact_thread.start()
+
+    def _compact2(self, snapshot):
+        '''
+        _compact的后台线程
+        '''
+        self._write_snapshot(snapshot)
+        os.remove(self.old_journal_path)
+
+    def _compacted(self, data):
+        '''
+        后台合并完成后的处理（在save里调用）
+        args
+            data:list 当前的标签数据
+        '''
+        pass
+
+    def _wait_compact(self):
+        if self.compact_thread is not None:
+            self.compact_thread.join()
+            self.compact_thread = None
+
+    def _has_snapshot(self):
+        return os.path.exists(self.snapshot_path)
+
+    def _read_snapshot(self):
+        '''
+        读取快照
+        ret
+            list 标签数据
+        '''
+        self.snapshot_size = os.path.getsize(self.snapshot_path)
+        return pickle.load(open(self.snapshot_path,'rb'))
+
+    def _write_snapshot(self, data):
+        '''
+        写快照（可能在后台线程里调用）
+        args
+            data:list 标签数据
+        '''
+        write_snapshot(self.snapshot_path, data)
+        self.snapshot_size = os.path.getsize(self.snapshot_path)
+
+    def _copy_tag_dict(self, tag_dict):
+        '''
+        复制tag_dict作为合并用的快照（图片的标签集修改时整个替换，不会原地修改，所以浅复制就是一致的快照）
+        '''
+        return dict(tag_dict)
+
+class MmapTagStorage(PickleTagStorage):
+    '''
+    快照是内存映射的tag.{代}.mmap文件（格式见MmapTagFile），日志和合并同PickleTagStorage
+    合并时写下一代文件，不覆盖正在映射的文件；合并完成后tag_dict改用新文件，旧的代关闭后删除
+    '''
+    def __init__(self, tag_filedir):
+        super().__init__(tag_filedir)
+        self.journal_path = os.path.join(tag_filedir,'tag_mmap.journal') #日志（和pickle的日志分开）
+        self.old_journal_path = os.path.join(tag_filedir,'tag_mmap.journal.old') #正在合并进快照的日志
+        self.tag_file = None #MmapTagFile 当前映射的快照文件
+        self.retired_files = [] #[MmapTagFile] 合并后不再使用的文件（筛选线程可能还在扫描，下次合并或load时才关闭）
+        self.written_path = None #最后写的快照文件
+        self.compacted = None #MmapTagDict 后台合并写进新文件的数据
+
+    def load(self, recover=False):
+        '''
+        同PickleTagStorage.load，第一次使用mmap时先把tag.pkl（连同它的日志）导入成快照文件
+        日志里最后一个保存记录之后的记录（上次用pickle时崩溃留下的修改）也一起导入，和pickle启动时恢复的数据相同
+        '''
+        if not self._has_snapshot() and os.path.exists(os.path.join(self.tag_filedir,'tag.pkl')):
+            self._write_snapshot(PickleTagStorage(self.tag_filedir).load(recover=True)) #recover=False会截掉pickle日志里未保存的记录
+        return super().load(recover)
+
+    def close(self):
+        '''
+        同PickleTagStorage.close，并关闭映射的文件
+        '''
+        super().close()
+        self._close_files()
+        self.tag_file = None
+
+    def _close_files(self):
+        '''
+        关闭当前和已经不用的映射文件
+        '''
+        for tag_file in self.retired_files + [self.tag_file]:
+            if tag_file is not None:
+                tag_file.close()
+        self.retired_files = []
+
+    def _remove_old_gens(self):
+        '''
+        删除最新一代之前的快照文件
+        '''
+        for gen in self._gens()[:-1]:
+            try:
+                os.remove(os.path.join(self.tag_filedir,f'tag.{gen}.mmap'))
+            except OSError: #还在映射中（Windows），下次再删
+                pass
+
+    def _gens(self):
+        '''
+        列出快照文件的代
+        ret
+            [int] 从旧到新
+        '''
+        if not os.path.exists(self.tag_filedir):
+            return []
+        return sorted(int(name[4:-5]) for name in os.listdir(self.tag_filedir) if mmap_name_re.fullmatch(name))
+
+    def _has_snapshot(self):
+        return len(self._gens()) > 0
+
+    def _read_snapshot(self):
+        '''
+        映射最新的快照文件（只读文件头和元标签数据），删除旧的代
+        ret
+            list 标签数据（tag_dict是MmapTagDict）
+        '''
+        self._close_files() #重新load后旧的tag_dict不再使用
+        self.compacted = None
+        filepath = os.path.join(self.tag_filedir,f'tag.{self._gens()[-1]}.mmap')
+        self.tag_file = MmapTagFile(filepath)
+        self.snapshot_size = os.path.getsize(filepath)
+        self._remove_old_gens()
+        return self.tag_file.meta + [MmapTagDict(self.tag_file)]
+
+    def _write_snapshot(self, data):
+        '''
+        写下一代快照文件（可能在后台线程里调用）
+        args
+            data:list 标签数据
+        '''
+        gens = self._gens()
+        filepath = os.path.join(self.tag_filedir,f'tag.{gens[-1]+1 if len(gens) > 0 else 0}.mmap')
+        write_mmap_file(filepath, data)
+        self.snapshot_size = os.path.getsize(filepath)
+        self.written_path = filepath
+
+    def _compact2(self, snapshot):
+        super()._compact2(snapshot)
+        self.compacted = snapshot[4]
+
+    def _compacted(self, data):
+        '''
+        合并完成后让tag_dict改用新文件，旧文件放进retired_files
+        args
+            data:list 当前的标签数据
+        '''
+        compacted,self.compacted = self.compacted,None
+        tag_dict = data[4]
+        if compacted is None or not isinstance(tag_dict, MmapTagDict) or tag_dict.tag_file is not self.tag_file:
+            return
+        for tag_file in self.retired_files:
+            tag_file.close()
+        self.retired_files = [self.tag_file]
+        self.tag_file = MmapTagFile(self.written_path)
+        tag_dict.rebase(self.tag_file, compacted.overlay)
+        self._remove_old_gens()
+
+    def _copy_tag_dict(self, tag_dict):
+        '''
+        复制tag_dict作为合并用的快照（MmapTagDict只复制修改过的部分）
+        '''
+        if isinstance(tag_dict, MmapTagDict):
+            return tag_dict.copy()
+        return dict(tag_dict)
+
+class MmapTagFile(object):
+    '''
+    内存映射的标签文件（只读）
+    文件格式（整数都是本机字节序的uint64，文件不在不同字节序的机器间共用）：
+        文件头：魔数，图片数n，元标签数据长度，路径区长度，记录区长度
+        元标签数据：pickle的[meta_tag_cnt,meta_tag_tree,meta_kvtag_list,meta_tag2name]
+        路径偏移：n+1个，第i个路径是路径区[off[i]:off[i+1]]（utf-8），路径按顺序排列
+        记录偏移：n+1个，第i个图片的标签集是记录区[off[i]:off[i+1]]（pickle）
+        路径区、记录区
+    打开时只读文件头和元标签数据，查找路径用二分查找，标签集第一次访问时才解析
+    二分查找次数多了（筛选时按路径逐个查）才把所有路径读进dict，之后用dict查找
+    '''
+    def __init__(self, filepath):
+        with open(filepath,'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic,self.n,meta_len,path_len,rec_len = struct.unpack_from(mmap_header_fmt, self.mm, 0)
+        assert magic == mmap_magic, f'invalid tag file({filepath})'
+        pos = struct.calcsize(mmap_header_fmt)
+        self.meta = pickle.loads(self.mm[pos:pos+meta_len])
+        pos += meta_len
+        self.view = memoryview(self.mm)
+        self.path_offs = self.view[pos:pos+8*(self.n+1)].cast('Q') #路径偏移
+        pos += 8*(self.n+1)
+        self.rec_offs = self.view[pos:pos+8*(self.n+1)].cast('Q') #记录偏移
+        pos += 8*(self.n+1)
+        self.path_base = pos #路径区的起点
+        self.rec_base = pos + path_len #记录区的起点
+        self.records = {} #i->dict(k->v) 已经解析的标签集
+        self.path2ix = None #path->i 所有路径的dict（二分查找次数多了才建立）
+        self.lookups = 0 #二分查找的次数
+
+    def path(self, i):
+        return self.mm[self.path_base+self.path_offs[i]:self.path_base+self.path_offs[i+1]].decode('utf-8','surrogatepass')
+
+    def record(self, i, cache=True):
+        '''
+        第i个图片的标签集
+        args
+            i:int 序号
+            cache:bool 是否缓存解析结果（扫描全部时不缓存，否则整个标签库都会留在内存里）
+        ret
+            dict(k->v)
+        '''
+        rec = self.records.get(i)
+        if rec is None:
+            rec = pickle.loads(self.raw_record(i))
+            if cache:
+                self.records[i] = rec
+        return rec
+
+    def raw_record(self, i):
+        '''
+        第i个图片的标签集的pickle字节（不解析）
+        '''
+        return self.mm[self.rec_base+self.rec_offs[i]:self.rec_base+self.rec_offs[i+1]]
+
+    def close(self):
+        '''
+        关闭映射（先释放引用映射的memoryview）
+        '''
+        self.path_offs.release()
+        self.rec_offs.release()
+        self.view.release()
+        self.mm.close()
+        self.records = {}
+        self.path2ix = None
+
+    def find(self, path):
+        '''
+        查找路径
+        args
+            path:str 图片路径
+        ret
+            int 路径的序号，找不到为-1
+        '''
+        if self.path2ix is not None:
+            return self.path2ix.get(path, -1)
+        self.lookups += 1
+        if self.lookups > mmap_bisect_lookups:
+            self.path2ix = {self.path(i):i for i in range(self.n)}
+            return self.path2ix.get(path, -1)
+        key = path.encode('utf-8','surrogatepass')
+        lo,hi = 0,self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.mm[self.path_base+self.path_offs[mid]:self.path_base+self.path_offs[mid+1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n and self.path(lo) == path:
+            return lo
+        return -1
+
+class MmapTagDict(collections.abc.MutableMapping):
+    '''
+    映射文件上的tag_dict，用法和dict(path->dict(k->v))相同
+    修改（包括重放的日志）记在overlay里，覆盖映射文件里的数据
+    '''
+    def __init__(self, tag_file, overlay=None):
+        self.tag_file = tag_file #MmapTagFile
+        self.overlay = {} if overlay is None else overlay #path->dict(k->v) 修改过的标签集，None表示已删除
+
+    def __getitem__(self, path):
+        try:
+            tagDict = self.overlay[path] #不先判断in，rebase可能同时在删overlay
+        except KeyError:
+            tag_file = self.tag_file #合并后可能被rebase换掉，查找和读取要用同一个文件
+            i = tag_file.find(path)
+            tagDict = tag_file.record(i) if i >= 0 else None
+        if tagDict is None:
+            raise KeyError(path)
+        return tagDict
+
+    def __setitem__(self, path, tagDict):
+        self.overlay[path] = tagDict
+
+    def __delitem__(self, path):
+        if path not in self:
+            raise KeyError(path)
+        self.overlay[path] = None
+
+    def __iter__(self):
+        for path,_ in self.items():
+            yield path
+
+    def __len__(self):
+        tag_file = self.tag_file
+        cnt = tag_file.n
+        for path,tagDict in list(self.overlay.items()):
+            in_file = tag_file.find(path) >= 0
+            cnt += (tagDict is not None) - in_file
+        return cnt
+
+    def items(self):
+        '''
+        按路径顺序扫描所有图片的标签集（生成器），合并映射文件和overlay
+        映射文件里的标签集扫描时解析但不缓存
+        ret
+            generator((str,dict(k->v))) 路径和标签集
+        '''
+        return self._scan(False)
+
+    def raw_items(self):
+        '''
+        同items，但标签集是pickle的字节，映射文件里的直接复制，不解析（合并时用）
+        ret
+            generator((str,bytes)) 路径和标签集
+        '''
+        return self._scan(True)
+
+    def _scan(self, raw):
+        tag_file = self.tag_file
+        overlay = sorted(self.overlay.items())
+        if raw:
+            overlay = [(path, None if tagDict is None else pickle.dumps(tagDict, pickle.HIGHEST_PROTOCOL)) for path,tagDict in overlay]
+        j = 0
+        for i in range(tag_file.n):
+            path = tag_file.path(i)
+            while j < len(overlay) and overlay[j][0] < path:
+                if overlay[j][1] is not None:
+                    yield overlay[j]
+                j += 1
+            if j < len(overlay) and overlay[j][0] == path:
+                if overlay[j][1] is not None:
+                    yield overlay[j]
+                j += 1
+                continue
+            yield path, tag_file.raw_record(i) if raw else tag_file.record(i, cache=False)
+        for item in overlay[j:]:
+            if item[1] is not None:
+                yield item
+
+    def rebase(self, tag_file, merged):
+        '''
+        改用合并后的新文件，去掉已经写进新文件（之后没再修改）的overlay
+        先换文件再删overlay，并发读取时总能读到正确的数据
+        args
+            tag_file:MmapTagFile 新文件
+            merged:dict(path->dict(k->v)) 写进新文件的overlay
+        '''
+        self.tag_file = tag_file
+        for path,tagDict in merged.items():
+            if path in self.overlay and self.overlay[path] is tagDict:
+                del self.overlay[path]
+
+    def copy(self):
+        '''
+        复制（共用映射文件，只复制overlay）
+        ret
+            MmapTagDict
+        '''
+        return MmapTagDict(self.tag_file, dict(self.overlay))
+
+class SqliteTagStorage(object):
+    def __init__(self, tag_filedir):
+        self.tag_filedir = tag_filedir #保存标签文件的目录
+        self.lock = threading.RLock() #筛选线程和GUI线程共用数据库连接时的互斥锁
+        self.recovered = False #未提交的修改不会留到下次启动
+
+        os.makedirs(self.tag_filedir, exist_ok=True)
+        filepath = os.path.join(self.tag_filedir,'tag.db')
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        create_schema(self.conn)
+        self.conn.commit()
+        self.tag_dict = SqliteTagDict(self.conn, self.lock)
+
+        # 第一次使用sqlite时导入tag.pkl（连同日志里未保存的记录，同MmapTagStorage.load）
+        # 按数据库里有没有元标签数据判断，导入中途崩溃（事务没提交）时下次会重新导入
+        is_new = self.conn.execute("SELECT value FROM meta WHERE key='tag_cnt'").fetchone() is None
+        if is_new and os.path.exists(os.path.join(self.tag_filedir,'tag.pkl')):
+            data = PickleTagStorage(self.tag_filedir).load(recover=True)
+            with self.lock:
+                self.conn.executemany('INSERT INTO tags VALUES(?,?,?)',
+                    ((path,tag,v) for path,tagSet in data[4].items() for tag,v in tagSet.items()))
+                write_meta(self.conn, data)
+                self.conn.commit()
+
+    def load(self, recover=False):
+        '''
+        放弃未保存的修改，读取元标签数据
+        args
+            recover:bool 不使用（未提交的修改在关闭连接时已经丢弃）
+        ret
+            list 标签数据（tag_dict是SqliteTagDict），数据库里没有数据时返回None
+        '''
+        with self.lock:
+            self.conn.rollback()
+            data = read_meta(self.conn)
+        if data is None:
+            return None
+        return data + [self.tag_dict]
+
+    def save(self, data):
+        '''
+        重写元标签数据，并提交标签的修改
+        args
+            data:list 标签数据（tag_dict已经写在事务里，不再写一遍）
+        '''
+        with self.lock:
+            write_meta(self.conn, data)
+            self.conn.commit()
+
+    def index(self, kv_number):
+        '''
+        数据库上的倒排索引，代替TagSystem在内存里建立的tag_index,kv_index,kv_sorted（只支持筛选用到的get）
+        每次get都查询数据库（能看到事务里未提交的修改），结果不缓存，修改标签时也不需要维护
+        args
+            kv_number:func(str)->float|None 取KV标签值里的数字
+        ret
+            (SqliteTagIndex,SqliteKVIndex,SqliteKVSorted)
+        '''
+        return SqliteTagIndex(self.conn, self.lock), SqliteKVIndex(self.conn, self.lock), SqliteKVSorted(self.conn, self.lock, kv_number)
+
+    def log_tag(self, path, tagDict):
+        pass #修改已经写进数据库
+
+    def log_tags(self, items):
+        pass
+
+    def log_meta(self, meta):
+        pass #元标签在save时整个重写
+
+    def close(self):
+        '''
+        关闭数据库连接（未保存的修改会被丢弃）
+        '''
+        with self.lock:
+            self.conn.close()
+
+class SqliteTagDict(collections.abc.MutableMapping):
+    '''
+    数据库里的tag_dict，用法和dict(path->dict(k->v))相同
+    取出的标签集是新建的dict，修改它不会影响数据库，要修改需重新赋值
+    没有标签的图片不占行，赋值为空标签集等于删除
+    '''
+    def __init__(self, conn, lock):
+        self.conn = conn #数据库连接
+        self.lock = lock #互斥锁
+
+    def __getitem__(self, path):
+        with self.lock:
+            rows = self.conn.execute('SELECT tag,value FROM tags WHERE path=?', (path,)).fetchall()
+        if len(rows) == 0:
+            raise KeyError(path)
+        return dict(rows)
+
+    def __setitem__(self, path, tagSet):
+        with self.lock:
+            self.conn.execute('DELETE FROM tags WHERE path=?', (path,))
+            self.conn.executemany('INSERT INTO tags VALUES(?,?,?)', ((path,tag,v) for tag,v in tagSet.items()))
+
+    def __delitem__(self, path):
+        with self.lock:
+            if self.conn.execute('DELETE FROM tags WHERE path=?', (path,)).rowcount == 0:
+                raise KeyError(path)
+
+    def __contains__(self, path):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM tags WHERE path=? LIMIT 1', (path,)).fetchone() is not None
+
+    def __iter__(self):
+        for path,_ in self.items():
+            yield path
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(DISTINCT path) FROM tags').fetchone()[0]
+
+    def items(self):
+        '''
+        按路径顺序扫描所有图片的标签集（生成器）
+        每次查询sqlite_page_size行，查询之间可以修改数据
+        ret
+            generator((str,dict(k->v))) 路径和标签集
+        '''
+        last = ''
+        while True:
+            with self.lock:
+                rows = self.conn.execute('SELECT path,tag,value FROM tags WHERE path>? ORDER BY path LIMIT ?', (last, sqlite_page_size)).fetchall()
+                if len(rows) == sqlite_page_size: #最后一个路径的标签可能没取全，单独再取
+                    tail = rows[-1][0]
+                    rows = [row for row in rows if row[0] != tail]
+                    rows += self.conn.execute('SELECT path,tag,value FROM tags WHERE path=?', (tail,)).fetchall()
+            if len(rows) == 0:
+                return
+            for path,group in itertools.groupby(rows, operator.itemgetter(0)):
+                yield path, {tag:v for _,tag,v in group}
+            last = rows[-1][0]
+
+class SqliteTagIndex(object):
+    '''
+    tag->set(path) 有某个标签的图片
+    '''
+    def __init__(self, conn, lock):
+        self.conn = conn #数据库连接
+        self.lock = lock #互斥锁
+
+    def get(self, tag, default=None):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute('SELECT path FROM tags WHERE tag=?', (tag,)))
+
+class SqliteKVIndex(object):
+    '''
+    tag->v->set(path) KV标签为某个值的图片（值按字符串比较）
+    '''
+    def __init__(self, conn, lock):
+        self.conn = conn #数据库连接
+        self.lock = lock #互斥锁
+
+    def get(self, tag, default=None):
+        return SqliteKVValues(self.conn, self.lock, tag)
+
+class SqliteKVValues(object):
+    def __init__(self, conn, lock, tag):
+        self.conn = conn #数据库连接
+        self.lock = lock #互斥锁
+        self.tag = tag #KV标签码
+
+    def get(self, v, default=None):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute('SELECT path FROM tags WHERE tag=? AND CAST(value AS TEXT)=?', (self.tag, v)))
+
+class SqliteKVSorted(object):
+    '''
+    tag->([float],[path]) KV标签按(数值,路径)排序的值索引，查询时才排序
+    '''
+    def __init__(self, conn, lock, kv_number):
+        self.conn = conn #数据库连接
+        self.lock = lock #互斥锁
+        self.kv_number = kv_number #取KV标签值里的数字
+
+    def get(self, tag, default=None):
+        with self.lock:
+            rows = self.conn.execute('SELECT value,path FROM tags WHERE tag=? AND value IS NOT NULL', (tag,)).fetchall()
+        items = sorted((num, path) for num,path in ((self.kv_number(v), path) for v,path in rows) if num is not None)
+        return [num for num,_ in items], [path for _,path in items]
+
+def write_snapshot(filepath, data):
+    '''
+    写快照（先写临时文件再替换，写到一半崩溃不会损坏原来的快照）
+    args
+        filepath:str 快照路径
+        data:list 标签数据
+    '''
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_path = filepath + '.tmp'
+    with open(tmp_path,'wb') as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+def write_mmap_file(filepath, data):
+    '''
+    写MmapTagFile格式的标签文件（先写临时文件再改名）
+    args
+        filepath:str 文件路径
+        data:list 标签数据（tag_dict为dict或MmapTagDict）
+    '''
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    if isinstance(data[4], MmapTagDict): #已经按顺序，映射文件里的记录直接复制字节
+        items = data[4].raw_items()
+    else:
+        items = ((path, pickle.dumps(tagDict, pickle.HIGHEST_PROTOCOL)) for path,tagDict in sorted(data[4].items()))
+    path_offs,rec_offs = array.array('Q',[0]),array.array('Q',[0])
+    paths,recs = bytearray(),bytearray()
+    for path,rec in items:
+        paths += path.encode('utf-8','surrogatepass')
+        recs += rec
+        path_offs.append(len(paths))
+        rec_offs.append(len(recs))
+    meta = pickle.dumps(list(data[:4]), pickle.HIGHEST_PROTOCOL)
+    tmp_path = filepath + '.tmp'
+    with open(tmp_path,'wb') as f:
+        f.write(struct.pack(mmap_header_fmt, mmap_magic, len(path_offs)-1, len(meta), len(paths), len(recs)))
+        f.write(meta)
+        f.write(path_offs.tobytes())
+        f.write(rec_offs.tobytes())
+        f.write(paths)
+        f.write(recs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+def truncate_file(filepath, size):
+    '''
+    截短文件并fsync
+    args
+        filepath:str 文件路径
+        size:int 截短后的大小
+    '''
+    with open(filepath,'r+b') as f:
+        f.truncate(size)
+        os.fsync(f.fileno())
+
+def read_journal(filepath):
+    '''
+    读取日志里的所有完整记录（写了一半或校验不对的记录及其之后的部分被忽略）
+    args
+        filepath:str 日志路径
+    ret
+        [(tuple,int)] 记录，以及该记录在日志里的末尾位置
+    '''
+    if not os.path.exists(filepath):
+        return []
+    buf = open(filepath,'rb').read()
+    recs = []
+    pos = 0
+    while pos + 8 <= len(buf):
+        size,crc = struct.unpack_from('<II', buf, pos)
+        payload = buf[pos+8:pos+8+size]
+        if len(payload) != size or zlib.crc32(payload) != crc:
+            break
+        pos += 8 + size
+        recs.append((pickle.loads(payload), pos))
+    return recs
+
+def apply_record(data, rec):
+    '''
+    把一条日志记录应用到标签数据上
+    记录都是修改后的完整值，是幂等的：
+        ('tag',path,tagDict) 图片的标签集，tagDict为None表示删除该图片
+        ('tags',[(path,tagDict)]) 一批图片的标签集（批量修改）
+        ('meta',meta) 元标签数据
+        ('save',) 保存
+    args
+        data:list 标签数据
+        rec:tuple 记录
+    '''
+    if rec[0] in ['tag','tags']:
+        for path,tagDict in [rec[1:]] if rec[0] == 'tag' else rec[1]:
+            if tagDict is None:
+                data[4].pop(path, None)
+            else:
+                data[4][path] = tagDict
+    elif rec[0] == 'meta':
+        data[:4] = rec[1]
+
+def create_schema(conn):
+    '''
+    建立sqlite的表（已存在则跳过）
+    args
+        conn:sqlite3.Connection 数据库连接
+    '''
+    for sql in sqlite_schema:
+        conn.execute(sql)
+
+def write_meta(conn, data):
+    '''
+    把元标签数据写进数据库（不提交）
+    标签树的每个节点写成(标签码,名字,父亲标签码,在兄弟里的位置)，KV标签的父亲为NULL，位置是在KV标签列表里的位置
+    已删除但名字还留在meta_tag2name里的标签（如removeKVTag删除的KV标签）is_kv为2，只保存名字，与pickle保存的内容一致
+    args
+        conn:sqlite3.Connection 数据库连接
+        data:list 标签数据
+    '''
+    meta_tag_cnt,meta_tag_tree,meta_kvtag_list,meta_tag2name = data[:4]
+    rows = [(meta_tag_tree[0], meta_tag2name[meta_tag_tree[0]], None, 0, 0)]
+    stack = [meta_tag_tree]
+    while len(stack) > 0:
+        cur_node = stack.pop()
+        for pos,son_node in enumerate(cur_node[1]):
+            rows.append((son_node[0], meta_tag2name[son_node[0]], cur_node[0], pos, 0))
+            stack.append(son_node)
+    for pos,tag in enumerate(meta_kvtag_list):
+        rows.append((tag, meta_tag2name[tag], None, pos, 1))
+    written = set(row[0] for row in rows)
+    for tag,name in meta_tag2name.items():
+        if tag not in written:
+            rows.append((tag, name, None, 0, 2))
+    conn.execute('DELETE FROM meta_tags')
+    conn.executemany('INSERT INTO meta_tags VALUES(?,?,?,?,?)', rows)
+    conn.execute("INSERT OR REPLACE INTO meta VALUES('tag_cnt',?)", (meta_tag_cnt,))
+
+def read_meta(conn):
+    '''
+    从数据库读取元标签数据
+    args
+        conn:sqlite3.Connection 数据库连接
+    ret
+        [int,list,[int],dict(int->str)] meta_tag_cnt,meta_tag_tree,meta_kvtag_list,meta_tag2name，没有数据时返回None
+    '''
+    row = conn.execute("SELECT value FROM meta WHERE key='tag_cnt'").fetchone()
+    if row is None:
+        return None
+    meta_tag2name = {}
+    nodes = {}
+    sons = []
+    kv_tags = []
+    for tag,name,father,pos,is_kv in conn.execute('SELECT tag,name,father,pos,is_kv FROM meta_tags ORDER BY pos'):
+        meta_tag2name[tag] = name
+        if is_kv == 2: #只有名字
+            continue
+        if is_kv:
+            kv_tags.append(tag)
+        else:
+            nodes[tag] = [tag,[]]
+            if father is None: #根
+                meta_tag_tree = nodes[tag]
+            else:
+                sons.append((tag,father))
+    for tag,father in sons: #按位置顺序加到父亲下面
+        nodes[father][1].append(nodes[tag])
+    return [row[0], meta_tag_tree, kv_tags, meta_tag2name]
@@ -1,8 +1,20 @@
 import os
-import pickle
-import copy
+import types
 import datetime
 import re
+import time
+import bisect
+import threading
+import itertools
+import collections
+import multiprocessing
+try:
+    import re._parser as sre_parse
+except ImportError: #python3.11以前
+    import sre_parse
+
+from tag_storage import PickleTagStorage,MmapTagStorage,SqliteTagStorage
+from tag_snapshot import TagSnapshotStore
 
 '''
 TagSystem模块可独立于Qt/GUI使用
@@ -24,10 +36,12 @@ TagSystem模块可独立于Qt/GUI使用
     1. 该结构是多叉树
     2. 根在TagWidget是不显示的
     3. 根的儿子是TagWidget的顶层节点
+    4. 标签树有索引：标签码->节点，标签码->父亲节点，随标签树的修改同步维护，查找节点不用遍历整棵树
+       另外按需计算欧拉序区间（判断祖先/子孙关系）和子树标签集合（“存在”运算符用），标签树修改后重新计算
 
 标签筛选算法
     事实上，目前有三级筛选：
-    1. 路径目录
+    1. 路径目录（有CatalogSystem时从目录记录里读取，不遍历文件系统）
     2. 路径筛选
     3. 标签筛选
     2和3的筛选都写在了tagStr中，格式是{pathFilterStr}tagFilterStr
@@ -36,59 +50,593 @@ TagSystem模块可独立于Qt/GUI使用
     tagFilterStr为逻辑表达式，支持与、或、非、存在（用`表示），以及等于不等（用于KV标签），例如：
         坐姿&逆光|!俯拍
         蹲姿&光圈==F1.4
+        焦距>=35&焦距<85
+        评分==3~5
         `前景&侧身
+    优先级从低到高：| & ! ==/!=/</<=/>/>= `，这些比较运算符的左边是KV标签，右边是值
+    ==和!=按字符串比较；<、<=、>、>=和区间（==a~b，包括两端）按数值比较，
+    数值取值里的第一个数字（如F1.4取1.4，50mm取50），取不到数字的值不参与数值比较
+
+    标签筛选串的计算分两步：
+    1. 编译：词法分析后用递归下降解析成语法树，再把语法树编译成嵌套的闭包（compile_tag_ast）
+       编译结果按(筛选串,元标签版本)缓存在plan_cache里，元标签修改后版本+1，旧的编译结果自然失效
+    2. 计算：对每个图片只调用一次闭包，闭包的参数是图片的标签集，&和|会短路
+
+    倒排索引：
+    1. tag_index记录每个标签码对应的图片路径集合，kv_index记录每个KV标签的每个值对应的图片路径集合
+       索引在第一次筛选时建立，之后由updateTag增量维护，reset和cleanData后重建
+    2. 筛选时先在索引上用集合运算计算语法树（eval_tag_ast），结果是一个集合或一个集合的补集
+       结果是集合时，只需检查集合里的路径是否在路径目录下，不用遍历目录，耗时只和结果数量有关
+       结果是补集时（如!坐姿），才遍历路径目录，再去掉补集里的路径
+    3. kv_sorted按(数值,路径)记录每个KV标签的有序值索引，数值比较只需二分查找再取一段，不用逐个图片比较
+       建立索引时每个标签收集完再排序一次，updateTag增删单个图片时二分查找到确切的位置
+
+路径筛选串的计算：
+    路径筛选串编译一次（PathFilter，和标签筛选串一起缓存），并从正则表达式里提取必须出现的字面量：
+    1. 以^开头的字面量前缀：遍历目录时，与前缀不相容的目录整棵子树都不进入
+    2. 所有必须出现的字面量：先用in判断，都出现了才调用正则表达式
+    没有^的正则表达式可以匹配任何深度的文件名，不能据此跳过目录，只能用字面量加快逐个判断
+
+流式筛选：
+    iterFilterImage是筛选的生成器版本，边遍历边分批产出结果，供GUI在线程里调用，每批之间可以取消
+    filterImage等于把所有批次拼起来
+
+筛选结果缓存：
+    完整执行完的筛选结果按(路径目录,筛选串)缓存在result_cache里（LRU，限制路径总数），再次打开同一筛选时直接返回
+    1. updateTag修改的图片在某个缓存结果的路径目录下时，删除该缓存结果
+    2. 缓存结果记录了元标签版本，元标签修改后自然失效；reset和cleanData清空缓存
+    3. 筛选执行期间tag_dict被修改过，或者筛选被取消，则不缓存结果
+    4. 文件的增删不会让缓存结果失效（缓存只在内存里，重启程序后重新计算）
+
+多进程筛选：
+    filter_workers不为1时，需要遍历目录的筛选（补集或只有路径筛选串）交给进程池计算
+    1. 进程池创建时传入tag_dict的快照（只读），之后updateTag等的修改记在filter_deltas里，随任务发给进程，
+       进程按顺序把还没应用的修改应用到自己的快照上；修改超过filter_delta_max个，或reset/cleanData/restoreSnapshot
+       整体替换了数据时，下次筛选才重建进程池。重建时只在lock里复制tag_dict，创建进程（传入快照）时不持有lock
+       旧进程池还有筛选在取结果时不马上结束，而是等这些筛选都结束（取完结果或被取消）后再结束
+    2. 遍历目录得到的路径按filter_chunk_size分块，语法树和路径筛选串随任务发给进程，在进程里编译和计算
+    3. 按分块顺序取回结果，结果顺序与单进程相同；同时在计算的分块数有上限，取消筛选时遍历也会随之停止
+    4. 路径数不到filter_parallel_min时仍在当前线程计算
+    筛选可能在线程里进行，因此修改标签和元标签、reset、cleanData、建立索引、编译筛选串都要持有lock
+
+标签文件：
+    标签文件的读写交给TagStorage（见tag_storage.py），storage为pickle时tag.pkl是快照，修改记在日志里
+    storage为mmap时快照是内存映射的文件，启动时不读入标签数据，tag_dict里的标签集第一次访问时才解析
+    updateTag每次追加一条记录，addTagToPaths等批量修改、cleanData和restoreSnapshot整批只追加一条，元标签的修改也会追加记录；save只追加一个保存记录，日志大了才在后台合并进快照
+    auto_save交给TagSnapshotStore（见tag_snapshot.py），保存在snapshots目录里，没变化的部分不重复保存
+    restoreSnapshot把某个自动保存恢复成未保存的修改，确认后再save，不想要了可以reset
+    storage为sqlite时tag_dict是数据库里的表，updateTag直接写该图片的行，save只提交事务和重写元标签
+    因此整个遍历tag_dict的地方（建立索引、统计、清理数据）都用items()按顺序扫描，不按路径逐个查询
+    sqlite时倒排索引也不在内存里建立，tag_index,kv_index,kv_sorted是对数据库的查询（见SqliteTagStorage.index），
+    每次筛选只查询语法树里的标签，内存占用只和结果大小有关；多进程筛选时进程里仍是整份tag_dict的快照
+
+标签统计：
+    dir_tag_cnt记录每个目录（不含子孙目录）里每个标签的图片数，第一次统计时建立，之后由updateTag增量维护
+    统计某个路径目录时只需累加该目录及其子孙目录的计数（countTags），不用遍历所有图片
 '''
 
 # 标签筛选用到的东西
-op_chs = set(['(',')','|','&','!','=','#','`']) #属于op的字符
-op_adv = {'|':1,'&':2,'!':4,'`':5,'==':3,'!=':3,'#':0} #op优先级
-op_func = { #op具体函数
-    '|':lambda a,b : a or b,
-    '&':lambda a,b : a and b,
-    '!':lambda a : not a,
-    '==':lambda a,b : a==b,
-    '!=':lambda a,b : a!=b,
-    '#':lambda a : a,
-    '`':None,
-}
+op_chs = set(['(',')','|','&','!','=','#','`','<','>']) #属于op的字符
+cmp_ops = ['==','!=','<','<=','>','>='] #比较运算符（左边是KV标签，右边是值）
+kv_number_re = re.compile(r'[-+]?\d+(?:\.\d+)?') #KV标签值里的数字
+
+def kv_number(v):
+    '''
+    取KV标签值里的第一个数字（用于数值比较）
+    args
+        v:object KV标签值
+    ret
+        float 数值（取不到则为None）
+    '''
+    if v is None:
+        return None
+    ma = kv_number_re.search(str(v))
+    return float(ma.group()) if ma is not None else None
+plan_cache_size = 64 #缓存的编译结果数量
+filter_batch_size = 256 #流式筛选每批最多的路径数
+filter_batch_interval = 0.2 #流式筛选距离上一批超过这么多秒就产出一批（可以是空批），方便调用者及时取消
+filter_chunk_size = 16384 #多进程筛选时每个任务的路径数
+filter_delta_max = 4096 #进程池快照之后修改过的图片数超过这么多时，下次筛选重建进程池（否则把修改随任务发给进程）
+filter_parallel_min = 2 * filter_chunk_size #路径数不到这么多时不用进程池（启动进程和传入快照的开销比计算还大）
+result_cache_paths = 200000 #筛选结果缓存里最多保存的路径总数
+empty_tag_set = types.MappingProxyType({}) #没有标签的图片的标签集（只读）
+
+class PathFilter(object):
+    '''
+    编译好的路径筛选串
+    '''
+    def __init__(self, pathFilterStr):
+        self.pathFilterStr = pathFilterStr #路径筛选串（正则表达式）
+        self.regex = re.compile(pathFilterStr) #编译好的正则表达式
+        self.prefix,self.literals = regex_literals(pathFilterStr) #以^开头时的字面量前缀（没有则为None），必须出现的字面量列表
+
+    def match(self, path):
+        '''
+        判断路径是否符合路径筛选串
+        args
+            path:str 图片路径
+        ret
+            bool 是否符合
+        '''
+        for literal in self.literals: #先判断必须出现的字面量，比正则表达式快
+            if literal not in path:
+                return False
+        return self.regex.search(path) is not None
+
+    def prune(self, dirpath):
+        '''
+        判断目录的整棵子树是否都不可能符合路径筛选串（遍历目录时跳过）
+        args
+            dirpath:str 目录路径
+        ret
+            bool 是否可以跳过
+        '''
+        if self.prefix is None:
+            return False
+        dirpath = os.path.join(dirpath, '')
+        return not (self.prefix.startswith(dirpath) or dirpath.startswith(self.prefix))
+
+def regex_literals(pattern):
+    '''
+    从正则表达式里提取必须出现的字面量（只分析最外层，忽略大小写时不提取）
+    args
+        pattern:str 正则表达式
+    ret
+        (str,[str]) 以^开头时的字面量前缀（没有则为None），必须出现的字面量列表
+    '''
+    parsed = sre_parse.parse(pattern)
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & re.IGNORECASE:
+        return None,[]
+
+    items = list(parsed)
+    anchored = len(items) > 0 and items[0] == (sre_parse.AT, sre_parse.AT_BEGINNING) or \
+               len(items) > 0 and items[0] == (sre_parse.AT, sre_parse.AT_BEGINNING_STRING)
+    if anchored:
+        items = items[1:]
+
+    literals = []
+    cur = []
+    prefix = None
+    for op,av in items + [(None,None)]: #最后补一项用于结束字面量
+        if op == sre_parse.LITERAL:
+            cur.append(chr(av))
+            continue
+        if anchored and prefix is None:
+            prefix = ''.join(cur) if len(cur) > 0 else ''
+        if len(cur) > 0:
+            literals.append(''.join(cur))
+            cur = []
+    if prefix == '':
+        prefix = None
+    return prefix,literals
+
+def ast_exist_tags(node):
+    '''
+    找出语法树里所有“存在”运算符的标签码
+    args
+        node:tuple 语法树节点
+    ret
+        set(int) 标签码集合
+    '''
+    if node[0] == 'exist':
+        return {node[1]}
+    if node[0] in ['not','and','or']:
+        return set().union(*[ast_exist_tags(son) for son in node[1:]])
+    return set()
+
+# 多进程筛选的worker用到的东西（每个进程一份）
+filter_worker_tag_dict = None #tag_dict的快照
+filter_worker_plans = {} #(pathFilterStr,ast,meta_version)->(PathFilter,func) 进程里编译好的筛选串
+filter_worker_delta_ix = 0 #快照已经应用了多少个修改
+
+def init_filter_worker(tag_dict):
+    '''
+    多进程筛选的进程初始化函数
+    args
+        tag_dict:dict(path->dict(k->v)) tag_dict的快照
+    '''
+    global filter_worker_tag_dict, filter_worker_delta_ix
+    filter_worker_tag_dict = tag_dict
+    filter_worker_delta_ix = 0
+
+def filter_chunk(args):
+    '''
+    多进程筛选的任务函数（在进程池里执行）
+    args
+        args:(str,tuple,dict(int->frozenset(int)),int,[(str,dict)],[str]) 路径筛选串，语法树，“存在”运算符用到的子树标签集合，元标签版本，
+            快照之后的修改（path->新标签集，None表示删除），路径分块
+    ret
+        [int] 分块里符合筛选要求的路径的下标（只传回下标，减少进程间传输）
+    '''
+    global filter_worker_delta_ix
+    pathFilterStr,ast,subtree,meta_version,deltas,paths = args
+    for path,tagDict in deltas[filter_worker_delta_ix:]: #只应用还没应用过的修改
+        if tagDict is None:
+            filter_worker_tag_dict.pop(path, None)
+        else:
+            filter_worker_tag_dict[path] = tagDict
+    filter_worker_delta_ix = max(filter_worker_delta_ix, len(deltas))
+    key = (pathFilterStr, ast, meta_version)
+    if key not in filter_worker_plans:
+        if len(filter_worker_plans) >= plan_cache_size:
+            filter_worker_plans.clear()
+        pathFilter = PathFilter(pathFilterStr) if pathFilterStr is not None else None
+        func = compile_tag_ast(ast, subtree.__getitem__) if ast is not None else None
+        filter_worker_plans[key] = (pathFilter, func)
+    pathFilter,func = filter_worker_plans[key]
+
+    tag_dict = filter_worker_tag_dict
+    empty = {}
+    return [i for i,path in enumerate(paths) if (pathFilter is None or pathFilter.match(path)) and (func is None or func(tag_dict.get(path, empty)))]
+
+def tokenize_tag_exp(tagStr):
+    '''
+    标签筛选串的词法分析
+    args
+        tagStr:str 标签筛选串（不含路径筛选串）
+    ret
+        [str] 单词列表，运算符和标签名字/值都是一个单词
+    '''
+    tokens = []
+    ibeg = 0
+    while ibeg < len(tagStr):
+        if tagStr[ibeg] in op_chs: #运算符
+            if tagStr[ibeg] in ['=','!','<','>'] and ibeg+1<len(tagStr) and tagStr[ibeg+1]=='=':
+                iend = ibeg + 2
+            else:
+                iend = ibeg + 1
+        else: #标签或值
+            iend = ibeg + 1
+            while iend < len(tagStr) and tagStr[iend] not in op_chs:
+                iend += 1
+        tokens.append(tagStr[ibeg:iend])
+        ibeg = iend
+    return tokens
+
+def parse_tag_exp(tagStr, name2tag):
+    '''
+    把标签筛选串解析成语法树（递归下降）
+    语法树的节点是元组：
+        ('tag',tag) ('exist',tag) ('eq',tag,value) ('ne',tag,value)
+        ('range',tag,lo,hi,lo_closed,hi_closed) 数值区间，lo/hi为None表示没有该边界
+        ('not',node) ('and',node,node) ('or',node,node)
+    args
+        tagStr:str 标签筛选串（不含路径筛选串）
+        name2tag:dict(str->int) 标签名字->标签码
+    ret
+        tuple 语法树的根节点
+    '''
+    tokens = tokenize_tag_exp(tagStr)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        assert pos < len(tokens), f'unexpected end of tagStr({tagStr})'
+        pos += 1
+        return tokens[pos-1]
+
+    def parse_or():
+        node = parse_and()
+        while peek() == '|':
+            take()
+            node = ('or', node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek() == '&':
+            take()
+            node = ('and', node, parse_not())
+        return node
+
+    def parse_not():
+        if peek() == '!':
+            take()
+            return ('not', parse_not())
+        return parse_eq()
+
+    def parse_eq():
+        node = parse_exist()
+        if peek() in cmp_ops:
+            op = take()
+            assert node[0] == 'tag', f'left of {op} must be a tag in tagStr({tagStr})'
+            value = take()
+            assert value not in op_chs and value not in cmp_ops, f'invalid value({value}) in tagStr({tagStr})'
+            tag = node[1]
+            if op == '==' and '~' in value: #区间
+                lo,hi = value.split('~', 1)
+                lo = kv_number(lo) if lo != '' else None
+                hi = kv_number(hi) if hi != '' else None
+                node = ('range', tag, lo, hi, True, True)
+            elif op in ['==','!=']:
+                node = ('eq' if op == '==' else 'ne', tag, value)
+            else:
+                num = kv_number(value)
+                assert num is not None, f'{op} needs a number, got {value} in tagStr({tagStr})'
+                if op[0] == '<':
+                    node = ('range', tag, None, num, False, op == '<=')
+                else:
+                    node = ('range', tag, num, None, op == '>=', False)
+        return node
+
+    def parse_exist():
+        if peek() == '`':
+            take()
+            node = parse_exist()
+            return ('exist', node[1]) if node[0] == 'tag' else node #对表达式求存在等于表达式本身
+        return parse_primary()
+
+    def parse_primary():
+        token = take()
+        if token == '(':
+            node = parse_or()
+            assert take() == ')', f'unmatched ( in tagStr({tagStr})'
+            return node
+        assert token not in op_chs and token not in cmp_ops, f'unexpected {token} in tagStr({tagStr})'
+        assert token in name2tag, f'unknown tag name({token}) in tagStr({tagStr})'
+        return ('tag', name2tag[token]) #名字转标签码
+
+    node = parse_or()
+    assert pos == len(tokens), f'unexpected {tokens[pos]} in tagStr({tagStr})'
+    return node
+
+def compile_tag_ast(node, subtree_tags):
+    '''
+    把语法树编译成闭包
+    闭包的参数是图片的标签集（dict(k->v)，没有标签的图片传空dict），返回是否符合筛选要求
+    args
+        node:tuple 语法树节点
+        subtree_tags:func(int)->set(int) 获取元标签子树里所有标签码的函数（用于“存在”运算符）
+    ret
+        func(dict)->bool 编译好的闭包
+    '''
+    kind = node[0]
+    if kind == 'tag':
+        tag = node[1]
+        return lambda tagSet: tag in tagSet
+    if kind == 'exist':
+        tags = frozenset(subtree_tags(node[1])) #编译时就展开子树，计算时只需判断是否相交
+        return lambda tagSet: not tags.isdisjoint(tagSet)
+    if kind in ['eq','ne']:
+        tag,value = node[1],node[2]
+        eq = lambda tagSet: tagSet.get(tag) is not None and str(tagSet[tag]) == value
+        if kind == 'eq':
+            return eq
+        return lambda tagSet: not eq(tagSet)
+    if kind == 'range':
+        tag,lo,hi,lo_closed,hi_closed = node[1:]
+        def in_range(tagSet):
+            num = kv_number(tagSet.get(tag))
+            if num is None:
+                return False
+            if lo is not None and (num < lo or num == lo and not lo_closed):
+                return False
+            if hi is not None and (num > hi or num == hi and not hi_closed):
+                return False
+            return True
+        return in_range
+    if kind == 'not':
+        f = compile_tag_ast(node[1], subtree_tags)
+        return lambda tagSet: not f(tagSet)
+    f1 = compile_tag_ast(node[1], subtree_tags)
+    f2 = compile_tag_ast(node[2], subtree_tags)
+    if kind == 'and':
+        return lambda tagSet: f1(tagSet) and f2(tagSet)
+    assert kind == 'or', f'unknown node({node})'
+    return lambda tagSet: f1(tagSet) or f2(tagSet)
+
+def eval_tag_ast(node, tag_index, kv_index, subtree_tags, kv_sorted=None):
+    '''
+    在倒排索引上用集合运算计算语法树
+    为了不用枚举全集就能计算非运算，结果用(集合,是否取补集)表示
+    args
+        node:tuple 语法树节点
+        tag_index:dict(int->set(str)) 标签码->图片路径集合
+        kv_index:dict(int->dict(str->set(str))) KV标签码->值->图片路径集合
+        subtree_tags:func(int)->set(int) 获取元标签子树里所有标签码的函数
+        kv_sorted:dict(int->([float],[str])) KV标签码->按数值排序的值列表和对应的图片路径列表（None表示没有）
+    ret
+        (set(str),bool) 路径集合，以及结果是否为该集合的补集
+    '''
+    empty = set()
+    kind = node[0]
+    if kind == 'tag':
+        return tag_index.get(node[1], empty), False
+    if kind == 'exist':
+        paths = set()
+        for tag in subtree_tags(node[1]):
+            paths |= tag_index.get(tag, empty)
+        return paths, False
+    if kind in ['eq','ne']:
+        paths = kv_index.get(node[1], {}).get(node[2], empty)
+        return paths, kind == 'ne'
+    if kind == 'range': #二分查找区间的两端，再取一段
+        tag,lo,hi,lo_closed,hi_closed = node[1:]
+        nums,paths = kv_sorted.get(tag, ([],[])) if kv_sorted is not None else ([],[])
+        if lo is None:
+            i = 0
+        else:
+            i = bisect.bisect_left(nums, lo) if lo_closed else bisect.bisect_right(nums, lo)
+        if hi is None:
+            j = len(nums)
+        else:
+            j = bisect.bisect_right(nums, hi) if hi_closed else bisect.bisect_left(nums, hi)
+        return set(paths[i:j]), False
+    if kind == 'not':
+        paths,neg = eval_tag_ast(node[1], tag_index, kv_index, subtree_tags, kv_sorted)
+        return paths, not neg
+    a,neg_a = eval_tag_ast(node[1], tag_index, kv_index, subtree_tags, kv_sorted)
+    b,neg_b = eval_tag_ast(node[2], tag_index, kv_index, subtree_tags, kv_sorted)
+    if kind == 'and':
+        if not neg_a and not neg_b:
+            return a & b, False
+        if not neg_a:
+            return a - b, False
+        if not neg_b:
+            return b - a, False
+        return a | b, True #~a&~b = ~(a|b)
+    assert kind == 'or', f'unknown node({node})'
+    if not neg_a and not neg_b:
+        return a | b, False
+    if not neg_a:
+        return b - a, True #a|~b = ~(b-a)
+    if not neg_b:
+        return a - b, True
+    return a & b, True #~a|~b = ~(a&b)
 
 class TagSystem(object):
-    def __init__(self, tag_filedir, img_extnames):
+    def __init__(self, tag_filedir, img_extnames, catalog=None, filter_workers=1, storage='pickle', snapshot_keep=20, snapshot_keep_days=30):
         self.tag_filedir = tag_filedir #保存标签文件的目录
         self.img_extnames = img_extnames #需要打标签的图片文件名后缀
+        self.catalog = catalog #CatalogSystem 图片目录树的目录，为None时直接访问文件系统
+        self.filter_workers = filter_workers #筛选的进程数（1表示不用进程池，0表示使用CPU核数）
+        storage_classes = {'pickle':PickleTagStorage, 'mmap':MmapTagStorage, 'sqlite':SqliteTagStorage}
+        assert storage in storage_classes, f'invalid storage({storage})'
+        self.storage = storage_classes[storage](tag_filedir) #标签文件的读写
+        self.snapshots = TagSnapshotStore(os.path.join(tag_filedir,'snapshots'), snapshot_keep, snapshot_keep_days) #自动保存
+        self.snapshot_version = None #上次自动保存时的(data_version,meta_version)
 
-        self.tag_dict = {} #path->dict(k->v) 每个图片对应的标签集，k是标签码，v是KV标签值，普通标签的v为None
+        self.tag_dict = self.storage.tag_dict if storage == 'sqlite' else {} #path->dict(k->v) 每个图片对应的标签集，k是标签码，v是KV标签值，普通标签的v为None
         self.is_dirty = False #判断是否修改（即是否未保存）
 
         self.meta_tag_tree = [0,[]] #标签树数据结构，节点第一项是标签码，第二项是儿子节点列表
         self.meta_kvtag_list = [] #list(int) KV标签列表数据结构
         self.meta_tag2name = {0:'root'} #标签码->标签名字
         self.meta_tag_cnt = 1 #标签码最大值（用于分配新标签码）
+        self.meta_version = 0 #元标签的版本，元标签每次修改都+1（用于判断缓存的编译结果是否失效）
+
+        self.meta_tag2node = {} #标签码->标签树节点
+        self.meta_tag2father = {} #标签码->父亲节点（根的父亲是None）
+        self.meta_euler = None #标签码->(进入序号,离开序号) 欧拉序区间，None表示需要重新计算
+        self.meta_subtree = {} #标签码->frozenset(标签码) 子树标签集合的缓存
+        self._build_tree_index()
 
-        self.reset() #从文件载入标签数据
+        self.plan_cache = collections.OrderedDict() #(tagStr,meta_version)->(pathFilter,ast,func) 标签筛选串的编译结果
+        self.index_in_db = storage == 'sqlite' #倒排索引是否为对数据库的查询（不在内存里，不需要维护）
+        self.tag_index = None #tag->set(path) 倒排索引，None表示还没建立
+        self.kv_index = None #tag->dict(v->set(path)) KV标签的倒排索引（值统一转成字符串）
+        self.kv_sorted = None #tag->([float],[path]) KV标签按(数值,路径)排序的值索引（两个列表一一对应）
+        self.dir_tag_cnt = None #目录key->Counter(tag->int) 每个目录里每个标签的图片数，None表示还没建立
+        self.lock = threading.RLock() #筛选线程和GUI线程共用索引和编译缓存时的互斥锁
+        self.data_version = 0 #tag_dict的版本，tag_dict每次修改都+1
+        self.filter_pool = None #多进程筛选的进程池（按需创建）
+        self.filter_deltas = None #[(path,dict)] 进程池快照之后的修改，None表示进程池需要重建
+        self.filter_pool_lock = threading.Lock() #重建进程池时的互斥锁（只有筛选线程使用，创建进程时不持有lock）
+        self.filter_pool_users = collections.Counter() #进程池->int 正在使用该进程池取结果的筛选数
+        self.retired_filter_pools = [] #已被新进程池代替、但还有筛选在使用的旧进程池
+        self.result_cache = collections.OrderedDict() #(目录key,tagStr)->(meta_version,[path]) 筛选结果缓存
+        self.result_cache_size = 0 #筛选结果缓存里的路径总数
+
+        self.reset(recover=True) #从文件载入标签数据（恢复上次未保存的修改）
 
     def updateTag(self, path, tagDict):
         '''
         tag的set操作
         args
             path: str 图片路径
-            tagDict: dict(k->v) 图片标签集
+            tagDict: dict(k->v) 图片标签集（会浅复制一份，标签值都是不可变的）
         '''
-        self.tag_dict[path] = copy.deepcopy(tagDict)
+        with self.lock:
+            self._updateTag(path, dict(tagDict))
+            self.data_version += 1
         self.is_dirty = True
 
+    def addTagToPaths(self, paths, tag, value=None):
+        '''
+        给多个图片加上同一个标签（已有该标签的只修改值）
+        args
+            paths: [str] 图片路径列表
+            tag: int 标签码
+            value: str 标签值（普通标签为None）
+        ret
+            int 标签集有变化的图片数
+        '''
+        assert tag in self.meta_tag2name, f'tag({tag}) not found'
+        changed = []
+        with self.lock:
+            for path in paths:
+                tagDict = self.tag_dict.get(path)
+                if tagDict is not None and tag in tagDict and tagDict[tag] == value:
+                    continue
+                newTagDict = {} if tagDict is None else dict(tagDict)
+                newTagDict[tag] = value
+                self._updateTag(path, newTagDict, log=False)
+                changed.append((path, newTagDict))
+            if len(changed) > 0:
+                self.storage.log_tags(changed) #整批只写一条日志记录
+                self.data_version += 1
+        if len(changed) > 0:
+            self.is_dirty = True
+        return len(changed)
+
+    def removeTagFromPaths(self, paths, tag):
+        '''
+        从多个图片里删除同一个标签
+        args
+            paths: [str] 图片路径列表
+            tag: int 标签码
+        ret
+            int 标签集有变化的图片数
+        '''
+        changed = []
+        with self.lock:
+            for path in paths:
+                tagDict = self.tag_dict.get(path)
+                if tagDict is None or tag not in tagDict:
+                    continue
+                newTagDict = {k:v for k,v in tagDict.items() if k != tag}
+                self._updateTag(path, newTagDict, log=False)
+                changed.append((path, newTagDict))
+            if len(changed) > 0:
+                self.storage.log_tags(changed) #整批只写一条日志记录
+                self.data_version += 1
+        if len(changed) > 0:
+            self.is_dirty = True
+        return len(changed)
+
+    def _updateTag(self, path, tagDict, log=True):
+        '''
+        替换一个图片的标签集，同时维护倒排索引、标签统计、日志和筛选结果缓存（调用者需持有lock，并负责data_version和脏位）
+        args
+            path: str 图片路径
+            tagDict: dict(k->v) 新的标签集（之后不会再被修改）
+            log: bool 是否写日志（批量修改时为False，由调用者用log_tags写一条记录）
+        '''
+        oldTagDict = self.tag_dict.get(path)
+        maintain_index = self.tag_index is not None and not self.index_in_db
+        if maintain_index and oldTagDict is not None:
+            self._unindex(path, oldTagDict)
+        if self.dir_tag_cnt is not None and oldTagDict is not None:
+            self._count(path, oldTagDict, -1)
+        self.tag_dict[path] = tagDict
+        if log:
+            self.storage.log_tag(path, tagDict)
+        if self.filter_deltas is not None:
+            self.filter_deltas.append((path, tagDict))
+        if maintain_index:
+            self._index(path, tagDict)
+        if self.dir_tag_cnt is not None:
+            self._count(path, tagDict, 1)
+        self._invalidateResultCache(path)
+
     def getTag(self, path):
         '''
         tag的get操作
+        返回的是只读视图，不复制（要修改时复制一份再updateTag，或用addTagToPaths/removeTagFromPaths）
         args
             path: str 图片路径
         ret 
-            dict(k->v) 图片标签集
+            MappingProxyType(k->v) 图片标签集
         '''
-        if path not in self.tag_dict:
-            return {}
+        tagDict = self.tag_dict.get(path)
+        if tagDict is None:
+            return empty_tag_set
         else:
-            return copy.deepcopy(self.tag_dict[path])
+            return types.MappingProxyType(tagDict)
 
     def getTagName(self, tag):
         '''
@@ -109,13 +657,20 @@ class TagSystem(object):
         ret
             int 新的元标签的标签码
         '''
-        fatherNode,_ = self._dfs_find(fatherTag)
-        assert fatherNode is not None, f'fatherTag({fatherTag}) not found'
-        fatherNode[1].append([self.meta_tag_cnt,[]])
-        self.meta_tag2name[self.meta_tag_cnt] = tagName
-        self.meta_tag_cnt += 1
-        self.is_dirty = True
-        return self.meta_tag_cnt - 1
+        with self.lock:
+            fatherNode,_ = self._dfs_find(fatherTag)
+            assert fatherNode is not None, f'fatherTag({fatherTag}) not found'
+            newNode = [self.meta_tag_cnt,[]]
+            fatherNode[1].append(newNode)
+            self.meta_tag2node[self.meta_tag_cnt] = newNode
+            self.meta_tag2father[self.meta_tag_cnt] = fatherNode
+            self._invalidate_tree_index()
+            self.meta_tag2name[self.meta_tag_cnt] = tagName
+            self.meta_tag_cnt += 1
+            self.meta_version += 1
+            self._log_meta()
+            self.is_dirty = True
+            return self.meta_tag_cnt - 1
 
     def removeMetaTag(self, tag):
         '''
@@ -124,12 +679,20 @@ class TagSystem(object):
         args
             tag: int 元标签的标签码
         '''
-        tagNode,fatherNode = self._dfs_find(tag)
-        assert tagNode is not None, f'tag({tag}) not found'
-        self._dfs_exec(tagNode, lambda cur_node:self.meta_tag2name.pop(cur_node[0])) #删除所有子孙
-        ix = [k for k,son_node in enumerate(fatherNode[1]) if son_node[0] == tag][0]
-        fatherNode[1].pop(ix)
-        self.is_dirty = True
+        with self.lock:
+            tagNode,fatherNode = self._dfs_find(tag)
+            assert tagNode is not None, f'tag({tag}) not found'
+            def remove(cur_node): #删除所有子孙
+                self.meta_tag2name.pop(cur_node[0])
+                self.meta_tag2node.pop(cur_node[0])
+                self.meta_tag2father.pop(cur_node[0])
+            self._dfs_exec(tagNode, remove)
+            ix = [k for k,son_node in enumerate(fatherNode[1]) if son_node[0] == tag][0]
+            fatherNode[1].pop(ix)
+            self._invalidate_tree_index()
+            self.meta_version += 1
+            self._log_meta()
+            self.is_dirty = True
 
     def moveMetaTag(self, tag, dstFatherTag, dstBigBroTag):
         '''
@@ -140,22 +703,28 @@ class TagSystem(object):
             dstFatherTag: int 目标父亲的标签码（由于根是不显示的，因此可见节点必定有父亲）
             dstBigBroTag: int 目标哥哥的标签码（如果是大哥，则该值是负数）
         '''
-        tagNode,fatherNode = self._dfs_find(tag)
-        assert tagNode is not None, f'tag({tag}) not found'
-        ix = [k for k,son_node in enumerate(fatherNode[1]) if son_node[0] == tag][0]
-        fatherNode[1].pop(ix)
-        dstFatherNode,_ = self._dfs_find(dstFatherTag)
-        assert dstFatherNode is not None, f'dstFatherTag({dstFatherTag}) not found'
-        if dstBigBroTag < 0:
-            # 自己是大哥
-            dstFatherNode[1].insert(0, tagNode)
-        else:
-            # 自己不是大哥
-            ix_bigbro = [k for k,son_node in enumerate(dstFatherNode[1]) if son_node[0] == dstBigBroTag]
-            assert len(ix_bigbro)!=0, f'dstBigBroTag({dstBigBroTag}) not found'
-            ix_bigbro = ix_bigbro[0]
-            dstFatherNode[1].insert(ix_bigbro+1, tagNode)
-        self.is_dirty = True
+        with self.lock:
+            tagNode,fatherNode = self._dfs_find(tag)
+            assert tagNode is not None, f'tag({tag}) not found'
+            dstFatherNode,_ = self._dfs_find(dstFatherTag)
+            assert dstFatherNode is not None, f'dstFatherTag({dstFatherTag}) not found'
+            assert not self.isDescendant(dstFatherTag, tag), f'cannot move tag({tag}) into its own subtree'
+            ix = [k for k,son_node in enumerate(fatherNode[1]) if son_node[0] == tag][0]
+            fatherNode[1].pop(ix)
+            if dstBigBroTag < 0:
+                # 自己是大哥
+                dstFatherNode[1].insert(0, tagNode)
+            else:
+                # 自己不是大哥
+                ix_bigbro = [k for k,son_node in enumerate(dstFatherNode[1]) if son_node[0] == dstBigBroTag]
+                assert len(ix_bigbro)!=0, f'dstBigBroTag({dstBigBroTag}) not found'
+                ix_bigbro = ix_bigbro[0]
+                dstFatherNode[1].insert(ix_bigbro+1, tagNode)
+            self.meta_tag2father[tag] = dstFatherNode
+            self._invalidate_tree_index()
+            self.meta_version += 1
+            self._log_meta()
+            self.is_dirty = True
 
     def renameMetaTag(self, tag, newName):
         '''
@@ -164,9 +733,12 @@ class TagSystem(object):
             tag: int 元标签的标签码
             newName: str 元标签的新名字
         '''
-        assert tag in self.meta_tag2name, f'tag({tag}) not found'
-        self.meta_tag2name[tag] = newName
-        self.is_dirty = True
+        with self.lock:
+            assert tag in self.meta_tag2name, f'tag({tag}) not found'
+            self.meta_tag2name[tag] = newName
+            self.meta_version += 1
+            self._log_meta()
+            self.is_dirty = True
 
     def addMetaKVTag(self, tagName, bigBroTag):
         '''
@@ -176,18 +748,21 @@ class TagSystem(object):
             bigBroTag:int 目标哥哥的标签码
         ret int 新KV元标签的标签码
         '''
-        if bigBroTag < 0:
-            # 自己是大哥
-            self.meta_kvtag_list.insert(0, self.meta_tag_cnt)
-        else:
-            # 自己不是大哥
-            ix_bigbro = self.meta_kvtag_list.index(bigBroTag)
-            assert ix_bigbro!=-1, f'bigBroTag({bigBroTag}) not found'
-            self.meta_kvtag_list.insert(ix_bigbro+1, self.meta_tag_cnt)
-        self.meta_tag2name[self.meta_tag_cnt] = tagName
-        self.meta_tag_cnt += 1
-        self.is_dirty = True
-        return self.meta_tag_cnt - 1
+        with self.lock:
+            if bigBroTag < 0:
+                # 自己是大哥
+                self.meta_kvtag_list.insert(0, self.meta_tag_cnt)
+            else:
+                # 自己不是大哥
+                ix_bigbro = self.meta_kvtag_list.index(bigBroTag)
+                assert ix_bigbro!=-1, f'bigBroTag({bigBroTag}) not found'
+                self.meta_kvtag_list.insert(ix_bigbro+1, self.meta_tag_cnt)
+            self.meta_tag2name[self.meta_tag_cnt] = tagName
+            self.meta_tag_cnt += 1
+            self.meta_version += 1
+            self._log_meta()
+            self.is_dirty = True
+            return self.meta_tag_cnt - 1
 
     def removeKVTag(self, tag):
         '''
@@ -195,10 +770,13 @@ class TagSystem(object):
         args
             tag:int 目标元标签的标签码
         '''
-        ix = self.meta_kvtag_list.index(tag)
-        assert ix!=-1, f'tag({tag}) not found'
-        self.meta_kvtag_list.pop(ix)
-        self.is_dirty = True
+        with self.lock:
+            ix = self.meta_kvtag_list.index(tag)
+            assert ix!=-1, f'tag({tag}) not found'
+            self.meta_kvtag_list.pop(ix)
+            self.meta_version += 1
+            self._log_meta()
+            self.is_dirty = True
 
     def moveMetaKVTag(self, tag, dstBigBroTag):
         '''
@@ -207,20 +785,23 @@ class TagSystem(object):
             tag:int 目标元标签的标签码
             dstBigBrotag:int 目标哥哥的标签码
         '''
-        ix = self.meta_kvtag_list.index(tag)
-        assert ix!=-1, f'tag({tag}) not found'
-        self.meta_kvtag_list.pop(ix)
+        with self.lock:
+            ix = self.meta_kvtag_list.index(tag)
+            assert ix!=-1, f'tag({tag}) not found'
+            self.meta_kvtag_list.pop(ix)
 
-        if dstBigBroTag < 0:
-            # 自己是大哥
-            self.meta_kvtag_list.insert(0, tag)
-        else:
-            # 自己不是大哥
-            ix_bigbro = self.meta_kvtag_list.index(dstBigBroTag)
-            assert ix_bigbro!=-1, f'dstBigBroTag({dstBigBroTag}) not found'
-            self.meta_kvtag_list.insert(ix_bigbro+1, tag)
+            if dstBigBroTag < 0:
+                # 自己是大哥
+                self.meta_kvtag_list.insert(0, tag)
+            else:
+                # 自己不是大哥
+                ix_bigbro = self.meta_kvtag_list.index(dstBigBroTag)
+                assert ix_bigbro!=-1, f'dstBigBroTag({dstBigBroTag}) not found'
+                self.meta_kvtag_list.insert(ix_bigbro+1, tag)
 
-        self.is_dirty = True
+            self.meta_version += 1
+            self._log_meta()
+            self.is_dirty = True
 
     def renameMetaKVTag(self, tag, newName):
         '''
@@ -231,26 +812,78 @@ class TagSystem(object):
         '''
         return self.renameMetaTag(tag, newName)
 
+    def _log_meta(self):
+        '''
+        把元标签的修改记进日志
+        '''
+        self.storage.log_meta([self.meta_tag_cnt,self.meta_tag_tree,self.meta_kvtag_list,self.meta_tag2name])
+
     def _dfs_find(self, tag):
         '''
-        在标签树上搜索元标签
+        在标签树上查找元标签（通过标签树索引，不用遍历）
         args
             tag:int 目标元标签的标签码
         ret (node,node) 返回目标标签的节点，以及它的父亲。没找到则返回(None,None)
         '''
-        ret = (None,None)
-        def dfs(cur_node,fa_node):
-            if cur_node[0] == tag:
-                nonlocal ret
-                ret = (cur_node,fa_node)
-                return True
-            for son_node in cur_node[1]:
-                if dfs(son_node,cur_node):
-                    return True
+        return self.meta_tag2node.get(tag), self.meta_tag2father.get(tag)
+
+    def isDescendant(self, tag, ancestorTag):
+        '''
+        判断元标签是否在另一个元标签的子树里（自己也算在自己的子树里）
+        args
+            tag:int 待判断的元标签的标签码
+            ancestorTag:int 子树的根的标签码
+        ret
+            bool 是否在子树里
+        '''
+        if self.meta_euler is None:
+            self._build_euler()
+        if tag not in self.meta_euler or ancestorTag not in self.meta_euler:
             return False
+        tin,tout = self.meta_euler[tag]
+        anc_tin,anc_tout = self.meta_euler[ancestorTag]
+        return anc_tin <= tin and tout <= anc_tout
 
-        ans = dfs(self.meta_tag_tree,None)
-        return ret
+    def _build_tree_index(self):
+        '''
+        根据标签树重建标签树索引（载入标签文件后调用）
+        '''
+        self.meta_tag2node = {}
+        self.meta_tag2father = {}
+        stack = [(self.meta_tag_tree,None)]
+        while len(stack) > 0:
+            cur_node,fa_node = stack.pop()
+            self.meta_tag2node[cur_node[0]] = cur_node
+            self.meta_tag2father[cur_node[0]] = fa_node
+            for son_node in cur_node[1]:
+                stack.append((son_node,cur_node))
+        self._invalidate_tree_index()
+
+    def _invalidate_tree_index(self):
+        '''
+        标签树结构修改后，让欧拉序区间和子树标签集合的缓存失效
+        '''
+        self.meta_euler = None
+        self.meta_subtree = {}
+
+    def _build_euler(self):
+        '''
+        计算标签树的欧拉序区间（非递归，避免树太深时栈溢出）
+        子孙的区间包含在祖先的区间里
+        '''
+        self.meta_euler = {}
+        clock = 0
+        stack = [(self.meta_tag_tree,False)]
+        while len(stack) > 0:
+            cur_node,leaving = stack.pop()
+            if leaving:
+                self.meta_euler[cur_node[0]] = (self.meta_euler[cur_node[0]], clock)
+                continue
+            self.meta_euler[cur_node[0]] = clock #先记进入序号，离开时再组成区间
+            clock += 1
+            stack.append((cur_node,True))
+            for son_node in reversed(cur_node[1]):
+                stack.append((son_node,False))
 
     def _dfs_exec(self, node, func):
         '''
@@ -273,33 +906,86 @@ class TagSystem(object):
         将数据保存到文件里
         '''
         data = [self.meta_tag_cnt,self.meta_tag_tree,self.meta_kvtag_list,self.meta_tag2name,self.tag_dict]
-        os.makedirs(self.tag_filedir, exist_ok=True)
-        pickle.dump(data, open(os.path.join(self.tag_filedir,'tag.pkl'),'wb'))
+        self.storage.save(data)
         self.is_dirty = False
 
     def auto_save(self):
         '''
         自动保存数据
-        和save的区别主要是路径上加上了时间
+        和save的区别主要是以时间为名字保存在snapshots目录里（只保存变化的部分，超出保留策略的自动删除）
+        上次自动保存之后数据没修改过则跳过；和最新的自动保存内容相同时也不会写新的清单
         '''
+        self.snapshots.import_legacy(self.tag_filedir) #以前版本的tag_{time}.pkl，导入一次后删除
+        version = (self.data_version, self.meta_version)
+        if version == self.snapshot_version:
+            return
         data = [self.meta_tag_cnt,self.meta_tag_tree,self.meta_kvtag_list,self.meta_tag2name,self.tag_dict]
         time_str = datetime.datetime.strftime(datetime.datetime.now(), "%Y_%m_%d_%H_%M_%S")
-        auto_save_path = os.path.join(self.tag_filedir,f'tag_{time_str}.pkl')
-        os.makedirs(self.tag_filedir, exist_ok=True)
-        pickle.dump(data, open(auto_save_path,'wb'))
+        self.snapshots.save(data, time_str)
+        self.snapshot_version = version
+
+    def listSnapshots(self):
+        '''
+        列出保留的自动保存
+        ret
+            [str] 自动保存的名字（时间串），从旧到新
+        '''
+        return self.snapshots.names()
 
-    def reset(self):
+    def restoreSnapshot(self, name):
+        '''
+        把数据恢复成某个自动保存
+        恢复结果是未保存的修改（只改动和当前数据不同的图片），需要save才会写进标签文件，reset可以撤销
+        args
+            name:str 自动保存的名字
+        '''
+        data = self.snapshots.load(name)
+        with self.lock:
+            self.meta_tag_cnt,self.meta_tag_tree,self.meta_kvtag_list,self.meta_tag2name = data[:4]
+            self._build_tree_index()
+            self.meta_version += 1
+            self._log_meta()
+            new_tag_dict = data[4]
+            changed = [(path, None) for path in self.tag_dict if path not in new_tag_dict]
+            for path,_ in changed:
+                self.tag_dict.pop(path)
+            for path,tagDict in new_tag_dict.items():
+                if self.tag_dict.get(path) != tagDict:
+                    self.tag_dict[path] = tagDict
+                    changed.append((path, tagDict))
+            if len(changed) > 0:
+                self.storage.log_tags(changed)
+            self.tag_index = self.kv_index = self.kv_sorted = None #倒排索引在下次筛选时重建
+            self.filter_deltas = None #多进程筛选的进程池在下次筛选时重建
+            self.dir_tag_cnt = None #标签统计在下次统计时重建
+            self.data_version += 1
+            self.result_cache.clear() #筛选结果缓存全部失效
+            self.result_cache_size = 0
+        self.is_dirty = True
+
+    def reset(self, recover=False):
         '''
         重设数据
         save的逆操作，从文件里读取数据
+        args
+            recover:bool 是否恢复上次未保存的修改（启动时为True，恢复了修改则脏位为脏）
         '''
-        # 如果没有该文件，则保存
-        if not os.path.exists(os.path.join(self.tag_filedir,'tag.pkl')):
-            self.save()
-            return
-        data = pickle.load(open(os.path.join(self.tag_filedir,'tag.pkl'),'rb'))
-        self.meta_tag_cnt,self.meta_tag_tree,self.meta_kvtag_list,self.meta_tag2name,self.tag_dict = data
-        self.is_dirty = False
+        with self.lock:
+            data = self.storage.load(recover)
+            # 如果没有该文件，则保存
+            if data is None:
+                self.save()
+                return
+            self.meta_tag_cnt,self.meta_tag_tree,self.meta_kvtag_list,self.meta_tag2name,self.tag_dict = data
+            self._build_tree_index()
+            self.meta_version += 1
+            self.tag_index = self.kv_index = self.kv_sorted = None #倒排索引在下次筛选时重建
+            self.filter_deltas = None #多进程筛选的进程池在下次筛选时重建
+            self.dir_tag_cnt = None #标签统计在下次统计时重建
+            self.data_version += 1
+            self.result_cache.clear() #筛选结果缓存全部失效
+            self.result_cache_size = 0
+            self.is_dirty = self.storage.recovered
 
     def cleanData(self):
         '''
@@ -308,25 +994,32 @@ class TagSystem(object):
             1. 文件不存在，但tag_dict里还有该文件数据
             2. 元标签不存在，但tag_dict里某些文件还有对应的标签数据
         '''
-        remove_paths = []
-        for path in self.tag_dict:
-            if not os.path.exists(path):
-                remove_paths.append(path)
-            else:
-                remove_tags = []
-                for tag in self.tag_dict[path]:
-                    if tag not in self.meta_tag2name:
-                        remove_tags.append(tag)
-                for tag in remove_tags:
-                    self.tag_dict[path].pop(tag)
-                if len(self.tag_dict[path]) == 0: #删到没有标签了
+        with self.lock:
+            remove_paths = []
+            update_paths = {}
+            for path,tagDict in self.tag_dict.items():
+                if not os.path.exists(path):
                     remove_paths.append(path)
-                if len(remove_tags) > 0:
-                    self.is_dirty = True
-        for path in remove_paths:
-            self.tag_dict.pop(path)
-        if len(remove_paths) > 0:
-            self.is_dirty = True
+                else:
+                    newTagDict = {tag:v for tag,v in tagDict.items() if tag in self.meta_tag2name}
+                    if len(newTagDict) == 0: #删到没有标签了
+                        remove_paths.append(path)
+                    elif len(newTagDict) < len(tagDict):
+                        update_paths[path] = newTagDict
+            for path,tagDict in update_paths.items(): #重新赋值（sqlite时取出的标签集是副本，原地修改不会写回）
+                self.tag_dict[path] = tagDict
+            for path in remove_paths:
+                self.tag_dict.pop(path)
+            if len(remove_paths) > 0 or len(update_paths) > 0:
+                self.storage.log_tags(list(update_paths.items()) + [(path, None) for path in remove_paths])
+            if len(remove_paths) > 0 or len(update_paths) > 0:
+                self.is_dirty = True
+            self.tag_index = self.kv_index = self.kv_sorted = None #倒排索引在下次筛选时重建
+            self.filter_deltas = None #多进程筛选的进程池在下次筛选时重建
+            self.dir_tag_cnt = None #标签统计在下次统计时重建
+            self.data_version += 1
+            self.result_cache.clear() #筛选结果缓存全部失效
+            self.result_cache_size = 0
 
     def printMetaTagTree(self):
         '''
@@ -347,163 +1040,442 @@ class TagSystem(object):
             tagStr:str 标签筛选串
         ret [str] 符合筛选要求的路径列表
         '''
-        paths = self._filterImageByPath(pathStr)
-        paths = self._filterImageByTagExp(paths, tagStr)
+        return [path for batch in self.iterFilterImage(pathStr, tagStr) for path in batch]
+
+    def iterFilterImage(self, pathStr, tagStr):
+        '''
+        流式的标签筛选（生成器），边遍历边分批产出结果
+        每批最多filter_batch_size个路径，距离上一批超过filter_batch_interval秒时也会产出（可能是空批）
+        结果缓存里有的话直接分批产出缓存结果，完整执行完的结果会加入缓存
+        args
+            pathStr:str 路径串
+            tagStr:str 标签筛选串
+        ret
+            generator([str]) 每次产出一批符合筛选要求的路径
+        '''
+        key = (os.path.normcase(os.path.abspath(pathStr)), tagStr)
+        with self.lock:
+            ret_paths = self._getResultCache(key)
+            meta_version,data_version = self.meta_version,self.data_version
+        if ret_paths is not None:
+            for i in range(0, len(ret_paths), filter_batch_size):
+                yield ret_paths[i:i+filter_batch_size]
+            return
+
+        ret_paths = []
+        for batch in self._iterFilterImage(pathStr, tagStr):
+            ret_paths += batch
+            yield batch
+        with self.lock:
+            if self.meta_version == meta_version and self.data_version == data_version: #执行期间没被修改过
+                self._putResultCache(key, meta_version, ret_paths)
+
+    def _getResultCache(self, key):
+        '''
+        获取缓存的筛选结果（调用者需持有lock）
+        args
+            key:(str,str) 目录key和筛选串
+        ret
+            [str] 筛选结果（没有或已失效则为None）
+        '''
+        if key not in self.result_cache:
+            return None
+        meta_version,paths = self.result_cache[key]
+        if meta_version != self.meta_version: #元标签修改过
+            self._popResultCache(key)
+            return None
+        self.result_cache.move_to_end(key)
         return paths
 
-    def _filterImageByPath(self, pathStr):
+    def _putResultCache(self, key, meta_version, paths):
+        '''
+        缓存筛选结果，超过路径总数上限时淘汰最久没用的结果（调用者需持有lock）
+        args
+            key:(str,str) 目录key和筛选串
+            meta_version:int 筛选时的元标签版本
+            paths:[str] 筛选结果
+        '''
+        if len(paths) > result_cache_paths: #太大的结果不缓存
+            return
+        if key in self.result_cache:
+            self._popResultCache(key)
+        self.result_cache[key] = (meta_version, paths)
+        self.result_cache_size += len(paths)
+        while self.result_cache_size > result_cache_paths:
+            self._popResultCache(next(iter(self.result_cache)))
+
+    def _popResultCache(self, key):
+        '''
+        删除一个缓存的筛选结果（调用者需持有lock）
+        args
+            key:(str,str) 目录key和筛选串
+        '''
+        _,paths = self.result_cache.pop(key)
+        self.result_cache_size -= len(paths)
+
+    def _invalidateResultCache(self, path):
+        '''
+        图片的标签被修改后，删除路径目录包含该图片的缓存结果（调用者需持有lock）
+        args
+            path:str 图片路径
+        '''
+        if len(self.result_cache) == 0:
+            return
+        npath = os.path.normcase(os.path.abspath(path))
+        for key in [key for key in self.result_cache if npath.startswith(os.path.join(key[0], ''))]:
+            self._popResultCache(key)
+
+    def _iterFilterImage(self, pathStr, tagStr):
+        '''
+        iterFilterImage的实现（不经过结果缓存）
+        args
+            pathStr:str 路径串
+            tagStr:str 标签筛选串
+        ret
+            generator([str]) 每次产出一批符合筛选要求的路径
+        '''
+        with self.lock:
+            pathFilter,ast,func = self._compileTagStr(tagStr)
+            if ast is not None:
+                self._build_index()
+                select_paths,neg = eval_tag_ast(ast, self.tag_index, self.kv_index, self._subtree_tags, self.kv_sorted)
+                select_paths = set(select_paths) if neg else sorted(select_paths) #复制一份，之后不再持有锁
+
+        prune = pathFilter.prune if pathFilter is not None else None #遍历目录时跳过不可能符合路径筛选串的子树
+        dir_paths = None #遍历目录得到的路径
+        if self.filter_workers != 1 and (ast is None and pathFilter is not None or ast is not None and neg):
+            # 需要遍历目录且每个路径都要计算时，交给进程池（补集的判断等价于在快照上计算语法树）
+            dir_paths = self._iterImageByPath(pathStr, prune)
+            head = list(itertools.islice(dir_paths, filter_parallel_min))
+            if len(head) == filter_parallel_min:
+                yield from self._iterFilterParallel(self._chunk(itertools.chain(head, dir_paths)), pathFilter, ast)
+                return
+            dir_paths = head #路径少，在当前线程计算
+        elif ast is None or neg:
+            dir_paths = self._iterImageByPath(pathStr, prune)
+        if ast is None: #没有标签筛选，只能遍历目录
+            paths = dir_paths
+        elif neg: #结果是补集，需要遍历目录，再去掉补集里的路径
+            paths = (path for path in dir_paths if path not in select_paths)
+        else: #结果是集合，只检查集合里的路径
+            paths = self._iterImageInDir(select_paths, pathStr)
+
+        batch = []
+        last_time = time.time()
+        for path in paths:
+            if pathFilter is None or pathFilter.match(path): #路径筛选
+                batch.append(path)
+            if len(batch) >= filter_batch_size or time.time()-last_time >= filter_batch_interval:
+                yield batch
+                batch = []
+                last_time = time.time()
+        if len(batch) > 0:
+            yield batch
+
+    def _iterImageInDir(self, paths, pathStr):
+        '''
+        从给定的路径里选出在路径目录下（包括子孙目录）且存在的图片文件（生成器）
+        结果和_filterImageByPath的结果取交集相同，但不用遍历目录
+        args
+            paths:[str] 图片路径列表
+            pathStr:str 路径串
+        ret generator(str) 符合筛选要求的路径
+        '''
+        root = os.path.join(os.path.normcase(os.path.abspath(pathStr)), '')
+        for path in paths:
+            if not os.path.normcase(os.path.abspath(path)).startswith(root):
+                continue
+            if os.path.splitext(path)[1] not in self.img_extnames:
+                continue
+            if self.catalog.hasFile(path) if self.catalog is not None else os.path.isfile(path):
+                yield path
+
+    def _filterImageByPath(self, pathStr, prune=None):
         '''
         查找路径目录里的所有子孙图片文件
         args
             pathStr:str 路径串
+            prune:func(str)->bool 判断是否跳过某个目录的整棵子树（None表示不跳过）
         ret [str] 符合筛选要求的路径列表
         '''
-        ret_paths = []
+        return list(self._iterImageByPath(pathStr, prune))
+
+    def _iterImageByPath(self, pathStr, prune=None):
+        '''
+        查找路径目录里的所有子孙图片文件（生成器）
+        args
+            pathStr:str 路径串
+            prune:func(str)->bool 判断是否跳过某个目录的整棵子树（None表示不跳过）
+        ret generator(str) 图片路径
+        '''
+        if self.catalog is not None: #从目录记录里读取，只重新扫描变化了的目录
+            yield from self.catalog.iterImages(pathStr, prune)
+            return
+        if prune is not None and prune(pathStr):
+            return
         for cur_dir,dirs,files in os.walk(pathStr): #注意不单是本目录，还包括子孙目录的图片文件
+            if prune is not None:
+                dirs[:] = [k for k in dirs if not prune(os.path.join(cur_dir, k))] #原地修改，os.walk不会进入被跳过的目录
             for file in files:
                 if os.path.splitext(file)[1] in self.img_extnames:
-                    ret_paths.append(os.path.join(cur_dir, file))
-        return ret_paths
+                    yield os.path.join(cur_dir, file)
 
     def _filterImageByTagExp(self, paths, tagStr):
         '''
         筛选符合标签筛选串的所有图片文件
         先进行路径筛选，再进行标签筛选
-        路径筛选使用正则表达式模块计算，标签筛选使用逆波兰表达式计算
+        路径筛选使用正则表达式模块计算，标签筛选使用编译好的闭包计算
         args
             paths: [str] 路径目录给出的所有图片文件的路径
             tagStr:str 标签筛选串
         ret [str] 符合筛选要求的路径列表
         '''
-        # 特判空串（路径和标签都空）
-        if tagStr == "":
+        with self.lock:
+            pathFilter,ast,func = self._compileTagStr(tagStr)
+        if self.filter_workers != 1 and (pathFilter is not None or ast is not None) and len(paths) >= filter_parallel_min:
+            return [path for batch in self._iterFilterParallel(self._chunk(paths), pathFilter, ast) for path in batch]
+        if pathFilter is not None:
+            paths = self._filterImageByPathExp(paths, pathFilter) #路径筛选
+        if func is None: #标签空
             return paths
 
+        tag_dict = self.tag_dict
+        empty = {}
+        return [path for path in paths if func(tag_dict.get(path, empty))]
+
+    def _iterFilterParallel(self, chunks, pathFilter, ast):
+        '''
+        多进程筛选（生成器），按分块顺序产出每个分块的筛选结果
+        args
+            chunks:iter([str]) 路径分块
+            pathFilter:PathFilter 编译好的路径筛选串（没有则为None）
+            ast:tuple 标签筛选的语法树（没有则为None）
+        ret
+            generator([str]) 每个分块里符合筛选要求的路径
+        '''
+        pool,deltas = self._get_filter_pool()
+        with self.lock:
+            subtree = {tag:self._subtree_tags(tag) for tag in ast_exist_tags(ast)} if ast is not None else {}
+            meta_version = self.meta_version
+        try:
+            pathFilterStr = pathFilter.pathFilterStr if pathFilter is not None else None
+            max_pending = 2 * (self.filter_workers if self.filter_workers > 0 else os.cpu_count()) #同时在计算的分块数上限
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append((chunk, pool.apply_async(filter_chunk, ((pathFilterStr, ast, subtree, meta_version, deltas, chunk),))))
+                while len(pending) >= max_pending or len(pending) > 0 and pending[0][1].ready():
+                    chunk,ret = pending.popleft()
+                    yield [chunk[i] for i in ret.get()]
+            while len(pending) > 0:
+                chunk,ret = pending.popleft()
+                yield [chunk[i] for i in ret.get()]
+        finally: #取完结果或被取消（生成器被关闭）
+            with self.lock:
+                self.filter_pool_users[pool] -= 1
+                if self.filter_pool_users[pool] == 0:
+                    del self.filter_pool_users[pool]
+                    if pool in self.retired_filter_pools: #已被代替的旧进程池没人用了才结束
+                        self.retired_filter_pools.remove(pool)
+                        pool.terminate()
+
+    def _get_filter_pool(self):
+        '''
+        获取多进程筛选的进程池以及快照之后的修改，并登记为使用者（调用者不能持有lock，用完要减掉filter_pool_users）
+        修改太多或数据被整体替换过时用新的快照重建；只在lock里复制tag_dict，创建进程时不持有lock，不阻塞GUI线程的修改
+        旧进程池还有筛选在使用时先留在retired_filter_pools里，等它们结束再结束
+        ret
+            multiprocessing.Pool 进程池
+            [(str,dict)] 快照之后的修改
+        '''
+        with self.filter_pool_lock:
+            with self.lock:
+                if self.filter_pool is not None and self.filter_deltas is not None and len(self.filter_deltas) <= filter_delta_max:
+                    self.filter_pool_users[self.filter_pool] += 1
+                    return self.filter_pool, list(self.filter_deltas)
+                snapshot = dict(self.tag_dict.items())
+                self.filter_deltas = [] #之后的修改都记在这里
+            workers = self.filter_workers if self.filter_workers > 0 else None
+            pool = multiprocessing.Pool(workers, initializer=init_filter_worker, initargs=(snapshot,))
+            old_pool = None
+            with self.lock:
+                if self.filter_pool is not None:
+                    if self.filter_pool in self.filter_pool_users:
+                        self.retired_filter_pools.append(self.filter_pool)
+                    else:
+                        old_pool = self.filter_pool
+                self.filter_pool = pool
+                self.filter_pool_users[pool] += 1
+                deltas = list(self.filter_deltas) if self.filter_deltas is not None else []
+            if old_pool is not None:
+                old_pool.terminate()
+            return pool, deltas
+
+    def _chunk(self, paths):
+        '''
+        把路径按filter_chunk_size分块（生成器）
+        args
+            paths:iter(str) 路径
+        ret
+            generator([str]) 路径分块
+        '''
+        it = iter(paths)
+        while True:
+            chunk = list(itertools.islice(it, filter_chunk_size))
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+    def close(self):
+        '''
+        程序关闭时的处理，结束多进程筛选的进程池，关闭标签文件
+        '''
+        with self.lock:
+            for pool in self.retired_filter_pools:
+                pool.terminate()
+            self.retired_filter_pools = []
+            if self.filter_pool is not None:
+                self.filter_pool.terminate()
+                self.filter_pool = None
+        self.storage.close()
+
+    def _compileTagStr(self, tagStr):
+        '''
+        编译标签筛选串（带缓存）
+        args
+            tagStr:str 标签筛选串
+        ret
+            (PathFilter,tuple,func) 编译好的路径筛选串（没有则为None），标签筛选的语法树和闭包（标签为空串时为None）
+        '''
+        key = (tagStr, self.meta_version)
+        if key in self.plan_cache:
+            self.plan_cache.move_to_end(key)
+            return self.plan_cache[key]
+
+        pathFilter = None
+        tagExp = tagStr
         # 判断是否有路径筛选串
-        if tagStr[0] == '{':
-            ix = tagStr.find('}')
+        if tagExp[:1] == '{':
+            ix = tagExp.find('}')
             assert ix!=-1, f'invalid tagStr({tagStr})'
-            paths = self._filterImageByPathExp(paths, tagStr[1:ix]) #路径筛选
-            tagStr = tagStr[ix+1:]
+            pathFilter = PathFilter(tagExp[1:ix])
+            tagExp = tagExp[ix+1:]
 
-        #特判空串（标签空）
-        if tagStr == "":
-            return paths
+        ast = func = None
+        if tagExp != "":
+            name2tag = {name:tag for tag,name in self.meta_tag2name.items()} #tag2name的逆映射
+            ast = parse_tag_exp(tagExp, name2tag)
+            func = compile_tag_ast(ast, self._subtree_tags)
 
-        name2tag = {name:tag for tag,name in self.meta_tag2name.items()} #tag2name的逆映射，下面算法会用到
-
-        # 中序表达式转后缀表达式（逆波兰表达式）
-        tagStr = tagStr + '#' #用于保证表达式结束
-        s1 = []
-        s2 = []
-        ibeg = 0
-        while ibeg < len(tagStr):
-            if tagStr[ibeg] in op_chs: #运算符
-                # 先确定运算符长度
-                if tagStr[ibeg] in ['=','!'] and ibeg+1<len(tagStr) and tagStr[ibeg+1]=='=':
-                    iend = ibeg + 2
-                else:
-                    iend = ibeg + 1
-                op = tagStr[ibeg:iend]
-                # 判断运算符类型
-                if op == '(': # (
-                    s1.append([1,op])
-                elif op == ')': # )
-                    while s1[-1][1] != '(':
-                        s2.append(s1[-1])
-                        s1.pop()
-                else: # & | ! ` == !=
-                    while len(s1)>0 and op_adv[s1[-1][1]]>=op_adv[op]:
-                        s2.append(s1[-1])
-                        s1.pop()
-                    s1.append([1,op])
-                ibeg = iend
-            else: #标签或值
-                iend = ibeg + 1
-                while iend < len(tagStr) and tagStr[iend] not in op_chs:
-                    iend += 1
-                s2.append([0,name2tag[tagStr[ibeg:iend]]]) #名字转标签码
-                ibeg = iend
-        s2.append([1,'#']) #最后的#是不会进入s2的，要补充
+        self.plan_cache[key] = (pathFilter, ast, func)
+        if len(self.plan_cache) > plan_cache_size:
+            self.plan_cache.popitem(False)
+        return pathFilter, ast, func
 
-        #计算逆波兰表达式的值
-        ret_paths = []
-        for path in paths: #对每个路径单独计算布尔值
-            s = []
-            for code,item in s2:
-                if code == 0: #标签或值
-                    s.append([item]) #先用列表形式，因为不确定是标签还是值，要等实际运算时才能进行正确转换
-                else: #运算符
-                    if item == '`': #特判存在运算符
-                        num1 = s.pop()
-                        val1 = self._calc_exist(path, num1[0]) if isinstance(num1, list) else num1
-                        s.append(val1)
-                    elif item in ['!','#']: #单目运算符
-                        num1 = s.pop()
-                        val1 = path in self.tag_dict and num1[0] in self.tag_dict[path] if isinstance(num1, list) else num1 #如果是标签，则转为值
-                        s.append(op_func[item](val1))
-                    else: #双目运算符
-                        num2 = s.pop()
-                        num1 = s.pop()
-                        if item in ['==','!=']: #要求==和!=的左边是标签，右边是值
-                            if isinstance(num1, list):
-                                if path in self.tag_dict and num1[0] in self.tag_dict[path]:
-                                    val1 = self.tag_dict[path][num1[0]]
-                                else:
-                                    val1 = None
-                            else:
-                                val1 = num1
-                            val2 = num2[0]
-                        else: #其他双目运算符则要求两边都是标签
-                            val1 = path in self.tag_dict and num1[0] in self.tag_dict[path] if isinstance(num1, list) else num1
-                            val2 = path in self.tag_dict and num2[0] in self.tag_dict[path] if isinstance(num2, list) else num2
-                        s.append(op_func[item](val1,val2))
-
-            # 判断结果
-            if s[0]:
-                ret_paths.append(path)
-        
-        return ret_paths
-
-    def _filterImageByPathExp(self, paths, pathFilterStr):
+    def _build_index(self):
+        '''
+        建立倒排索引（已建立则直接返回），sqlite时只取得对数据库的查询
+        '''
+        with self.lock:
+            if self.tag_index is not None:
+                return
+            if self.index_in_db:
+                self.tag_index,self.kv_index,self.kv_sorted = self.storage.index(kv_number)
+                return
+            self.tag_index = {}
+            self.kv_index = {}
+            self.kv_sorted = {}
+            kv_items = {} #tag->[(float,path)] 先收集，最后每个标签排序一次，不用逐个插入
+            for path,tagDict in self.tag_dict.items():
+                self._index(path, tagDict, kv_items)
+            for tag,items in kv_items.items():
+                items.sort()
+                self.kv_sorted[tag] = ([num for num,_ in items], [path for _,path in items])
+
+    def _index(self, path, tagDict, kv_items=None):
+        '''
+        把一个图片的标签加入倒排索引
+        args
+            path:str 图片路径
+            tagDict:dict(k->v) 图片标签集
+            kv_items:dict(tag->[(float,str)]) 建立索引时收集KV标签数值的字典（None表示直接插入kv_sorted）
+        '''
+        for tag,v in tagDict.items():
+            self.tag_index.setdefault(tag, set()).add(path)
+            if v is not None:
+                self.kv_index.setdefault(tag, {}).setdefault(str(v), set()).add(path)
+                num = kv_number(v)
+                if num is None:
+                    continue
+                if kv_items is not None:
+                    kv_items.setdefault(tag, []).append((num, path))
+                    continue
+                nums,paths = self.kv_sorted.setdefault(tag, ([],[]))
+                ix = self._kv_sorted_pos(nums, paths, num, path)
+                nums.insert(ix, num)
+                paths.insert(ix, path)
+
+    def _unindex(self, path, tagDict):
+        '''
+        把一个图片的标签从倒排索引里删除
+        args
+            path:str 图片路径
+            tagDict:dict(k->v) 图片原来的标签集
+        '''
+        for tag,v in tagDict.items():
+            self.tag_index[tag].discard(path)
+            if v is not None:
+                self.kv_index[tag][str(v)].discard(path)
+                num = kv_number(v)
+                if num is not None:
+                    nums,paths = self.kv_sorted[tag]
+                    ix = self._kv_sorted_pos(nums, paths, num, path)
+                    assert paths[ix] == path, f'{path} not in kv_sorted of tag({tag})'
+                    nums.pop(ix)
+                    paths.pop(ix)
+
+    def _kv_sorted_pos(self, nums, paths, num, path):
+        '''
+        二分查找(num,path)在KV标签值索引里的位置（值索引按(数值,路径)排序）
+        先找到数值相同的一段，同一数值的路径是有序的，再在这一段里二分查找路径
+        args
+            nums:[float] 值索引的数值列表
+            paths:[str] 值索引的路径列表
+            num:float 数值
+            path:str 图片路径
+        ret
+            int 该项所在（或应插入）的位置
+        '''
+        lo = bisect.bisect_left(nums, num)
+        hi = bisect.bisect_right(nums, num, lo)
+        return bisect.bisect_left(paths, path, lo, hi)
+
+    def _filterImageByPathExp(self, paths, pathFilter):
         '''
         路径筛选
-        使用正则表达式模块计算
+        使用编译好的正则表达式计算，先用必须出现的字面量排除
         args
             paths: [str] 路径目录给出的所有图片文件的路径
-            pathFilterStr:str 路径筛选串
+            pathFilter:PathFilter 编译好的路径筛选串
         ret [str] 符合筛选要求的路径列表
         '''
-        ret_paths = []
-        for path in paths:
-            ma = re.search(pathFilterStr, path)
-            if ma is not None:
-                ret_paths.append(path)
-        return ret_paths
+        return [path for path in paths if pathFilter.match(path)]
 
-    def _calc_exist(self, path, tag):
+    def _subtree_tags(self, tag):
         '''
-        标签筛选中的“存在”运算符的对应计算函数
-        枚举tag为根的子树中所有结点，假如存在一个结点为True，则返回True
+        获取以某个元标签为根的子树中所有元标签（用于“存在”运算符）
+        结果会缓存起来，标签树修改后失效
         args
-            path:str 待判断的图片
             tag:int 目标tag
         ret
-            bool “存在”运算的结果
+            frozenset(int) 子树中所有元标签的标签码
         '''
-        if path not in self.tag_dict:
-            return False
-
-        def dfs(cur_node):
-            if cur_node[0] in self.tag_dict[path]:
-                return True
-            for son_node in cur_node[1]:
-                if dfs(son_node):
-                    return True
-            return False
-        
-        node,fa_node = self._dfs_find(tag)
-        return dfs(node)
+        if tag not in self.meta_subtree:
+            node,fa_node = self._dfs_find(tag)
+            assert node is not None, f'tag({tag}) not found'
+            tags = set()
+            self._dfs_exec(node, lambda cur_node:tags.add(cur_node[0]))
+            self.meta_subtree[tag] = frozenset(tags)
+        return self.meta_subtree[tag]
     
     def calc_tag_cnt(self, rootpath, tag):
         '''
@@ -514,10 +1486,58 @@ class TagSystem(object):
         ret
             int 出现该tag的数量
         '''
-        cnt = 0
-        for path,tagSet in self.tag_dict.items():
-            if rootpath not in path:
+        cnts,_ = self.countTags(rootpath)
+        return cnts.get(tag, 0)
+
+    def countTags(self, rootpath):
+        '''
+        统计某个目录（包括子孙目录）下的所有图片中每个标签出现的数量，以及标签树每棵子树的总数
+        args
+            rootpath:str 目录路径
+        ret
+            (dict(int->int),dict(int->int)) 标签码->数量，标签码->以它为根的子树里所有标签的数量之和
+        '''
+        with self.lock:
+            if self.dir_tag_cnt is None:
+                self.dir_tag_cnt = {}
+                for path,tagDict in self.tag_dict.items():
+                    self._count(path, tagDict, 1)
+
+        root = os.path.normcase(os.path.abspath(rootpath))
+        prefix = os.path.join(root, '')
+        cnts = collections.Counter()
+        for dir_key,dir_cnt in self.dir_tag_cnt.items():
+            if dir_key == root or dir_key.startswith(prefix):
+                cnts.update(dir_cnt)
+
+        # 子树总数（后序累加，非递归）
+        totals = {}
+        stack = [(self.meta_tag_tree,False)]
+        while len(stack) > 0:
+            cur_node,leaving = stack.pop()
+            if leaving:
+                totals[cur_node[0]] = cnts.get(cur_node[0], 0) + sum(totals[son_node[0]] for son_node in cur_node[1])
                 continue
-            if tag in tagSet:
-                cnt += 1
-        return cnt
+            stack.append((cur_node,True))
+            for son_node in cur_node[1]:
+                stack.append((son_node,False))
+        return dict(cnts),totals
+
+    def _count(self, path, tagSet, delta):
+        '''
+        把一个图片的标签计入（或移出）所在目录的标签统计
+        args
+            path:str 图片路径
+            tagSet:dict(k->v) 图片标签集
+            delta:int 1为计入，-1为移出
+        '''
+        if not tagSet:
+            return
+        dir_key = os.path.normcase(os.path.dirname(os.path.abspath(path)))
+        dir_cnt = self.dir_tag_cnt.setdefault(dir_key, collections.Counter())
+        for tag in tagSet:
+            dir_cnt[tag] += delta
+            if dir_cnt[tag] == 0:
+                del dir_cnt[tag]
+        if len(dir_cnt) == 0:
+            self.dir_tag_cnt.pop(dir_key)